@@ -1,5 +1,7 @@
 import modal
 
+from config.general import VOLUME_PATH
+
 COMMON_PACKAGES = [
     "torchvision",
     "transformers==4.57.0",
@@ -8,11 +10,46 @@ COMMON_PACKAGES = [
     "Pillow",
     "requests",
     "hf_transfer",
+    "optimum-quanto",
 ]
 GPU = "L40S"
 SCALEDOWN_WINDOW = 60 # seconds
 TIMEOUT = 900 # seconds
 MIN_CONTAINERS = 0 # 0 to make sure we don't pay 24/7
+# enable only once benchmark_cold_start (services/decoder.py) shows a cold start gain for the deployed profiles:
+# - USE_MEMORY_SNAPSHOT relies on Modal's experimental enable_gpu_snapshot
+# - USE_SERIALIZED_MODELS keeps a save_pretrained copy of every loaded model on the volume (~9 GB per Qwen3-8B-FP8 model),
+#   written and committed to the volume during the first cold start
+USE_MEMORY_SNAPSHOT = False # snapshot Qwen3Decoder (GPU memory included) after preload, and restore it on cold starts
+USE_SERIALIZED_MODELS = False # load models from a save_pretrained copy on the volume (saved on first load) instead of the Hub
+SERIALIZED_MODELS_PATH = f"{VOLUME_PATH}/decoder_models"
+USE_RESPONSE_CACHE = True # agents reuse the stored output of an identical request (same model, profile, prompt and sampling params)
+RESPONSE_CACHE_PATH = f"{VOLUME_PATH}/decoder_response_cache"
+RESPONSE_CACHE_TTL_SECONDS = 30 * 24 * 3600 # 30 days
+RESPONSE_CACHE_MAX_SIZE_MB = 512 # oldest entries evicted above it
+RESPONSE_CACHE_OPT_OUT_PROFILES = [] # sampling-sensitive profiles that must get a fresh sample on every call
+RESPONSE_CACHE_SAMPLING_PARAMS = ["max_new_tokens", "max_context_tokens", "temperature", "top_p", "top_k", "enable_thinking", "thinking_budget"] # part of the cache key
+USE_GRAMMAR_CONSTRAINED_DECODING = False # mask tokens that would break the profile's tag structure (PROFILE_GRAMMARS), a Python automaton checking GRAMMAR_MAX_CANDIDATES tokens per step
+GRAMMAR_MAX_CANDIDATES = 64 # highest-scoring tokens checked against the grammar per step (>= top_k)
+# appended (token by token) once a sequence reaches its profile's "thinking_budget", to move on to the answer
+THINKING_BUDGET_END_TEXT = "\n\nConsidering the limited time, I have to give the answer based on my thinking directly now.\n</think>\n\n"
+DRAFT_MODEL_PATH = "Qwen/Qwen3-0.6B" # speculative decoding draft model (same tokenizer), opted into per profile with "draft_model_path": DRAFT_MODEL_PATH
+DECODER_BACKEND = "modal" # agents' decoder: "modal" (deployed Qwen3Decoder), "local" (tiny model on CPU) or "fake" (no model), overridden by the DECODER_BACKEND env var
+LOCAL_DECODER_MODEL_PATH = "Qwen/Qwen3-0.6B" # model run by the "local" backend (instead of every profile's model_path)
+LOCAL_DECODER_MAX_NEW_TOKENS = 512 # per request, for the "local" backend
+MODEL_REGISTRY_GPU_MEMORY_BUDGET_GB = 32 # resident models (weights) per Qwen3Decoder container, evicted LRU (rest of the GPU for KV caches)
+USE_DECODER_METRICS = True # agents append each decoder request's metrics (tokens, timing, peak memory, cache hits) to DECODER_METRICS_PATH
+DECODER_METRICS_PATH = f"{VOLUME_PATH}/decoder_metrics" # one JSONL file per worker and day
+COLD_START_BENCHMARK_FILE = "decoder_cold_start.jsonl" # appended to (in RESULTS_DIR_NAME) by benchmark_cold_start
+DECODER_TOKEN_BUDGET = 65536 # KV cache tokens (prompt + capped max_new_tokens, over a batch) a Qwen3Decoder container admits at once
+# profiles' "kv_cache_mode": "quantized" (KV_CACHE_QUANTIZATION_CONFIG) or "offloaded" (CPU memory), None for full precision
+KV_CACHE_QUANTIZATION_CONFIG = {"backend": "quanto", "nbits": 4}
+KV_CACHE_MODE_TOKEN_BUDGET_FACTORS = {"quantized": 3, "offloaded": 4} # DECODER_TOKEN_BUDGET multiplier per kv_cache_mode
+KV_CACHE_BENCHMARK_FILE = "decoder_kv_cache.jsonl" # appended to (in RESULTS_DIR_NAME) by benchmark_kv_cache
+VLM_IMAGE_CACHE_MAX_ENTRIES = 128 # preprocessed images (by image hash) kept per decoder container, reused across turns, retries and prompts
+MAX_BATCH_SIZE = 8 # prompts per model.generate call in run_qwen3_lm_or_vlm_batch
+USE_PREFIX_CACHE = True # reuse the KV cache of the prompt prefix shared by a profile's requests (text models)
+PREFIX_CACHE_MIN_TOKENS = 256 # shorter shared prefixes are not worth a resident cache
 FLASH_ATTENTION_RELEASE = "https://github.com/Dao-AILab/flash-attention/releases/download/v2.8.3/flash_attn-2.8.3+cu12torch2.8cxx11abiFALSE-cp311-cp311-linux_x86_64.whl"
 FLASH_ATTENTION_IMAGE = "anywinter4079/pytorch:2.8.0-py3.11-cuda12.8.1-cudnn-devel-ubuntu22.04-runpod-clone"
 FLASH_ATTENTION_RUN_COMMANDS = ("python -m pip install --upgrade pip && "
@@ -60,6 +97,7 @@ THREAD_GROUPER_MAX_EMAILS = 20
 EMAIL_WRITER_PROFILE = "email_writer"
 THREAD_GROUPER_PROFILE = "thread_grouper"
 DATA_CLEANER_PROFILE = "data_cleaner"
+PRELOAD_PROFILES = [EMAIL_WRITER_PROFILE, DATA_CLEANER_PROFILE] # models loaded (and warmed up) when a decoder container starts
 
 DIRECTOR_EMAIL = "masteria.dia@fi.upm.es"
 DIRECTOR_NAME = "Damiano Zanardini"
@@ -79,10 +117,58 @@ EXAMPLE_DIRECTOR_PEER_EMAIL = "elena.torres@fi.upm.es"
 EXAMPLE_PROF1_EMAIL = "carmen.santos@fi.upm.es"
 EXAMPLE_PROF2_EMAIL = "luis.martin@fi.upm.es"
 
+# closing tags after which generation stops (once thinking is over), per profile
+PROFILE_STOP_TAGS = {
+    EMAIL_WRITER_PROFILE: [MESSAGE_CLOSING_TAG, NO_MESSAGE_CLOSING_TAG],
+    DATA_CLEANER_PROFILE: [QUESTIONS_CLOSING_TAG]
+}
+# (opening, closing) tags reported by the streaming tag parser as soon as they close, per profile
+PROFILE_FIELD_TAGS = {
+    EMAIL_WRITER_PROFILE: [
+        (MESSAGE_OPENING_TAG, MESSAGE_CLOSING_TAG),
+        (NO_MESSAGE_OPENING_TAG, NO_MESSAGE_CLOSING_TAG)
+    ],
+    DATA_CLEANER_PROFILE: [
+        (ABSTRACT_OPENING_TAG, ABSTRACT_CLOSING_TAG),
+        (SUMMARY_OPENING_TAG, SUMMARY_CLOSING_TAG),
+        (CLEANED_TEXT_OPENING_TAG, CLEANED_TEXT_CLOSING_TAG),
+        (QUESTION_OPENING_TAG, QUESTION_CLOSING_TAG),
+        (ANSWER_OPENING_TAG, ANSWER_CLOSING_TAG)
+    ]
+}
+# output structure enforced after the thinking block (USE_GRAMMAR_CONSTRAINED_DECODING), per profile:
+# ("field", opening, closing) free text, ("block", opening, closing, node) nested tags, ("sequence", [nodes]),
+# ("choice", [nodes]), ("repeat", node) zero or more times (whitespace is allowed around tags)
+PROFILE_GRAMMARS = {
+    EMAIL_WRITER_PROFILE: ("choice", [
+        ("field", MESSAGE_OPENING_TAG, MESSAGE_CLOSING_TAG),
+        ("field", NO_MESSAGE_OPENING_TAG, NO_MESSAGE_CLOSING_TAG)
+    ]),
+    THREAD_GROUPER_PROFILE: ("repeat", ("block", THREAD_OPENING_TAG, THREAD_CLOSING_TAG, ("repeat", (
+        "block", THREAD_MESSAGE_OPENING_TAG, THREAD_MESSAGE_CLOSING_TAG, ("sequence", [
+            ("field", THREAD_FROM_OPENING_TAG, THREAD_FROM_CLOSING_TAG),
+            ("field", THREAD_TO_OPENING_TAG, THREAD_TO_CLOSING_TAG),
+            ("field", THREAD_SUBJECT_OPENING_TAG, THREAD_SUBJECT_CLOSING_TAG),
+            ("field", THREAD_BODY_OPENING_TAG, THREAD_BODY_CLOSING_TAG)
+        ])
+    )))),
+    DATA_CLEANER_PROFILE: ("sequence", [
+        ("field", ABSTRACT_OPENING_TAG, ABSTRACT_CLOSING_TAG),
+        ("field", SUMMARY_OPENING_TAG, SUMMARY_CLOSING_TAG),
+        ("field", CLEANED_TEXT_OPENING_TAG, CLEANED_TEXT_CLOSING_TAG),
+        ("block", QUESTIONS_OPENING_TAG, QUESTIONS_CLOSING_TAG, ("repeat", ("sequence", [
+            ("field", QUESTION_OPENING_TAG, QUESTION_CLOSING_TAG),
+            ("field", ANSWER_OPENING_TAG, ANSWER_CLOSING_TAG)
+        ])))
+    ])
+}
+
 MODEL_PROFILES = {
     EMAIL_WRITER_PROFILE: {
         "model_path": "Qwen/Qwen3-8B-FP8",
         "is_vision_model": False,
+        "is_lora_adapter": False,
+        "draft_model_path": None, # DRAFT_MODEL_PATH for speculative decoding (disables the prefix cache)
         "system_prompt": "You are a concise, professional corporate email assistant.",
         "prompt_template": (
             "You are taking the role of {my_name}, {my_description}. You are reading an email sent to you.\n"
@@ -140,11 +226,15 @@ MODEL_PROFILES = {
         "top_k": 20,
         "use_flash_attention_2": USE_FLASH_ATTENTION_IMAGE,
         "enable_thinking": True,
+        "thinking_budget": 4096, # thinking tokens before </think> is forced (None for no limit)
+        "kv_cache_mode": None, # "quantized" or "offloaded" for more concurrent long (32k) requests
         "return_prompt_text": True
     },
     THREAD_GROUPER_PROFILE: {
         "model_path": "Qwen/Qwen3-8B-FP8",
         "is_vision_model": False,
+        "is_lora_adapter": False,
+        "draft_model_path": None,
         "system_prompt": (
             "You are an expert email thread reconstruction assistant."
         ),
@@ -268,11 +358,15 @@ MODEL_PROFILES = {
         "top_k": 20,
         "use_flash_attention_2": USE_FLASH_ATTENTION_IMAGE,
         "enable_thinking": True,
+        "thinking_budget": 4096, # below max_new_tokens, so the answer always gets room
+        "kv_cache_mode": None,
         "return_prompt_text": True
     },
     DATA_CLEANER_PROFILE: {
         "model_path": "Qwen/Qwen3-8B-FP8",
         "is_vision_model": False,
+        "is_lora_adapter": False,
+        "draft_model_path": None,
         "system_prompt": (
             "You are an expert Knowledge Curator for a RAG system. Your task is to transform the following raw text into a high-quality, English-language knowledge base entry.\n\n"
             "### CONTEXTUAL INFORMATION & RULES:\n"
@@ -382,6 +476,8 @@ MODEL_PROFILES = {
         "top_k": 20,
         "use_flash_attention_2": USE_FLASH_ATTENTION_IMAGE,
         "enable_thinking": True,
+        "thinking_budget": 2048,
+        "kv_cache_mode": None,
         "return_prompt_text": True
     }
 }
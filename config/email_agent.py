@@ -1,7 +1,9 @@
 import modal
 
+from config.general import VOLUME_PATH
+
 MAX_EMAILS = 2
-CONTEXT_EMAILS_PER_FOLDER = 20
+CONTEXT_EMAILS_PER_FOLDER = 100 # read from the mailbox mirror (no download per context email)
 # < 0 to keep all tokens
 MAX_UNQUOTED_TOKENS_PER_CURRENT_EMAIL = 1500
 MAX_UNQUOTED_TOKENS_PER_CONTEXT_EMAIL = 1000
@@ -15,6 +17,10 @@ LAST_N_DAYS = 120
 SEND_TO_SELF = True
 SAVE_AS_DRAFT = True
 DRAFTS_FOLDER = "Drafts"
+IMAP_FETCH_BATCH_SIZE = 50 # max messages per bulk FETCH when syncing the mailbox mirror
+USE_MAILBOX_MIRROR = True # keep synced inbox/sent messages (by folder, UIDVALIDITY and UID) on the volume across runs
+MAILBOX_MIRROR_PATH = f"{VOLUME_PATH}/mailbox_mirror" # one JSON file per folder
+MAILBOX_MIRROR_MAX_FETCH_PER_SYNC = 500 # new messages fetched per folder and run (latest first, the rest on later runs)
 
 EMAIL_HOUR = 9
 EMAIL_MINUTE = 0
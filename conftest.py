@@ -0,0 +1,2 @@
+# smoke_test.py is a script (DECODER_BACKEND=fake python smoke_test.py), not a pytest module
+collect_ignore = ["smoke_test.py"]
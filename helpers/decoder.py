@@ -2,17 +2,12 @@
 # Helper 1: Extract content between tags #
 ##########################################
 def extract_matched_content(response, opening_tag, closing_tag):
-    import re
-
     if response is None:
         return None
 
-    # match text within tags (we use () to return content inside the match)
-    # . -> any character
-    # * -> zero or more times
-    # ? -> stop as soon as possible (at the 1st closing tag match, vs at the last one)
-    matches = re.findall(f"{opening_tag}(.*?){closing_tag}", response, flags=re.DOTALL)
-    return [match.strip() for match in matches]
+    # contents of every (closed) tag pair, outer ones first (see scan_tags)
+    tag_nodes = find_tag_nodes(scan_tags(response, [(opening_tag, closing_tag)]), opening_tag)
+    return [tag_node["content"] for tag_node in tag_nodes]
 
 ##############################################
 # Helper 2: Remove <think>...</think> tokens #
@@ -41,13 +36,18 @@ def extract_message_content(
     if response is None:
         return None
 
+    tag_nodes = scan_tags(response, [
+        (no_message_opening_tag, no_message_closing_tag),
+        (message_opening_tag, message_closing_tag)
+    ])
+
     # if LM thinks it does not have enough info to answer, we do not reply
-    no_message = extract_matched_content(response, no_message_opening_tag, no_message_closing_tag)
+    no_message = find_tag_nodes(tag_nodes, no_message_opening_tag)
     if no_message:
         return None
     
     # if LM thinks it has enough info to answer, use the message
-    message = extract_matched_content(response, message_opening_tag, message_closing_tag)
+    message = [tag_node["content"] for tag_node in find_tag_nodes(tag_nodes, message_opening_tag)]
     if message:
         # return message (there should be a single message per response)
         return message[0]
@@ -55,10 +55,10 @@ def extract_message_content(
     # if neither tag, we do not reply (LM did not follow intructions or instructions were not correct)
     return None
 
-#################################################################################
-# Helper 4: Extract <from>...</from>, <to>...</to>, <subject>...</subject>      #
-#                   <body>...</body>                                            # 
-#################################################################################
+############################################################################
+# Helper 4: Extract <from>...</from>, <to>...</to>, <subject>...</subject> #
+#                   <body>...</body>                                       #
+############################################################################
 def extract_thread_content(
         response,
         thread_opening_tag,
@@ -78,35 +78,44 @@ def extract_thread_content(
     if response is None:
         return None
 
-    threads = extract_matched_content(response, thread_opening_tag, thread_closing_tag)
+    # one pass over the response, threads' messages and fields are then read from the tag tree
+    tag_nodes = scan_tags(response, [
+        (thread_opening_tag, thread_closing_tag),
+        (message_opening_tag, message_closing_tag),
+        (from_opening_tag, from_closing_tag),
+        (to_opening_tag, to_closing_tag),
+        (subject_opening_tag, subject_closing_tag),
+        (body_opening_tag, body_closing_tag)
+    ])
+    threads = find_tag_nodes(tag_nodes, thread_opening_tag)
     if not threads:
         return None
 
     parsed_threads = []
-    for thread_text in threads:
-        messages = extract_matched_content(thread_text, message_opening_tag, message_closing_tag)
+    for thread_node in threads:
+        messages = find_tag_nodes(thread_node["children"], message_opening_tag, direct_children_only=True)
         parsed_messages = []
-        for message_text in messages:
-            from_value = extract_matched_content(message_text, from_opening_tag, from_closing_tag)
-            to_value = extract_matched_content(message_text, to_opening_tag, to_closing_tag)
-            subject_value = extract_matched_content(message_text, subject_opening_tag, subject_closing_tag)
-            body_value = extract_matched_content(message_text, body_opening_tag, body_closing_tag)
+        for message_node in messages:
+            from_value = find_tag_nodes(message_node["children"], from_opening_tag, direct_children_only=True)
+            to_value = find_tag_nodes(message_node["children"], to_opening_tag, direct_children_only=True)
+            subject_value = find_tag_nodes(message_node["children"], subject_opening_tag, direct_children_only=True)
+            body_value = find_tag_nodes(message_node["children"], body_opening_tag, direct_children_only=True)
 
             parsed_messages.append({
-                "from": from_value[0] if from_value else None,
-                "to": to_value[0] if to_value else None,
-                "subject": subject_value[0] if subject_value else None,
-                "body": body_value[0] if body_value else None
+                "from": from_value[0]["content"] if from_value else None,
+                "to": to_value[0]["content"] if to_value else None,
+                "subject": subject_value[0]["content"] if subject_value else None,
+                "body": body_value[0]["content"] if body_value else None
             })
         parsed_threads.append({"messages": parsed_messages})
 
     return parsed_threads
 
-#################################################################################
-# Helper 5: Extract <abstract>...</abstract>, <summary>...</summary>,           # 
-#                   <cleanedtext>...</cleanedtext>, <question>...</question>    #
-#                   <answer>...</answer>                                        #
-#################################################################################
+##############################################################################
+# Helper 5: Extract <abstract>...</abstract>, <summary>...</summary>,        #
+#                   <cleanedtext>...</cleanedtext>, <question>...</question> #
+#                   <answer>...</answer>                                     #
+##############################################################################
 def extract_lm_cleaned_content(
         response,
         abstract_opening_tag,
@@ -125,21 +134,28 @@ def extract_lm_cleaned_content(
     if response is None:
         return None
     
-    # extract abstract, summary, cleanedtext, questions, answers
-    abstract = extract_matched_content(response, abstract_opening_tag, abstract_closing_tag)
+    # extract abstract, summary, cleanedtext, questions, answers (in one pass over the response)
+    tag_nodes = scan_tags(response, [
+        (abstract_opening_tag, abstract_closing_tag),
+        (summary_opening_tag, summary_closing_tag),
+        (cleanedtext_opening_tag, cleanedtext_closing_tag),
+        (question_opening_tag, question_closing_tag),
+        (answer_opening_tag, answer_closing_tag)
+    ])
+    abstract = [tag_node["content"] for tag_node in find_tag_nodes(tag_nodes, abstract_opening_tag)]
     if abstract:
         # there should be a single abstract per response
         abstract = abstract[0]
-    summary = extract_matched_content(response, summary_opening_tag, summary_closing_tag)
+    summary = [tag_node["content"] for tag_node in find_tag_nodes(tag_nodes, summary_opening_tag)]
     if summary:
         # there should be a single summary per response
         summary = summary[0]
-    cleanedtext = extract_matched_content(response, cleanedtext_opening_tag, cleanedtext_closing_tag)
+    cleanedtext = [tag_node["content"] for tag_node in find_tag_nodes(tag_nodes, cleanedtext_opening_tag)]
     if cleanedtext:
         # there should be a single cleanedtext per response
         cleanedtext = cleanedtext[0]
-    questions = extract_matched_content(response, question_opening_tag, question_closing_tag)
-    answers = extract_matched_content(response, answer_opening_tag, answer_closing_tag)
+    questions = [tag_node["content"] for tag_node in find_tag_nodes(tag_nodes, question_opening_tag)]
+    answers = [tag_node["content"] for tag_node in find_tag_nodes(tag_nodes, answer_opening_tag)]
 
     return [abstract, summary, cleanedtext, questions, answers]
 
@@ -173,3 +189,1521 @@ def truncate_to_tokens(tokenizer, text, max_tokens):
         skip_special_tokens=True
     ).strip()
     return f"{truncated}{ellipsis}" if truncated else ellipsis
+
+##############################################
+# Helper 7: Load decoder model and processor #
+##############################################
+def load_decoder_model(
+        model_path,
+        is_vision_model,
+        is_lora_adapter,
+        use_flash_attention_2,
+        worker_name
+        ):
+    from peft import AutoPeftModelForCausalLM
+    from transformers import AutoTokenizer, AutoModelForCausalLM, AutoProcessor, Qwen3VLForConditionalGeneration
+
+    print(
+        f"{worker_name}: loading model from {model_path} "
+        f"(is_vision_model: {is_vision_model}, is_lora_adapter: {is_lora_adapter})..."
+    )
+    attn_implementation = "sdpa" if not use_flash_attention_2 else "flash_attention_2"
+
+    # model is a LoRA adapter (to load on top of the base model), per profile metadata
+    if is_lora_adapter:
+        model = AutoPeftModelForCausalLM.from_pretrained(
+            model_path,
+            dtype="auto",
+            device_map="auto",
+            attn_implementation=attn_implementation
+        )
+    # or base model
+    elif is_vision_model:
+        model = Qwen3VLForConditionalGeneration.from_pretrained(
+            model_path,
+            dtype="auto",
+            device_map="auto",
+            attn_implementation=attn_implementation
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            dtype="auto",
+            device_map="auto",
+            attn_implementation=attn_implementation
+        )
+    if is_vision_model:
+        processor = AutoProcessor.from_pretrained(model_path)
+        tokenizer = processor.tokenizer
+    else:
+        processor = AutoTokenizer.from_pretrained(model_path)
+        tokenizer = processor
+    # left padding so batched prompts end right where generation starts
+    tokenizer.padding_side = "left"
+
+    print(f"{worker_name}: model and processor loaded")
+    return model, processor
+
+##################################################
+# Helper 8: Form VLM input turn (text and image) #
+##################################################
+def form_vlm_input_turn_content(input_text, input_image_in_bytes):
+    # the image is only a placeholder for the chat template: its pixels are preprocessed (and cached by
+    # hash) by preprocess_vlm_images
+    content = [{"type": "text", "text": input_text}]
+    if input_image_in_bytes:
+        content.insert(0, {"type": "image"})
+    return content
+
+#########################################################
+# Helper 9: Build decoder messages (system, context and #
+#           current turn)                               #
+#########################################################
+def build_decoder_messages(
+        context,
+        current_turn_input_text,
+        current_turn_image_in_bytes,
+        system_prompt,
+        is_vision_model
+        ):
+    messages = []
+
+    # add system prompt
+    messages.append({
+        "role": "system",
+        "content": [{"type": "text", "text": system_prompt}] if is_vision_model else system_prompt
+    })
+
+    # add context (both input and output)
+    for context_turn in context:
+        messages.append({
+            "role": "user",
+            "content": (
+                form_vlm_input_turn_content(context_turn["input_text"], context_turn.get("input_image"))
+                if is_vision_model
+                else context_turn["input_text"]
+            )
+        })
+        messages.append({
+            "role": "assistant",
+            "content": [{"type": "text", "text": context_turn["output_text"]}] if is_vision_model else context_turn["output_text"]
+        })
+
+    # add current turn input
+    messages.append({
+        "role": "user",
+        "content": (
+            form_vlm_input_turn_content(current_turn_input_text, current_turn_image_in_bytes)
+            if is_vision_model
+            else current_turn_input_text
+        )
+    })
+    return messages
+
+#########################################################
+# Helper 10: Apply chat template (as text or as tokens) #
+#########################################################
+def apply_decoder_chat_template(processor, messages, is_vision_model, enable_thinking, tokenize):
+    # messages can be a single conversation or a list of conversations (batch)
+    template_kwargs = {"add_generation_prompt": True}
+    if tokenize:
+        template_kwargs.update({
+            "tokenize": True,
+            "return_dict": True,
+            "return_tensors": "pt",
+            "padding": True
+        })
+    else:
+        template_kwargs["tokenize"] = False
+    # the VLM processor template does not take enable_thinking
+    if not is_vision_model:
+        template_kwargs["enable_thinking"] = enable_thinking
+    return processor.apply_chat_template(messages, **template_kwargs)
+
+#####################################################
+# Helper 11: Extract decoder output for its profile #
+#####################################################
+def extract_decoder_profile_content(output_text, decoder_profile, enable_thinking, worker_name):
+    from config.decoder import (
+        EMAIL_WRITER_PROFILE,
+        THREAD_GROUPER_PROFILE,
+        DATA_CLEANER_PROFILE,
+        NO_MESSAGE_OPENING_TAG,
+        NO_MESSAGE_CLOSING_TAG,
+        MESSAGE_OPENING_TAG,
+        MESSAGE_CLOSING_TAG,
+        ABSTRACT_OPENING_TAG,
+        ABSTRACT_CLOSING_TAG,
+        SUMMARY_OPENING_TAG,
+        SUMMARY_CLOSING_TAG,
+        CLEANED_TEXT_OPENING_TAG,
+        CLEANED_TEXT_CLOSING_TAG,
+        THREAD_OPENING_TAG,
+        THREAD_CLOSING_TAG,
+        THREAD_MESSAGE_OPENING_TAG,
+        THREAD_MESSAGE_CLOSING_TAG,
+        THREAD_FROM_OPENING_TAG,
+        THREAD_FROM_CLOSING_TAG,
+        THREAD_TO_OPENING_TAG,
+        THREAD_TO_CLOSING_TAG,
+        THREAD_SUBJECT_OPENING_TAG,
+        THREAD_SUBJECT_CLOSING_TAG,
+        THREAD_BODY_OPENING_TAG,
+        THREAD_BODY_CLOSING_TAG,
+        QUESTION_OPENING_TAG,
+        QUESTION_CLOSING_TAG,
+        ANSWER_OPENING_TAG,
+        ANSWER_CLOSING_TAG
+    )
+
+    # remove think tokens if thinking mode
+    if enable_thinking:
+        output_text = remove_think_tokens(output_text)
+
+    # extract reply if LM think it has enough info to answer
+    if decoder_profile == EMAIL_WRITER_PROFILE:
+        return extract_message_content(
+            output_text,
+            NO_MESSAGE_OPENING_TAG,
+            NO_MESSAGE_CLOSING_TAG,
+            MESSAGE_OPENING_TAG,
+            MESSAGE_CLOSING_TAG
+        )
+    elif decoder_profile == THREAD_GROUPER_PROFILE:
+        return extract_thread_content(
+            output_text,
+            THREAD_OPENING_TAG,
+            THREAD_CLOSING_TAG,
+            THREAD_MESSAGE_OPENING_TAG,
+            THREAD_MESSAGE_CLOSING_TAG,
+            THREAD_FROM_OPENING_TAG,
+            THREAD_FROM_CLOSING_TAG,
+            THREAD_TO_OPENING_TAG,
+            THREAD_TO_CLOSING_TAG,
+            THREAD_SUBJECT_OPENING_TAG,
+            THREAD_SUBJECT_CLOSING_TAG,
+            THREAD_BODY_OPENING_TAG,
+            THREAD_BODY_CLOSING_TAG
+        )
+    elif decoder_profile == DATA_CLEANER_PROFILE:
+        return extract_lm_cleaned_content(
+            output_text,
+            ABSTRACT_OPENING_TAG,
+            ABSTRACT_CLOSING_TAG,
+            SUMMARY_OPENING_TAG,
+            SUMMARY_CLOSING_TAG,
+            CLEANED_TEXT_OPENING_TAG,
+            CLEANED_TEXT_CLOSING_TAG,
+            QUESTION_OPENING_TAG,
+            QUESTION_CLOSING_TAG,
+            ANSWER_OPENING_TAG,
+            ANSWER_CLOSING_TAG
+        )
+    print(f"{worker_name}: unknown decoder_profile '{decoder_profile}'")
+    return None
+
+#################################################################
+# Helper 12: Get (a copy of) the resident KV cache for a prompt #
+#            prefix shared with previous requests               #
+#################################################################
+def get_prefix_cache(cache_owner, model, cache_key, input_ids, min_prefix_tokens, worker_name):
+    import copy
+    import torch
+    from transformers import DynamicCache
+
+    # one resident prefix per cache_key (e.g., model path, profile and LoRA adapter)
+    if not hasattr(cache_owner, "prefix_caches"):
+        cache_owner.prefix_caches = {}
+    request_ids = input_ids[0].tolist()
+    entry = cache_owner.prefix_caches.get(cache_key)
+
+    # 1st request: remember its ids, the shared prefix is only known once a 2nd request arrives
+    if entry is None:
+        cache_owner.prefix_caches[cache_key] = {"input_ids": request_ids, "cache": None}
+        return None, 0
+
+    # longest common prefix (leaving at least one token for generate to prefill)
+    prefix_length = 0
+    max_prefix_length = min(len(entry["input_ids"]), len(request_ids) - 1)
+    while prefix_length < max_prefix_length and entry["input_ids"][prefix_length] == request_ids[prefix_length]:
+        prefix_length += 1
+    if prefix_length < min_prefix_tokens:
+        print(f"{worker_name}: prefix cache miss for {cache_key} ({prefix_length} shared tokens)")
+        return None, 0
+
+    # compute the shared prefix KV cache once (static system prompt, instructions, few-shot examples)
+    if entry["cache"] is None:
+        prefix_cache = DynamicCache()
+        with torch.no_grad():
+            model(input_ids=input_ids[:, :prefix_length], past_key_values=prefix_cache, use_cache=True)
+        entry = {"input_ids": request_ids[:prefix_length], "cache": prefix_cache}
+        cache_owner.prefix_caches[cache_key] = entry
+        print(f"{worker_name}: prefix cache built for {cache_key} ({prefix_length} tokens)")
+    # or shorten it if this request diverges earlier (e.g., a variable field right after the instructions)
+    elif prefix_length < len(entry["input_ids"]):
+        entry["cache"].crop(prefix_length)
+        entry["input_ids"] = entry["input_ids"][:prefix_length]
+        print(f"{worker_name}: prefix cache for {cache_key} cropped to {prefix_length} tokens")
+
+    # generate extends the cache in place, so each request starts from a copy
+    return copy.deepcopy(entry["cache"]), prefix_length
+
+################################################
+# Helper 13: Create streaming tag parser state #
+################################################
+def create_tag_stream_state(field_tags, stop_tags, enable_thinking):
+    return {
+        "field_tags": field_tags,
+        "stop_tags": stop_tags,
+        # tags inside <think>...</think> are ignored (the model may quote them while reasoning)
+        "in_answer": not enable_thinking,
+        "buffer": "",
+        "open_field": None,
+        "search_start": 0,
+        "fields": [],
+        "done": False
+    }
+
+###########################################################
+# Helper 14: Feed decoded text to streaming tag parser    #
+#            (returns the fields completed by this delta) #
+###########################################################
+def feed_tag_stream(state, text_delta):
+    think_closing_tag = "</think>"
+    completed_fields = []
+    if state["done"]:
+        return completed_fields
+    state["buffer"] += text_delta
+
+    while True:
+        buffer = state["buffer"]
+
+        # skip the thinking block
+        if not state["in_answer"]:
+            think_end = buffer.find(think_closing_tag)
+            if think_end == -1:
+                # keep a tail in case the tag is split across deltas
+                state["buffer"] = buffer[-(len(think_closing_tag) - 1):]
+                break
+            state["buffer"] = buffer[think_end + len(think_closing_tag):]
+            state["in_answer"] = True
+            continue
+
+        # inside a field: wait for its closing tag
+        if state["open_field"] is not None:
+            opening_tag, closing_tag = state["open_field"]
+            field_end = buffer.find(closing_tag, state["search_start"])
+            if field_end == -1:
+                state["search_start"] = max(0, len(buffer) - len(closing_tag) + 1)
+                break
+            completed_fields.append((opening_tag[1:-1], buffer[:field_end].strip()))
+            state["buffer"] = buffer[field_end + len(closing_tag):]
+            state["open_field"] = None
+            state["search_start"] = 0
+            if closing_tag in state["stop_tags"]:
+                state["done"] = True
+                break
+            continue
+
+        # outside fields: find whichever comes first, an opening tag or a stop tag
+        next_tag_start, next_tag, next_field = -1, None, None
+        for opening_tag, closing_tag in state["field_tags"]:
+            tag_start = buffer.find(opening_tag)
+            if tag_start != -1 and (next_tag_start == -1 or tag_start < next_tag_start):
+                next_tag_start, next_tag, next_field = tag_start, opening_tag, (opening_tag, closing_tag)
+        for stop_tag in state["stop_tags"]:
+            tag_start = buffer.find(stop_tag)
+            if tag_start != -1 and (next_tag_start == -1 or tag_start < next_tag_start):
+                next_tag_start, next_tag, next_field = tag_start, stop_tag, None
+        if next_tag is None:
+            # keep a tail in case a tag is split across deltas
+            longest_tag = max([len(tag) for tags in state["field_tags"] for tag in tags] + [len(tag) for tag in state["stop_tags"]] + [1])
+            state["buffer"] = buffer[-(longest_tag - 1):] if longest_tag > 1 else ""
+            break
+        state["buffer"] = buffer[next_tag_start + len(next_tag):]
+        if next_field is None:
+            state["done"] = True
+            break
+        state["open_field"] = next_field
+
+    state["fields"].extend(completed_fields)
+    return completed_fields
+
+###################################################################
+# Helper 15: Build stopping criteria that stop each sequence once #
+#            its profile's closing tag is generated               #
+###################################################################
+def build_tag_stopping_criteria(tokenizer, prompt_length, batch_size, decoder_profile, enable_thinking, worker_name):
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+    from config.decoder import PROFILE_STOP_TAGS, PROFILE_FIELD_TAGS
+
+    stop_tags = PROFILE_STOP_TAGS.get(decoder_profile, [])
+    field_tags = PROFILE_FIELD_TAGS.get(decoder_profile, [])
+    if not stop_tags and not field_tags:
+        return None, None
+
+    class TagStoppingCriteria(StoppingCriteria):
+        def __init__(self):
+            self.states = [create_tag_stream_state(field_tags, stop_tags, enable_thinking) for _ in range(batch_size)]
+            # generated tokens already fed to each parser, and tokens waiting for a complete character
+            self.consumed = [0] * batch_size
+            self.pending_ids = [[] for _ in range(batch_size)]
+
+        def __call__(self, input_ids, scores, **kwargs):
+            for row, state in enumerate(self.states):
+                if state["done"]:
+                    continue
+                new_ids = input_ids[row, prompt_length + self.consumed[row]:].tolist()
+                self.consumed[row] += len(new_ids)
+                self.pending_ids[row].extend(new_ids)
+                text_delta = tokenizer.decode(self.pending_ids[row], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+                # a multi-byte character split across tokens decodes as U+FFFD until it is complete
+                if text_delta.endswith("\ufffd"):
+                    continue
+                self.pending_ids[row] = []
+                for field_name, field_content in feed_tag_stream(state, text_delta):
+                    print(f"{worker_name}: sequence {row} completed <{field_name}> ({len(field_content)} chars)")
+            return torch.tensor([state["done"] for state in self.states], dtype=torch.bool, device=input_ids.device)
+
+    tag_stopping_criteria = TagStoppingCriteria()
+    return StoppingCriteriaList([tag_stopping_criteria]), tag_stopping_criteria.states
+
+#####################################################
+# Helper 16: Prepare decoder inputs and prompt text #
+#####################################################
+def prepare_decoder_inputs(
+        model,
+        processor,
+        context,
+        current_turn_input_text,
+        current_turn_image_in_bytes,
+        system_prompt,
+        is_vision_model,
+        enable_thinking,
+        return_prompt_text,
+        prompt_ids=None,
+        cache_owner=None,
+        worker_name="prepare_decoder_inputs"
+        ):
+    # prompt_ids: the prompt already rendered and tokenized by the caller (text models, see render_decoder_prompt)
+    # cache_owner: keeps preprocessed images (VLMs) across requests
+    if prompt_ids is not None and not is_vision_model:
+        inputs = build_decoder_inputs_from_ids(prompt_ids)
+        prompt_text = processor.decode(prompt_ids) if return_prompt_text else None
+        return inputs.to(model.device), prompt_text
+
+    # add system prompt, context and current turn input
+    messages = build_decoder_messages(
+        context,
+        current_turn_input_text,
+        current_turn_image_in_bytes,
+        system_prompt,
+        is_vision_model
+    )
+
+    # render the chat template once and tokenize the rendered text (VLMs: with the turns' preprocessed images)
+    prompt_text = apply_decoder_chat_template(processor, messages, is_vision_model, enable_thinking, tokenize=False)
+    if is_vision_model:
+        inputs = build_vlm_inputs(
+            cache_owner,
+            processor,
+            [prompt_text],
+            [get_vlm_turn_images(context, current_turn_image_in_bytes)],
+            worker_name
+        )
+    else:
+        inputs = tokenize_decoder_prompt(processor, prompt_text)
+    return inputs.to(model.device), prompt_text if return_prompt_text else None
+
+######################################################################
+# Helper 17: Generate token ids (from the shared prefix KV cache and #
+#            stopping at the profile's closing tag)                  #
+######################################################################
+def generate_decoder_ids(
+        cache_owner,
+        model,
+        processor,
+        inputs,
+        model_path,
+        is_vision_model,
+        decoder_profile,
+        enable_thinking,
+        max_new_tokens,
+        temperature,
+        top_p,
+        top_k,
+        worker_name,
+        streamer=None,
+        adapter_names=None,
+        assistant_model=None,
+        thinking_budget=None,
+        generation_stats=None,
+        kv_cache_mode=None
+        ):
+    # generation_stats (optional dict) is filled with per-sequence thinking/answer token counts, throughput,
+    # prefill/decode timing, peak GPU memory and prefix cache hits
+    import time
+    import torch
+    from contextlib import nullcontext
+    from peft import PeftModel
+    from transformers import LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+    from config.decoder import USE_PREFIX_CACHE, PREFIX_CACHE_MIN_TOKENS
+
+    # LoRA adapters attached to a shared base model: one adapter name per prompt (None for the base model)
+    generate_kwargs = {}
+    # (a context factory: entered around the prefix cache forward pass and around generate)
+    adapter_context = nullcontext
+    is_mixed_adapter_batch = False
+    if isinstance(model, PeftModel):
+        adapter_names = adapter_names or [None] * inputs.input_ids.shape[0]
+        is_mixed_adapter_batch = len(set(adapter_names)) > 1
+        # mixed batch: per-row adapters (PEFT mixed adapter batch inference)
+        if is_mixed_adapter_batch:
+            generate_kwargs["adapter_names"] = [name or "__base__" for name in adapter_names]
+        # single adapter: activate it (so prefix cache forward passes use it too)
+        elif adapter_names[0] is not None:
+            model.set_adapter(adapter_names[0])
+        # base model (the last set adapter is disabled, for the prefix cache forward pass too)
+        else:
+            adapter_context = model.disable_adapter
+
+    # opt-in KV cache mode (long contexts): quantized, or offloaded to CPU memory, instead of a full-precision cache
+    kv_cache_kwargs = get_kv_cache_generate_kwargs(kv_cache_mode, worker_name)
+    generate_kwargs.update(kv_cache_kwargs)
+
+    # start from the shared prefix KV cache (so prefill only covers the variable part)
+    # NOTE: single prompts only, left padding would shift a batch's prefix
+    # NOTE: not with a draft model, which would prefill the whole prompt anyway
+    # NOTE: not with a KV cache mode, the resident prefix cache is a full-precision DynamicCache
+    # (keyed by adapter too: a LoRA adapter's keys and values differ from the base model's)
+    past_key_values, prefix_cache_tokens = None, 0
+    if (USE_PREFIX_CACHE and not is_vision_model and inputs.input_ids.shape[0] == 1
+            and not is_mixed_adapter_batch and assistant_model is None and not kv_cache_kwargs):
+        adapter_name = adapter_names[0] if adapter_names else None
+        with adapter_context():
+            past_key_values, prefix_cache_tokens = get_prefix_cache(
+                cache_owner,
+                model,
+                (model_path, decoder_profile, adapter_name),
+                inputs.input_ids,
+                PREFIX_CACHE_MIN_TOKENS,
+                worker_name
+            )
+
+    # stop right after the profile's closing tag (instead of at EOS or max_new_tokens)
+    stopping_criteria, _ = build_tag_stopping_criteria(
+        processor.tokenizer if is_vision_model else processor,
+        inputs.input_ids.shape[1],
+        inputs.input_ids.shape[0],
+        decoder_profile,
+        enable_thinking,
+        worker_name
+    )
+
+    # end of prefill: stopping criteria first run right after the first generated token
+    first_token_times = []
+
+    class FirstTokenTimer(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            if not first_token_times:
+                first_token_times.append(time.perf_counter())
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    stopping_criteria = stopping_criteria or StoppingCriteriaList()
+    stopping_criteria.append(FirstTokenTimer())
+
+    tokenizer = processor.tokenizer if is_vision_model else processor
+    logits_processor = LogitsProcessorList()
+
+    # end thinking (inject </think>) once a sequence has used the profile's thinking budget
+    thinking_budget_processor = build_thinking_budget_logits_processor(
+        tokenizer,
+        inputs.input_ids.shape[1],
+        inputs.input_ids.shape[0],
+        thinking_budget,
+        enable_thinking,
+        worker_name
+    )
+    if thinking_budget_processor is not None:
+        logits_processor.append(thinking_budget_processor)
+
+    # keep the profile's tag structure once thinking is over (instead of extracting nothing from malformed output)
+    grammar_processor = build_grammar_logits_processor(
+        cache_owner,
+        tokenizer,
+        model_path,
+        inputs.input_ids.shape[1],
+        inputs.input_ids.shape[0],
+        decoder_profile,
+        enable_thinking,
+        worker_name
+    )
+    if grammar_processor is not None:
+        logits_processor.append(grammar_processor)
+
+    # speculative (assisted) decoding: the draft model proposes tokens, the model verifies them in one forward pass
+    # NOTE: transformers supports it for single prompts only
+    forward_counts = {"model": 0, "assistant_model": 0}
+    hook_handles = []
+    # NOTE: not with a KV cache mode, rejected draft tokens are rolled back by cropping a DynamicCache
+    if assistant_model is not None and inputs.input_ids.shape[0] == 1 and not kv_cache_kwargs:
+        generate_kwargs["assistant_model"] = assistant_model
+
+        def count_forward(name):
+            def hook(module, args, output):
+                forward_counts[name] += 1
+            return hook
+        # count forward passes at the LM head (also reached through PEFT wrappers)
+        hook_handles.append(model.get_output_embeddings().register_forward_hook(count_forward("model")))
+        hook_handles.append(assistant_model.get_output_embeddings().register_forward_hook(count_forward("assistant_model")))
+
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.perf_counter()
+    try:
+        with torch.no_grad(), adapter_context():
+            generated_ids = model.generate(
+                **inputs,
+                **generate_kwargs,
+                past_key_values=past_key_values,
+                stopping_criteria=stopping_criteria,
+                logits_processor=logits_processor or None,
+                streamer=streamer,
+                max_new_tokens=max_new_tokens,
+                use_cache=True,
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                do_sample=True,
+            )
+    finally:
+        for hook_handle in hook_handles:
+            hook_handle.remove()
+    end_time = time.perf_counter()
+    elapsed_time = end_time - start_time
+    first_token_time = first_token_times[0] if first_token_times else end_time
+    peak_gpu_memory_gb = torch.cuda.max_memory_allocated() / 1024**3 if torch.cuda.is_available() else None
+
+    # throughput (and, with a draft model, share of drafted tokens accepted: each verification step
+    # yields its accepted draft tokens plus one token of its own)
+    generated_token_count = (generated_ids.shape[1] - inputs.input_ids.shape[1]) * generated_ids.shape[0]
+    tokens_per_second = generated_token_count / elapsed_time if elapsed_time > 0 else 0.0
+    if "assistant_model" in generate_kwargs and forward_counts["assistant_model"]:
+        accepted_token_count = max(generated_token_count - forward_counts["model"], 0)
+        acceptance_rate = accepted_token_count / forward_counts["assistant_model"]
+        print(
+            f"{worker_name}: {generated_token_count} tokens at {tokens_per_second:.1f} tok/s "
+            f"(draft acceptance rate: {acceptance_rate:.0%}, {forward_counts['model']} verification steps)"
+        )
+    else:
+        acceptance_rate = None
+        print(f"{worker_name}: {generated_token_count} tokens at {tokens_per_second:.1f} tok/s")
+
+    # thinking vs answer tokens per sequence
+    token_counts = count_thinking_and_answer_tokens(tokenizer, generated_ids, inputs.input_ids.shape[1], enable_thinking)
+    for row, row_token_counts in enumerate(token_counts):
+        print(
+            f"{worker_name}: sequence {row} used {row_token_counts['thinking_tokens']} thinking tokens "
+            f"and {row_token_counts['answer_tokens']} answer tokens"
+        )
+    if generation_stats is not None:
+        generation_stats.update({
+            "token_counts": token_counts,
+            "tokens_per_second": tokens_per_second,
+            "draft_acceptance_rate": acceptance_rate,
+            "first_token_time": first_token_time,
+            "prefill_ms": (first_token_time - start_time) * 1000,
+            "decode_ms": (end_time - first_token_time) * 1000,
+            "peak_gpu_memory_gb": peak_gpu_memory_gb,
+            "prefix_cache_tokens": prefix_cache_tokens
+        })
+    return generated_ids
+
+###########################################################
+# Helper 18: Get the volume path of a serialized model (a #
+#            save_pretrained copy of model_path), or None #
+###########################################################
+def get_serialized_model_path(serialized_models_path, model_path, is_lora_adapter):
+    import os
+
+    # adapters are small and load on top of their base model (from its own path)
+    if is_lora_adapter or os.path.isdir(model_path):
+        return None
+    return os.path.join(serialized_models_path, model_path.replace("/", "--"))
+
+#############################################################
+# Helper 19: Serialize model and processor (safetensors) so #
+#            cold starts load them from the volume          #
+#############################################################
+def serialize_decoder_model(model, processor, serialized_model_path, worker_name):
+    import os
+    import shutil
+
+    # write to a temporary directory first: a partial copy must never be loaded
+    temporary_path = f"{serialized_model_path}.tmp"
+    try:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        model.save_pretrained(temporary_path, safe_serialization=True)
+        processor.save_pretrained(temporary_path)
+        os.rename(temporary_path, serialized_model_path)
+        print(f"{worker_name}: model serialized to {serialized_model_path}")
+        return True
+    except Exception as e:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        print(f"{worker_name}: failed to serialize model to {serialized_model_path}: {e}")
+        return False
+
+##############################################################
+# Helper 20: Get a resident model (or load it), evicting the #
+#            least recently used ones over the memory budget #
+##############################################################
+def get_resident_model(cache_owner, model_key, load_model, gpu_memory_budget_gb, worker_name):
+    import gc
+    import torch
+    from collections import OrderedDict
+
+    # resident models by model_key, least recently used first
+    if not hasattr(cache_owner, "models"):
+        cache_owner.models = OrderedDict()
+    if not hasattr(cache_owner, "model_sizes_gb"):
+        cache_owner.model_sizes_gb = {}
+    if not hasattr(cache_owner, "model_registry_stats"):
+        cache_owner.model_registry_stats = {"hits": 0, "misses": 0, "evictions": 0}
+    stats = cache_owner.model_registry_stats
+
+    if model_key in cache_owner.models:
+        cache_owner.models.move_to_end(model_key)
+        stats["hits"] += 1
+        print(f"{worker_name}: model registry hit for {model_key} (hits: {stats['hits']}, misses: {stats['misses']})")
+        return cache_owner.models[model_key]
+
+    stats["misses"] += 1
+    print(f"{worker_name}: model registry miss for {model_key} (hits: {stats['hits']}, misses: {stats['misses']})")
+
+    def evict_until(max_resident_gb, keep_key=None):
+        while cache_owner.models:
+            resident_gb = sum(cache_owner.model_sizes_gb[key] for key in cache_owner.models)
+            if resident_gb <= max_resident_gb:
+                return
+            evicted_key = next(iter(cache_owner.models))
+            if evicted_key == keep_key:
+                return
+            del cache_owner.models[evicted_key]
+            # prefix KV caches belong to the evicted model (or to LoRA adapters attached to it)
+            lora_base_model_paths = getattr(cache_owner, "lora_base_model_paths", {})
+            for cache_key in [
+                key for key in getattr(cache_owner, "prefix_caches", {})
+                if lora_base_model_paths.get(key[0], key[0]) == evicted_key[0]
+            ]:
+                del cache_owner.prefix_caches[cache_key]
+            stats["evictions"] += 1
+            print(f"{worker_name}: evicted {evicted_key} ({cache_owner.model_sizes_gb[evicted_key]:.1f} GB)")
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    # make room before loading when the model size is known (loaded before), else after
+    evict_until(gpu_memory_budget_gb - cache_owner.model_sizes_gb.get(model_key, 0))
+    model, processor = load_model()
+    cache_owner.models[model_key] = (model, processor)
+    cache_owner.model_sizes_gb[model_key] = model.get_memory_footprint() / 1024**3
+    evict_until(gpu_memory_budget_gb, keep_key=model_key)
+
+    resident_gb = sum(cache_owner.model_sizes_gb[key] for key in cache_owner.models)
+    print(
+        f"{worker_name}: {len(cache_owner.models)} resident models "
+        f"({resident_gb:.1f}/{gpu_memory_budget_gb} GB)"
+    )
+    return model, processor
+
+########################################################
+# Helper 21: Get the base model path of a LoRA adapter #
+########################################################
+def get_lora_base_model_path(adapter_path):
+    from peft import PeftConfig
+
+    return PeftConfig.from_pretrained(adapter_path).base_model_name_or_path
+
+#################################################################
+# Helper 22: Attach a named LoRA adapter to a resident (shared) #
+#            base model, once (returns the PEFT model and name) #
+#################################################################
+def attach_lora_adapter(cache_owner, model_key, adapter_path, worker_name):
+    from peft import PeftModel
+
+    model, processor = cache_owner.models[model_key]
+    # adapter names are module attribute names (no dots)
+    adapter_name = adapter_path.replace("/", "--").replace(".", "_")
+
+    # 1st adapter: wrap the base model (LoRA layers are injected in place)
+    if not isinstance(model, PeftModel):
+        model = PeftModel.from_pretrained(model, adapter_path, adapter_name=adapter_name)
+        model.eval()
+        print(f"{worker_name}: LoRA adapter '{adapter_name}' attached to base model")
+    # next adapters: load next to the others (switched per request)
+    elif adapter_name not in model.peft_config:
+        model.load_adapter(adapter_path, adapter_name=adapter_name)
+        print(f"{worker_name}: LoRA adapter '{adapter_name}' loaded ({len(model.peft_config)} attached)")
+    # already attached: the registry entry is up to date
+    else:
+        return model, adapter_name
+
+    # keep the (wrapped) model resident with its new size
+    cache_owner.models[model_key] = (model, processor)
+    cache_owner.model_sizes_gb[model_key] = model.get_memory_footprint() / 1024**3
+    return model, adapter_name
+
+###########################################################
+# Helper 23: Compile a tag grammar (see PROFILE_GRAMMARS) #
+#            into character-level automaton nodes         #
+###########################################################
+def compile_tag_grammar(grammar):
+    # nodes: ("char", c, next), ("space", next) whitespace loop, ("content", closing, kmp_failure, next)
+    # free text up to its closing tag, ("split", [next, ...]) and ("end",) accepting
+    nodes = []
+
+    def add(node):
+        nodes.append(node)
+        return len(nodes) - 1
+
+    def compile_literal(tag, next_index):
+        for c in reversed(tag):
+            next_index = add(("char", c, next_index))
+        # whitespace allowed before every tag
+        return add(("space", next_index))
+
+    def compile_content(closing_tag, next_index):
+        # KMP failure function: the text inside a field ends at the 1st occurrence of its closing tag
+        kmp_failure = [0] * len(closing_tag)
+        k = 0
+        for i in range(1, len(closing_tag)):
+            while k > 0 and closing_tag[i] != closing_tag[k]:
+                k = kmp_failure[k - 1]
+            if closing_tag[i] == closing_tag[k]:
+                k += 1
+            kmp_failure[i] = k
+        return add(("content", closing_tag, kmp_failure, next_index))
+
+    def compile_node(node, next_index):
+        kind = node[0]
+        if kind == "field":
+            _, opening_tag, closing_tag = node
+            return compile_literal(opening_tag, compile_content(closing_tag, next_index))
+        if kind == "block":
+            _, opening_tag, closing_tag, inner_node = node
+            return compile_literal(opening_tag, compile_node(inner_node, compile_literal(closing_tag, next_index)))
+        if kind == "sequence":
+            for inner_node in reversed(node[1]):
+                next_index = compile_node(inner_node, next_index)
+            return next_index
+        if kind == "choice":
+            return add(("split", [compile_node(inner_node, next_index) for inner_node in node[1]]))
+        if kind == "repeat":
+            loop_index = add(("split", []))
+            nodes[loop_index] = ("split", [compile_node(node[1], loop_index), next_index])
+            return loop_index
+        raise ValueError(f"unknown grammar node: {kind}")
+
+    end_index = add(("space", add(("end",))))
+    start_index = compile_node(grammar, end_index)
+    return {"nodes": nodes, "start": close_tag_grammar_states(nodes, [(start_index, 0)])}
+
+#############################################################
+# Helper 24: Close tag grammar states (follow split and     #
+#            whitespace nodes without consuming characters) #
+#############################################################
+def close_tag_grammar_states(nodes, states):
+    closed = set()
+    stack = list(states)
+    while stack:
+        state = stack.pop()
+        if state in closed:
+            continue
+        closed.add(state)
+        node = nodes[state[0]]
+        if node[0] == "split":
+            stack.extend((next_index, 0) for next_index in node[1])
+        elif node[0] == "space":
+            stack.append((node[1], 0))
+    return frozenset(closed)
+
+#############################################################
+# Helper 25: Advance tag grammar states over text (an empty #
+#            set means the text breaks the grammar)         #
+#############################################################
+def advance_tag_grammar(nodes, states, text):
+    for c in text:
+        next_states = []
+        for node_index, matched in states:
+            node = nodes[node_index]
+            kind = node[0]
+            if kind == "char":
+                if c == node[1]:
+                    next_states.append((node[2], 0))
+            elif kind == "space":
+                if c.isspace():
+                    next_states.append((node_index, 0))
+            elif kind == "content":
+                _, closing_tag, kmp_failure, next_index = node
+                while matched > 0 and closing_tag[matched] != c:
+                    matched = kmp_failure[matched - 1]
+                if closing_tag[matched] == c:
+                    matched += 1
+                if matched == len(closing_tag):
+                    next_states.append((next_index, 0))
+                else:
+                    next_states.append((node_index, matched))
+        if not next_states:
+            return frozenset()
+        states = close_tag_grammar_states(nodes, next_states)
+    return states
+
+##################################################################
+# Helper 26: Build a logits processor that only lets through     #
+#            tokens keeping the profile's tag grammar (after the #
+#            thinking block)                                     #
+##################################################################
+def build_grammar_logits_processor(cache_owner, tokenizer, model_path, prompt_length, batch_size, decoder_profile, enable_thinking, worker_name):
+    import torch
+    from itertools import islice
+    from collections import defaultdict
+    from transformers import LogitsProcessor
+    from config.decoder import USE_GRAMMAR_CONSTRAINED_DECODING, GRAMMAR_MAX_CANDIDATES, PROFILE_GRAMMARS
+
+    grammar = PROFILE_GRAMMARS.get(decoder_profile)
+    if not USE_GRAMMAR_CONSTRAINED_DECODING or grammar is None:
+        return None
+    think_closing_tag = "</think>"
+
+    # compiled grammars and decoded vocabularies (by token id, and by first character), built once per container
+    if not hasattr(cache_owner, "tag_grammars"):
+        cache_owner.tag_grammars = {}
+    if decoder_profile not in cache_owner.tag_grammars:
+        cache_owner.tag_grammars[decoder_profile] = compile_tag_grammar(grammar)
+    compiled_grammar = cache_owner.tag_grammars[decoder_profile]
+    nodes = compiled_grammar["nodes"]
+
+    if not hasattr(cache_owner, "grammar_vocabularies"):
+        cache_owner.grammar_vocabularies = {}
+    if model_path not in cache_owner.grammar_vocabularies:
+        special_ids = set(tokenizer.all_special_ids)
+        token_texts = [
+            None if token_id in special_ids else tokenizer.decode([token_id], clean_up_tokenization_spaces=False)
+            for token_id in range(len(tokenizer))
+        ]
+        token_ids_by_first_char = defaultdict(list)
+        for token_id, token_text in enumerate(token_texts):
+            if token_text:
+                token_ids_by_first_char[token_text[0]].append(token_id)
+        cache_owner.grammar_vocabularies[model_path] = (token_texts, token_ids_by_first_char)
+        print(f"{worker_name}: grammar vocabulary built ({len(token_texts)} tokens)")
+    token_texts, token_ids_by_first_char = cache_owner.grammar_vocabularies[model_path]
+    # special tokens (EOS, end of turn) end the output: only allowed once the grammar is complete
+    end_ids = set(tokenizer.all_special_ids)
+
+    def is_valid_token(states, token_id):
+        if token_id >= len(token_texts):
+            return False
+        token_text = token_texts[token_id]
+        if token_text is None:
+            return token_id in end_ids and any(nodes[node_index][0] == "end" for node_index, _ in states)
+        return bool(advance_tag_grammar(nodes, states, token_text))
+
+    class GrammarLogitsProcessor(LogitsProcessor):
+        def __init__(self):
+            self.rows = [self.new_row() for _ in range(batch_size)]
+            # per row: the generated ids fed so far, and the row's state at the start of the latest draft round (the
+            # ids rolled back by the next one extend it)
+            self.row_generated_ids = [[] for _ in range(batch_size)]
+            self.row_checkpoints = [self.new_row() for _ in range(batch_size)]
+
+        @staticmethod
+        def new_row():
+            return {
+                "in_answer": not enable_thinking,
+                "think_buffer": "",
+                "states": compiled_grammar["start"],
+                "consumed": 0,
+                "pending_ids": []
+            }
+
+        @staticmethod
+        def copy_row(row_state):
+            return {**row_state, "pending_ids": list(row_state["pending_ids"])}
+
+        def restore(self, row, generated_ids):
+            # the checkpoint if its ids are still a prefix of generated_ids, or the row's initial state
+            checkpoint = self.row_checkpoints[row]
+            consumed = checkpoint["consumed"]
+            if consumed > len(generated_ids) or self.row_generated_ids[row][:consumed] != generated_ids[:consumed]:
+                checkpoint = self.new_row()
+            self.rows[row] = self.copy_row(checkpoint)
+            return self.rows[row]
+
+        def feed(self, row, new_ids):
+            row_state = self.rows[row]
+            row_state["pending_ids"].extend(new_ids)
+            text_delta = tokenizer.decode(row_state["pending_ids"], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+            # a multi-byte character split across tokens decodes as U+FFFD until it is complete
+            if text_delta.endswith("\ufffd"):
+                return
+            row_state["pending_ids"] = []
+            if not row_state["in_answer"]:
+                buffer = row_state["think_buffer"] + text_delta
+                think_end = buffer.find(think_closing_tag)
+                if think_end == -1:
+                    row_state["think_buffer"] = buffer[-(len(think_closing_tag) - 1):]
+                    return
+                row_state["in_answer"] = True
+                text_delta = buffer[think_end + len(think_closing_tag):]
+            if row_state["states"]:
+                row_state["states"] = advance_tag_grammar(nodes, row_state["states"], text_delta)
+                if not row_state["states"]:
+                    print(f"{worker_name}: sequence {row} left the {decoder_profile} grammar (unconstrained from here)")
+
+        def __call__(self, input_ids, scores):
+            for row in range(input_ids.shape[0]):
+                row_state = self.rows[row]
+                generated_ids = input_ids[row, prompt_length:].tolist()
+                # generation rolled back (e.g., rejected draft tokens): restore the checkpoint, feed the ids after it
+                # and keep the result as the checkpoint of the new draft round
+                previous_ids = self.row_generated_ids[row]
+                rolled_back = previous_ids != generated_ids[:len(previous_ids)]
+                if rolled_back:
+                    row_state = self.restore(row, generated_ids)
+                new_ids = generated_ids[row_state["consumed"]:]
+                row_state["consumed"] = len(generated_ids)
+                if new_ids:
+                    self.feed(row, new_ids)
+                self.row_generated_ids[row] = generated_ids
+                if rolled_back:
+                    self.row_checkpoints[row] = self.copy_row(row_state)
+
+                # only constrain complete characters of the answer, while it follows the grammar
+                states = row_state["states"]
+                if not row_state["in_answer"] or row_state["pending_ids"] or not states:
+                    continue
+
+                # check the highest-scoring tokens first
+                candidate_ids = torch.topk(scores[row], min(GRAMMAR_MAX_CANDIDATES, scores.shape[-1])).indices.tolist()
+                valid_ids = [token_id for token_id in candidate_ids if is_valid_token(states, token_id)]
+
+                # none of them: look up tokens starting with a character the grammar accepts next
+                if not valid_ids:
+                    next_chars = set()
+                    for node_index, _ in states:
+                        node = nodes[node_index]
+                        if node[0] == "char":
+                            next_chars.add(node[1])
+                        elif node[0] == "space":
+                            next_chars.update(c for c in token_ids_by_first_char if c.isspace())
+                        elif node[0] == "content":
+                            next_chars.update(token_ids_by_first_char)
+                    # (the scan stops at GRAMMAR_MAX_CANDIDATES valid tokens)
+                    valid_ids = list(islice(
+                        (
+                            token_id
+                            for c in next_chars
+                            for token_id in token_ids_by_first_char.get(c, [])
+                            if is_valid_token(states, token_id)
+                        ),
+                        GRAMMAR_MAX_CANDIDATES
+                    ))
+                    valid_ids += [token_id for token_id in end_ids if is_valid_token(states, token_id)]
+                if not valid_ids:
+                    continue
+
+                mask = torch.full_like(scores[row], float("-inf"))
+                valid_ids = torch.tensor(valid_ids, device=scores.device)
+                mask[valid_ids] = scores[row, valid_ids]
+                scores[row] = mask
+            return scores
+
+    return GrammarLogitsProcessor()
+
+##############################################################
+# Helper 27: Get the response cache key of a request (model, #
+#            profile, templated prompt and sampling params)  #
+##############################################################
+def get_response_cache_key(model_path, decoder_profile, prompt_text, sampling_params):
+    # prompt_text: the prompt exactly as the decoder renders it (see render_decoder_prompt)
+    import json
+    import hashlib
+
+    key_payload = json.dumps([model_path, decoder_profile, prompt_text, sampling_params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key_payload.encode("utf-8")).hexdigest()
+
+###################################################
+# Helper 28: Read a response from the cache (None #
+#            if missing or expired)               #
+###################################################
+def read_response_cache(cache_path, cache_key, ttl_seconds):
+    import os
+    import json
+    import time
+
+    entry_path = os.path.join(cache_path, f"{cache_key}.json")
+    try:
+        if time.time() - os.path.getmtime(entry_path) > ttl_seconds:
+            return None
+        with open(entry_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+########################################
+# Helper 29: Write a response to cache #
+########################################
+def write_response_cache(cache_path, cache_key, output, prompt_text):
+    import os
+    import json
+
+    os.makedirs(cache_path, exist_ok=True)
+    entry_path = os.path.join(cache_path, f"{cache_key}.json")
+    # write to a temporary file first: a partial entry must never be read
+    temporary_path = f"{entry_path}.tmp"
+    try:
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump({"output": output, "prompt_text": prompt_text}, f, ensure_ascii=False)
+        os.replace(temporary_path, entry_path)
+        return True
+    except (OSError, TypeError, ValueError) as e:
+        print(f"write_response_cache: failed to write {entry_path}: {e}")
+        return False
+
+#################################################################
+# Helper 30: Evict expired, then oldest, response cache entries #
+#            (down to max size)                                 #
+#################################################################
+def evict_response_cache(cache_path, ttl_seconds, max_size_mb):
+    import os
+    import time
+
+    if not os.path.isdir(cache_path):
+        return 0
+    entries = []
+    for file_name in os.listdir(cache_path):
+        entry_path = os.path.join(cache_path, file_name)
+        try:
+            entries.append((os.path.getmtime(entry_path), os.path.getsize(entry_path), entry_path))
+        except OSError:
+            continue
+
+    now = time.time()
+    total_size = sum(size for _, size, _ in entries)
+    evicted = 0
+    # oldest first
+    for mtime, size, entry_path in sorted(entries):
+        if now - mtime <= ttl_seconds and total_size <= max_size_mb * 1024**2:
+            break
+        try:
+            os.remove(entry_path)
+            total_size -= size
+            evicted += 1
+        except OSError:
+            continue
+    return evicted
+
+###############################################################
+# Helper 31: Cap max_new_tokens to the context left after the #
+#            prompt (max_new_tokens None: all of it)          #
+###############################################################
+def cap_max_new_tokens(model, prompt_length, max_new_tokens, max_context_tokens=None):
+    # VLM configs keep the language model's limits in text_config
+    model_config = getattr(model.config, "text_config", model.config)
+    context_limits = [
+        limit for limit in [max_context_tokens, getattr(model_config, "max_position_embeddings", None)]
+        if limit
+    ]
+    if not context_limits:
+        return max_new_tokens
+    remaining_context_tokens = max(min(context_limits) - prompt_length, 0)
+    if max_new_tokens is None:
+        return remaining_context_tokens
+    return min(max_new_tokens, remaining_context_tokens)
+
+##################################################################
+# Helper 32: Build a logits processor that ends thinking (forces #
+#            THINKING_BUDGET_END_TEXT) once a row has used its   #
+#            thinking budget                                     #
+##################################################################
+def build_thinking_budget_logits_processor(tokenizer, prompt_length, batch_size, thinking_budget, enable_thinking, worker_name):
+    import torch
+    from transformers import LogitsProcessor
+    from config.decoder import THINKING_BUDGET_END_TEXT
+
+    if not enable_thinking or not thinking_budget:
+        return None
+    think_end_id = tokenizer.convert_tokens_to_ids("</think>")
+    forced_ids = tokenizer.encode(THINKING_BUDGET_END_TEXT, add_special_tokens=False)
+
+    class ThinkingBudgetLogitsProcessor(LogitsProcessor):
+        def __init__(self):
+            # generated tokens already checked for </think>, and whether it was generated
+            self.consumed = [0] * batch_size
+            self.think_ended = [False] * batch_size
+
+        def __call__(self, input_ids, scores):
+            for row in range(input_ids.shape[0]):
+                generated_length = input_ids.shape[1] - prompt_length
+                # generation rolled back (e.g., rejected draft tokens): check again from the start
+                if generated_length < self.consumed[row]:
+                    self.consumed[row], self.think_ended[row] = 0, False
+                if not self.think_ended[row]:
+                    new_ids = input_ids[row, prompt_length + self.consumed[row]:]
+                    self.think_ended[row] = bool((new_ids == think_end_id).any())
+                self.consumed[row] = generated_length
+                if self.think_ended[row]:
+                    continue
+
+                # over budget: force the transition to the answer, one token per step
+                forced_position = generated_length - thinking_budget
+                if 0 <= forced_position < len(forced_ids):
+                    if forced_position == 0:
+                        print(f"{worker_name}: sequence {row} reached its thinking budget ({thinking_budget} tokens)")
+                    forced_scores = torch.full_like(scores[row], float("-inf"))
+                    forced_scores[forced_ids[forced_position]] = 0.0
+                    scores[row] = forced_scores
+            return scores
+
+    return ThinkingBudgetLogitsProcessor()
+
+#############################################################
+# Helper 33: Count thinking and answer tokens per generated #
+#            sequence (up to its end of turn)               #
+#############################################################
+def count_thinking_and_answer_tokens(tokenizer, generated_ids, prompt_length, enable_thinking):
+    think_end_id = tokenizer.convert_tokens_to_ids("</think>")
+    end_ids = {token_id for token_id in [tokenizer.eos_token_id, tokenizer.pad_token_id] if token_id is not None}
+
+    token_counts = []
+    for row_ids in generated_ids:
+        row_ids = row_ids[prompt_length:].tolist()
+        # end of turn (or padding of a finished row in a batch)
+        end = next((i for i, token_id in enumerate(row_ids) if token_id in end_ids), len(row_ids))
+        row_ids = row_ids[:end]
+        thinking_tokens = 0
+        if enable_thinking:
+            # no </think>: all of it was thinking
+            thinking_tokens = row_ids.index(think_end_id) + 1 if think_end_id in row_ids else len(row_ids)
+        token_counts.append({
+            "thinking_tokens": thinking_tokens,
+            "answer_tokens": len(row_ids) - thinking_tokens
+        })
+    return token_counts
+
+###############################################################
+# Helper 34: Build the metrics of a decoder request (returned #
+#            with its output, see write_decoder_metrics)      #
+###############################################################
+def build_decoder_metrics(
+        worker_name,
+        decoder_profile,
+        model_path,
+        request_start_time,
+        input_tokens,
+        generation_stats=None,
+        row=0,
+        queue_ms=None,
+        cache_hits=None
+        ):
+    # request_start_time: time.perf_counter() when the request reached the worker
+    import time
+    from datetime import datetime, timezone
+
+    generation_stats = generation_stats or {}
+    token_counts = generation_stats.get("token_counts") or []
+    row_token_counts = token_counts[row] if row < len(token_counts) else {}
+    first_token_time = generation_stats.get("first_token_time")
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "worker": worker_name,
+        "decoder_profile": decoder_profile,
+        "model_path": model_path,
+        "input_tokens": input_tokens,
+        "thinking_tokens": row_token_counts.get("thinking_tokens"),
+        "output_tokens": row_token_counts.get("answer_tokens"),
+        # waiting for a container (set by the caller)
+        "queue_ms": queue_ms,
+        "prefill_ms": generation_stats.get("prefill_ms"),
+        "decode_ms": generation_stats.get("decode_ms"),
+        # from request_start_time (model loading and tokenization included)
+        "ttft_ms": (first_token_time - request_start_time) * 1000 if first_token_time else None,
+        "total_ms": (time.perf_counter() - request_start_time) * 1000,
+        "tokens_per_second": generation_stats.get("tokens_per_second"),
+        "draft_acceptance_rate": generation_stats.get("draft_acceptance_rate"),
+        "peak_gpu_memory_gb": generation_stats.get("peak_gpu_memory_gb"),
+        "cache_hits": {
+            "response": False,
+            "model": None,
+            "prefix_tokens": generation_stats.get("prefix_cache_tokens", 0),
+            **(cache_hits or {})
+        }
+    }
+
+##########################################################
+# Helper 35: Append decoder request metrics to the JSONL #
+#            log of a worker (one file per worker/day)   #
+##########################################################
+def write_decoder_metrics(metrics_path, worker_name, metrics_records):
+    import os
+    import json
+    from datetime import datetime, timezone
+
+    if not metrics_records:
+        return False
+    os.makedirs(metrics_path, exist_ok=True)
+    log_path = os.path.join(metrics_path, f"{worker_name}-{datetime.now(timezone.utc).strftime('%Y-%m-%d')}.jsonl")
+    try:
+        with open(log_path, "a", encoding="utf-8") as f:
+            for metrics in metrics_records:
+                f.write(json.dumps(metrics, ensure_ascii=False) + "\n")
+        return True
+    except (OSError, TypeError, ValueError) as e:
+        print(f"write_decoder_metrics: failed to write {log_path}: {e}")
+        return False
+
+#####################################################################
+# Helper 36: Add the caller's round trip to a decoder request's     #
+#            metrics (the rest of it is spent queued or in transit) #
+#####################################################################
+def record_decoder_round_trip(metrics, call_start_time):
+    # call_start_time: time.perf_counter() right before the caller sent the request
+    import time
+
+    if metrics is None:
+        return None
+    metrics["round_trip_ms"] = (time.perf_counter() - call_start_time) * 1000
+    if metrics.get("queue_ms") is None:
+        metrics["queue_ms"] = max(metrics["round_trip_ms"] - metrics["total_ms"], 0.0)
+    return metrics
+
+##################################################################
+# Helper 37: Tokenize rendered prompts (what apply_chat_template #
+#            does after rendering, for text models)              #
+##################################################################
+def tokenize_decoder_prompt(tokenizer, prompt_texts):
+    # prompt_texts: a rendered prompt or a list of them (left-padded batch), special tokens are already in the text
+    return tokenizer(
+        prompt_texts if isinstance(prompt_texts, list) else [prompt_texts],
+        add_special_tokens=False,
+        padding=True,
+        return_tensors="pt"
+    )
+
+#################################################################
+# Helper 38: Build decoder inputs from pre-tokenized prompt ids #
+#################################################################
+def build_decoder_inputs_from_ids(prompt_ids, pad_token_id=None):
+    # prompt_ids: a tokenized prompt or a list of them (left-padded batch with pad_token_id, as tokenize_decoder_prompt)
+    import torch
+    from transformers import BatchEncoding
+
+    batch_prompt_ids = prompt_ids if prompt_ids and isinstance(prompt_ids[0], list) else [prompt_ids]
+    prompt_length = max(len(ids) for ids in batch_prompt_ids)
+    padding_lengths = [prompt_length - len(ids) for ids in batch_prompt_ids]
+    if any(padding_lengths) and pad_token_id is None:
+        raise ValueError("build_decoder_inputs_from_ids: prompts of different lengths need a pad_token_id")
+    return BatchEncoding({
+        "input_ids": torch.tensor(
+            [[pad_token_id] * padding_length + list(ids) for ids, padding_length in zip(batch_prompt_ids, padding_lengths)],
+            dtype=torch.long
+        ),
+        "attention_mask": torch.tensor(
+            [[0] * padding_length + [1] * len(ids) for ids, padding_length in zip(batch_prompt_ids, padding_lengths)],
+            dtype=torch.long
+        )
+    })
+
+##################################################################
+# Helper 39: Render a text model prompt once for the caller, and #
+#            tokenize it (prompt_ids the decoder can take as is) #
+##################################################################
+def render_decoder_prompt(tokenizer, context, current_turn_input_text, system_prompt, enable_thinking):
+    # returns (prompt_text, prompt_ids): prompt_text keys the response cache, len(prompt_ids) is the prompt's size
+    messages = build_decoder_messages(context, current_turn_input_text, None, system_prompt, False)
+    prompt_text = apply_decoder_chat_template(tokenizer, messages, False, enable_thinking, tokenize=False)
+    prompt_ids = tokenizer.encode(prompt_text, add_special_tokens=False)
+    return prompt_text, prompt_ids
+
+##############################################################
+# Helper 40: Get the generate kwargs of a profile's KV cache #
+#            mode (None: full-precision DynamicCache)        #
+##############################################################
+def get_kv_cache_generate_kwargs(kv_cache_mode, worker_name):
+    from config.decoder import KV_CACHE_QUANTIZATION_CONFIG
+
+    if kv_cache_mode is None:
+        return {}
+    # keys and values stored in KV_CACHE_QUANTIZATION_CONFIG["nbits"] (but the latest tokens, kept in full precision)
+    elif kv_cache_mode == "quantized":
+        return {"cache_implementation": "quantized", "cache_config": dict(KV_CACHE_QUANTIZATION_CONFIG)}
+    # keys and values kept in CPU memory, each layer's prefetched to the GPU for its forward pass
+    elif kv_cache_mode == "offloaded":
+        return {"cache_implementation": "offloaded"}
+    print(f"{worker_name}: unknown kv_cache_mode '{kv_cache_mode}', using the default KV cache")
+    return {}
+
+###############################################################
+# Helper 41: Get the images of a conversation in prompt order #
+#            (context turns, then current turn)               #
+###############################################################
+def get_vlm_turn_images(context, current_turn_image_in_bytes):
+    images_in_bytes = [context_turn["input_image"] for context_turn in context if context_turn.get("input_image")]
+    if current_turn_image_in_bytes:
+        images_in_bytes.append(current_turn_image_in_bytes)
+    return images_in_bytes
+
+##################################################################
+# Helper 42: Preprocess images (pixel patches and grid), reusing #
+#            the cached ones by image hash and processing the    #
+#            rest in one image processor call                    #
+##################################################################
+def preprocess_vlm_images(cache_owner, processor, images_in_bytes, worker_name):
+    import io
+    import hashlib
+    from collections import OrderedDict
+    from PIL import Image
+    from config.decoder import VLM_IMAGE_CACHE_MAX_ENTRIES
+
+    # preprocessed images by (processor, image hash), LRU first (no cache_owner: this call only)
+    if cache_owner is None:
+        image_cache = OrderedDict()
+    else:
+        if not hasattr(cache_owner, "vlm_image_cache"):
+            cache_owner.vlm_image_cache = OrderedDict()
+        image_cache = cache_owner.vlm_image_cache
+    processor_key = processor.tokenizer.name_or_path
+    image_keys = [(processor_key, hashlib.sha256(image_in_bytes).hexdigest()) for image_in_bytes in images_in_bytes]
+
+    # decode and preprocess each missing image once (an image repeated across turns or prompts included)
+    missing_images = {}
+    for image_key, image_in_bytes in zip(image_keys, images_in_bytes):
+        if image_key in image_cache:
+            image_cache.move_to_end(image_key)
+        elif image_key not in missing_images:
+            missing_images[image_key] = Image.open(io.BytesIO(image_in_bytes)).convert("RGB")
+    if missing_images:
+        image_inputs = processor.image_processor(images=list(missing_images.values()), return_tensors="pt")
+        # pixel patches of all images are concatenated, each image has grid t * h * w of them
+        patch_start = 0
+        for image_key, image_grid_thw in zip(missing_images, image_inputs["image_grid_thw"]):
+            patch_count = int(image_grid_thw.prod())
+            image_cache[image_key] = {
+                "pixel_values": image_inputs["pixel_values"][patch_start:patch_start + patch_count],
+                "image_grid_thw": image_grid_thw
+            }
+            patch_start += patch_count
+    print(
+        f"{worker_name}: {len(images_in_bytes)} images, {len(images_in_bytes) - len(missing_images)} "
+        f"preprocessed images reused"
+    )
+
+    preprocessed_images = [image_cache[image_key] for image_key in image_keys]
+    while len(image_cache) > VLM_IMAGE_CACHE_MAX_ENTRIES:
+        image_cache.popitem(last=False)
+    return preprocessed_images
+
+##################################################################
+# Helper 43: Build VLM inputs from rendered prompts and their    #
+#            (cached) preprocessed images, as the processor does #
+##################################################################
+def build_vlm_inputs(cache_owner, processor, prompt_texts, prompts_images_in_bytes, worker_name):
+    # prompts_images_in_bytes: each prompt's images, in the order of its image placeholders
+    import torch
+    from transformers import BatchEncoding
+
+    # all images of all prompts preprocessed together
+    preprocessed_images = preprocess_vlm_images(
+        cache_owner,
+        processor,
+        [image_in_bytes for images_in_bytes in prompts_images_in_bytes for image_in_bytes in images_in_bytes],
+        worker_name
+    )
+
+    # expand each image placeholder into one token per merged patch group
+    image_token = processor.image_token
+    merge_length = processor.image_processor.merge_size ** 2
+    expanded_prompt_texts = []
+    image_index = 0
+    for prompt_text, images_in_bytes in zip(prompt_texts, prompts_images_in_bytes):
+        prompt_parts = prompt_text.split(image_token)
+        if len(prompt_parts) - 1 != len(images_in_bytes):
+            raise ValueError(
+                f"{worker_name}: prompt has {len(prompt_parts) - 1} image placeholders but {len(images_in_bytes)} images"
+            )
+        expanded_prompt_text = prompt_parts[0]
+        for prompt_part in prompt_parts[1:]:
+            image_token_count = int(preprocessed_images[image_index]["image_grid_thw"].prod()) // merge_length
+            expanded_prompt_text += image_token * image_token_count + prompt_part
+            image_index += 1
+        expanded_prompt_texts.append(expanded_prompt_text)
+
+    inputs = tokenize_decoder_prompt(processor.tokenizer, expanded_prompt_texts)
+    if preprocessed_images:
+        return BatchEncoding({
+            **inputs,
+            "pixel_values": torch.cat([image["pixel_values"] for image in preprocessed_images]),
+            "image_grid_thw": torch.stack([image["image_grid_thw"] for image in preprocessed_images])
+        })
+    return inputs
+
+# compiled tag scanner patterns by tag pairs (built once per process)
+compiled_tag_scanners = {}
+
+##################################################################
+# Helper 44: Scan a response once for known tags (returns a tree #
+#            of {"tag", "content", "children"} nodes)            #
+##################################################################
+def scan_tags(response, tag_pairs):
+    import re
+
+    # tag_pairs: (opening_tag, closing_tag) pairs, a single alternation over all tags matches any of them
+    tag_pairs = tuple(tag_pairs)
+    if tag_pairs not in compiled_tag_scanners:
+        tags = sorted({tag for tag_pair in tag_pairs for tag in tag_pair}, key=len, reverse=True)
+        compiled_tag_scanners[tag_pairs] = re.compile("|".join(re.escape(tag) for tag in tags))
+    tag_pattern = compiled_tag_scanners[tag_pairs]
+    closing_to_opening_tags = {closing_tag: opening_tag for opening_tag, closing_tag in tag_pairs}
+    opening_tags = set(closing_to_opening_tags.values())
+
+    # open tags stack, the root collects top-level nodes
+    root = {"tag": None, "children": []}
+    stack = [(root, 0)]
+    for tag_match in tag_pattern.finditer(response):
+        tag = tag_match.group()
+        if tag in opening_tags:
+            stack.append(({"tag": tag, "children": []}, tag_match.end()))
+            continue
+        opening_tag = closing_to_opening_tags[tag]
+        # a closing tag without an open opening tag is ignored
+        if not any(node["tag"] == opening_tag for node, _ in stack[1:]):
+            continue
+        # unclosed tags inside it are dropped, their closed tags move up to their parent
+        while stack[-1][0]["tag"] != opening_tag:
+            unclosed_node, _ = stack.pop()
+            stack[-1][0]["children"].extend(unclosed_node["children"])
+        node, content_start = stack.pop()
+        node["content"] = response[content_start:tag_match.start()].strip()
+        stack[-1][0]["children"].append(node)
+
+    # tags still open at the end of the response are dropped the same way
+    while len(stack) > 1:
+        unclosed_node, _ = stack.pop()
+        stack[-1][0]["children"].extend(unclosed_node["children"])
+    return root["children"]
+
+################################################################
+# Helper 45: Find the nodes of a tag in a scanned tag tree (in #
+#            document order, outer ones before nested ones)    #
+################################################################
+def find_tag_nodes(tag_nodes, opening_tag, direct_children_only=False):
+    # direct_children_only: only tag_nodes themselves, not their descendants (e.g., a thread's own messages,
+    # not a <message> quoted inside one of their bodies)
+    found_nodes = []
+    for tag_node in tag_nodes:
+        if tag_node["tag"] == opening_tag:
+            found_nodes.append(tag_node)
+        if not direct_children_only:
+            found_nodes.extend(find_tag_nodes(tag_node["children"], opening_tag))
+    return found_nodes
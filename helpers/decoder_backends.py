@@ -0,0 +1,379 @@
+from abc import ABC, abstractmethod
+
+#########################################################################
+# Helper 1: Render a deterministic sample of a tag grammar (see         #
+#           PROFILE_GRAMMARS): first choice, one repetition, field_text #
+#########################################################################
+def render_tag_grammar_sample(node, field_text):
+    kind = node[0]
+    if kind == "field":
+        _, opening_tag, closing_tag = node
+        return f"{opening_tag}{field_text(opening_tag[1:-1])}{closing_tag}"
+    elif kind == "block":
+        _, opening_tag, closing_tag, inner_node = node
+        return f"{opening_tag}\n{render_tag_grammar_sample(inner_node, field_text)}\n{closing_tag}"
+    elif kind == "sequence":
+        return "\n".join(render_tag_grammar_sample(child, field_text) for child in node[1])
+    elif kind == "choice":
+        return render_tag_grammar_sample(node[1][0], field_text)
+    elif kind == "repeat":
+        return render_tag_grammar_sample(node[1], field_text)
+    raise ValueError(f"unknown tag grammar node kind '{kind}'")
+
+#####################################################################
+# Base decoder backend: run_qwen3_lm_or_vlm's call shape, returning #
+# (output, prompt_text, metrics), and its streaming events          #
+#####################################################################
+class DecoderBackend(ABC):
+    name = None
+    # outputs are stored in (and read from) the response cache, which is keyed by the profile's model_path
+    use_response_cache = False
+
+    @abstractmethod
+    def generate(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        # returns (output, prompt_text, metrics), output extracted for decoder_profile (None on failure)
+        pass
+
+    async def generate_aio(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        import asyncio
+
+        return await asyncio.to_thread(
+            self.generate,
+            context,
+            current_turn_input_text,
+            current_turn_image_in_bytes,
+            decoder_profile,
+            **model_config
+        )
+
+    def generate_batch(
+            self,
+            context,
+            current_turn_input_texts,
+            current_turn_images_in_bytes,
+            decoder_profile,
+            prompt_ids=None,
+            **model_config
+            ):
+        # run_qwen3_lm_or_vlm_batch's call shape (prompts sharing context and profile, optional per-prompt prompt_ids),
+        # returns one (output, prompt_text, metrics) per prompt; here one generate per prompt, a failed one does not
+        # fail the rest
+        if current_turn_images_in_bytes is None:
+            current_turn_images_in_bytes = [None] * len(current_turn_input_texts)
+        if prompt_ids is None:
+            prompt_ids = [None] * len(current_turn_input_texts)
+        results = []
+        for current_turn_input_text, current_turn_image_in_bytes, current_turn_prompt_ids in zip(
+                current_turn_input_texts,
+                current_turn_images_in_bytes,
+                prompt_ids
+                ):
+            try:
+                results.append(self.generate(
+                    context,
+                    current_turn_input_text,
+                    current_turn_image_in_bytes,
+                    decoder_profile,
+                    **model_config,
+                    prompt_ids=current_turn_prompt_ids
+                ))
+            except Exception as e:
+                print(f"{self.name}_decoder_backend: generation failed: {e}")
+                results.append((None, None, None))
+        return results
+
+    @abstractmethod
+    async def stream_aio(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        # yields the events of run_qwen3_lm_or_vlm_stream, the last one {"type": "result", ...}
+        yield
+
+#########################################################################
+# Text decoder backend: a backend on top of a raw text generator (whose #
+# output is extracted per profile, and streamed word by word)           #
+#########################################################################
+class TextDecoderBackend(DecoderBackend):
+    @abstractmethod
+    def generate_text(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        # returns (output_text, prompt_text, metrics) before profile extraction, output_text None on failure
+        pass
+
+    def generate(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        from helpers.decoder import extract_decoder_profile_content
+
+        output_text, prompt_text, metrics = self.generate_text(
+            context,
+            current_turn_input_text,
+            current_turn_image_in_bytes,
+            decoder_profile,
+            **model_config
+        )
+        if output_text is None:
+            return (None, prompt_text, metrics)
+        output = extract_decoder_profile_content(
+            output_text,
+            decoder_profile,
+            model_config.get("enable_thinking", False),
+            worker_name=f"{self.name}_decoder_backend"
+        )
+        return (output, prompt_text, metrics)
+
+    async def stream_aio(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        # same events as run_qwen3_lm_or_vlm_stream, replayed word by word from the generated text
+        import re
+        import asyncio
+        from config.decoder import PROFILE_STOP_TAGS, PROFILE_FIELD_TAGS
+        from helpers.decoder import extract_decoder_profile_content, create_tag_stream_state, feed_tag_stream
+
+        enable_thinking = model_config.get("enable_thinking", False)
+        output_text, prompt_text, metrics = await asyncio.to_thread(
+            self.generate_text,
+            context,
+            current_turn_input_text,
+            current_turn_image_in_bytes,
+            decoder_profile,
+            **model_config
+        )
+        if output_text is None:
+            yield {"type": "result", "output": None, "prompt_text": prompt_text, "metrics": metrics}
+            return
+
+        tag_stream_state = create_tag_stream_state(
+            PROFILE_FIELD_TAGS.get(decoder_profile, []),
+            PROFILE_STOP_TAGS.get(decoder_profile, []),
+            enable_thinking
+        )
+        for text_delta in re.findall(r"\S+\s*|\s+", output_text):
+            yield {"type": "delta", "text": text_delta}
+            for field_name, field_content in feed_tag_stream(tag_stream_state, text_delta):
+                yield {"type": "field", "name": field_name, "content": field_content}
+
+        output = extract_decoder_profile_content(
+            output_text,
+            decoder_profile,
+            enable_thinking,
+            worker_name=f"{self.name}_decoder_backend"
+        )
+        yield {"type": "result", "output": output, "prompt_text": prompt_text, "metrics": metrics}
+
+#################################################################
+# Modal decoder backend: the deployed Qwen3Decoder (transformers #
+# on GPU)                                                        #
+#################################################################
+class ModalDecoderBackend(DecoderBackend):
+    name = "modal"
+    use_response_cache = True
+
+    def __init__(self):
+        import modal
+
+        # raises if the decoder app is not deployed
+        self.decoder = modal.Cls.from_name("decoder", "Qwen3Decoder")()
+
+    def generate(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        return self.decoder.run_qwen3_lm_or_vlm.remote(
+            context=context,
+            current_turn_input_text=current_turn_input_text,
+            current_turn_image_in_bytes=current_turn_image_in_bytes,
+            **model_config,
+            decoder_profile=decoder_profile
+        )
+
+    def generate_batch(
+            self,
+            context,
+            current_turn_input_texts,
+            current_turn_images_in_bytes,
+            decoder_profile,
+            prompt_ids=None,
+            **model_config
+            ):
+        # one request (one container), micro-batched there by run_qwen3_lm_or_vlm_batch
+        return self.decoder.run_qwen3_lm_or_vlm_batch.remote(
+            context=context,
+            current_turn_input_texts=current_turn_input_texts,
+            current_turn_images_in_bytes=current_turn_images_in_bytes,
+            **model_config,
+            decoder_profile=decoder_profile,
+            prompt_ids=prompt_ids
+        )
+
+    async def generate_aio(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        return await self.decoder.run_qwen3_lm_or_vlm.remote.aio(
+            context=context,
+            current_turn_input_text=current_turn_input_text,
+            current_turn_image_in_bytes=current_turn_image_in_bytes,
+            **model_config,
+            decoder_profile=decoder_profile
+        )
+
+    async def stream_aio(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        async for event in self.decoder.run_qwen3_lm_or_vlm_stream.remote_gen.aio(
+            context=context,
+            current_turn_input_text=current_turn_input_text,
+            current_turn_image_in_bytes=current_turn_image_in_bytes,
+            **model_config,
+            decoder_profile=decoder_profile
+        ):
+            yield event
+
+#######################################################################
+# Local decoder backend: a tiny text model (LOCAL_DECODER_MODEL_PATH) #
+# in-process on CPU, through the same generation helpers              #
+#######################################################################
+class LocalDecoderBackend(TextDecoderBackend):
+    name = "local"
+
+    def __init__(self, model_path=None, max_new_tokens=None):
+        from config.decoder import LOCAL_DECODER_MODEL_PATH, LOCAL_DECODER_MAX_NEW_TOKENS
+
+        self.model_path = model_path or LOCAL_DECODER_MODEL_PATH
+        self.max_new_tokens = max_new_tokens or LOCAL_DECODER_MAX_NEW_TOKENS
+        self.model, self.processor = None, None
+
+    def generate_text(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        import time
+        from helpers.decoder import (
+            load_decoder_model,
+            prepare_decoder_inputs,
+            cap_max_new_tokens,
+            generate_decoder_ids,
+            build_decoder_metrics
+        )
+
+        worker_name = "local_decoder_backend"
+        request_start_time = time.perf_counter()
+        if model_config.get("is_vision_model") or current_turn_image_in_bytes is not None:
+            print(f"{worker_name}: vision profiles are not supported by the local backend")
+            return (None, None, None)
+        cache_hits = {"model": self.model is not None}
+        if self.model is None:
+            self.model, self.processor = load_decoder_model(
+                self.model_path,
+                is_vision_model=False,
+                is_lora_adapter=False,
+                use_flash_attention_2=False,
+                worker_name=worker_name
+            )
+
+        enable_thinking = model_config.get("enable_thinking", False)
+        inputs, prompt_text = prepare_decoder_inputs(
+            self.model,
+            self.processor,
+            context,
+            current_turn_input_text,
+            None,
+            model_config.get("system_prompt"),
+            False,
+            enable_thinking,
+            model_config.get("return_prompt_text", False),
+            prompt_ids=model_config.get("prompt_ids")
+        )
+        # the profile's budgets are sized for the GPU model, keep CPU runs short
+        prompt_length = inputs.input_ids.shape[1]
+        max_new_tokens = cap_max_new_tokens(
+            self.model,
+            prompt_length,
+            min(model_config.get("max_new_tokens") or self.max_new_tokens, self.max_new_tokens),
+            model_config.get("max_context_tokens")
+        )
+        if not max_new_tokens:
+            print(f"{worker_name}: rejected request ({prompt_length} prompt tokens, no context left)")
+            metrics = build_decoder_metrics(
+                worker_name,
+                decoder_profile,
+                self.model_path,
+                request_start_time,
+                prompt_length,
+                cache_hits=cache_hits
+            )
+            return (None, prompt_text, metrics)
+        thinking_budget = model_config.get("thinking_budget")
+        if enable_thinking:
+            thinking_budget = min(thinking_budget or max_new_tokens, max_new_tokens // 2)
+
+        generation_stats = {}
+        generated_ids = generate_decoder_ids(
+            self,
+            self.model,
+            self.processor,
+            inputs,
+            self.model_path,
+            False,
+            decoder_profile,
+            enable_thinking,
+            max_new_tokens,
+            model_config.get("temperature"),
+            model_config.get("top_p"),
+            model_config.get("top_k"),
+            worker_name=worker_name,
+            thinking_budget=thinking_budget,
+            generation_stats=generation_stats,
+            kv_cache_mode=model_config.get("kv_cache_mode")
+        )
+        output_text = self.processor.batch_decode(
+            [generated_ids[0][prompt_length:]],
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False
+        )[0]
+        metrics = build_decoder_metrics(
+            worker_name,
+            decoder_profile,
+            self.model_path,
+            request_start_time,
+            prompt_length,
+            generation_stats=generation_stats,
+            cache_hits=cache_hits
+        )
+        return (output_text, prompt_text, metrics)
+
+################################################################
+# Fake decoder backend: no model, a deterministic (per prompt) #
+# well-formed sample of the profile's tag grammar              #
+################################################################
+class FakeDecoderBackend(TextDecoderBackend):
+    name = "fake"
+
+    def generate_text(self, context, current_turn_input_text, current_turn_image_in_bytes, decoder_profile, **model_config):
+        import time
+        import hashlib
+        from config.decoder import PROFILE_GRAMMARS
+        from helpers.decoder import build_decoder_metrics
+
+        request_start_time = time.perf_counter()
+        grammar = PROFILE_GRAMMARS.get(decoder_profile)
+        if grammar is None:
+            print(f"fake_decoder_backend: no tag grammar for decoder_profile '{decoder_profile}'")
+            return (None, None, None)
+
+        prompt_text = None
+        if model_config.get("return_prompt_text", False):
+            prompt_text = f"{model_config.get('system_prompt') or ''}\n\n{current_turn_input_text}"
+        prompt_digest = hashlib.sha256((current_turn_input_text or "").encode("utf-8")).hexdigest()[:12]
+        output_text = render_tag_grammar_sample(grammar, lambda field_name: f"fake {field_name} {prompt_digest}")
+        # exercise the <think>...</think> removal
+        if model_config.get("enable_thinking", False):
+            output_text = f"<think>\nfake reasoning {prompt_digest}\n</think>\n\n{output_text}"
+        # there is no tokenizer: word counts instead of token counts (token fields left None)
+        metrics = build_decoder_metrics(
+            "fake_decoder_backend",
+            decoder_profile,
+            None,
+            request_start_time,
+            None
+        )
+        metrics["input_words"] = len((current_turn_input_text or "").split())
+        metrics["output_words"] = len(output_text.split())
+        return (output_text, prompt_text, metrics)
+
+#############################################################
+# Helper 2: Get the decoder backend named backend_name (see #
+#           DECODER_BACKEND)                                #
+#############################################################
+def get_decoder_backend(backend_name):
+    if backend_name == "modal":
+        return ModalDecoderBackend()
+    elif backend_name == "local":
+        return LocalDecoderBackend()
+    elif backend_name == "fake":
+        return FakeDecoderBackend()
+    raise ValueError(f"unknown decoder backend '{backend_name}' (expected 'modal', 'local' or 'fake')")
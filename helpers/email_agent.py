@@ -61,15 +61,17 @@ def compact_email_body_for_decoder(
         missing_body_placeholder,
         unquoted_fail_placeholder=None,
         quoted_fail_placeholder=None,
-        log_prefix=""
+        log_prefix="",
+        unquoted_and_quoted_body=None
         ):
+    # unquoted_and_quoted_body: body's get_unquoted_text split if already known (e.g., mirrored emails)
     from helpers.data import get_unquoted_text
     from helpers.decoder import truncate_to_tokens
 
     if not body:
-        body = missing_body_placeholder
+        body, unquoted_and_quoted_body = missing_body_placeholder, None
 
-    unquoted_body, quoted_body = get_unquoted_text(body, return_quoted=True)
+    unquoted_body, quoted_body = unquoted_and_quoted_body or get_unquoted_text(body, return_quoted=True)
     if unquoted_body:
         if max_unquoted_tokens >= 0:
             unquoted_body = truncate_to_tokens(tokenizer, unquoted_body, max_unquoted_tokens)
@@ -95,131 +97,74 @@ def compact_email_body_for_decoder(
 # Helper 6: Read latest emails #
 ################################
 def read_latest_emails(
+        imap_session,
+        mailbox_mirror,
         max_emails,
         folder,
         last_n_days,
-        imap_email,
-        password,
         unread_only,
-        imap_server,
-        imap_port,
         blacklisted_emails,
         blacklisted_domains
         ):
+    # reads from the folder's mailbox mirror (see sync_mailbox_mirror), only unread flags come from the server
     from config.email_agent import INBOX_FOLDER, SENT_FOLDER
-    # https://docs.python.org/3/library/imaplib.html
-    import email
-    from imaplib import IMAP4_SSL
-    from email.utils import parseaddr, parsedate_to_datetime
     from datetime import datetime, timedelta, timezone
     
     try:
-        # getting a hold of the imap server with context manager:
-        with IMAP4_SSL(imap_server, imap_port) as imap:
-            # log in
-            imap.login(imap_email, password)
-
-            # select folder
-            imap.select(folder)
-
-            # search for either unseen or seen and unseen emails
-            use_unread_filter = unread_only and folder == INBOX_FOLDER
-            search_criteria = "(UNSEEN)" if use_unread_filter else "ALL"
-
-            # get all messages that fit the (above) criteria
-            retcode, messages = imap.search(None, search_criteria)
-
-            # get message ids
-            email_ids = messages[0].split()
-
-            # set up a list to hold ids, senders, dates and bodies
-            emails_contents = []
-
-            # calculate cutoff date
-            cutoff_date = datetime.now(timezone.utc) - timedelta(days=last_n_days)
-
-            # from latest to the oldest id:
-            for email_id in reversed(email_ids):
-                body = ""
-                ignore_message = False
-                try:
-                    # BODY.PEEK[] keeps emails unread while they are being processed
-                    fetch_command = "(BODY.PEEK[])"
-
-                    # get message data
-                    status, message_data = imap.fetch(email_id, fetch_command)
-                    message = email.message_from_bytes(message_data[0][1])
-
-                    # compare dates
-                    try:
-                        email_date = message.get("Date", "")
-                        parsed_date = parsedate_to_datetime(email_date)
-                        if parsed_date.tzinfo is None:
-                            parsed_date = parsed_date.replace(tzinfo=timezone.utc)
-                        if parsed_date < cutoff_date:
-                            print(f"read_latest_emails: email date {email_date} is older than {last_n_days} days: stopping")
-                            break
-                        email_date = parsed_date # use parsed date only if parsing succeeds
-                    except Exception as e:
-                        print(f"read_latest_emails: warning: could not parse date '{email_date}' for email {email_id}: {e}")
-                    
-                    # get sender
-                    raw_from = decode_email_header(message.get("From", ""))
-                    _, from_ = parseaddr(raw_from)
-                    # get recipients
-                    to_ = decode_email_header(message.get("To", ""))
-
-                    # ignore if sender is blacklisted (skip for sent folder)
-                    if folder != SENT_FOLDER and is_blacklisted(from_, blacklisted_emails, blacklisted_domains):
-                        print(f"read_latest_emails: email '{from_}' is blacklisted: skipping")
-                        continue
-
-                    # get subject
-                    subject = decode_email_header(message.get("Subject", ""))
-
-                    # get message
-                    if message.is_multipart():
-                        # walking if multipart (e.g., HTML, attachments, plain text) to find plain text
-                        for part in message.walk():
-
-                            # ignoring the full message if attachments are present
-                            content_disposition = str(part.get("Content-Disposition"))
-                            if "attachment" in content_disposition:
-                                ignore_message = True
-                            
-                            # and using the plain text when reached (discarding other parts)
-                            if not ignore_message and part.get_content_type() == "text/plain":
-                                try:
-                                    payload = part.get_payload(decode=True)
-                                    charset = part.get_content_charset()
-                                    body = payload.decode(charset or "utf-8")
-                                except Exception as e:
-                                    print(f"read_latest_emails: error extracting body: {e}")
-                    
-                    # or decoding content if it is plain text
-                    else:
-                        try:
-                            payload = message.get_payload(decode=True)
-                            charset = message.get_content_charset()
-                            body = payload.decode(charset or "utf-8")
-                        except Exception as e:
-                            print(f"read_latest_emails: error extracting body: {e}")
-
-                    # append email id, sender, date, subject and message body
-                    if not ignore_message:
-                        emails_contents.append({"id": email_id, "from": from_, "to": to_, "date": email_date, "subject": subject, "message_body": body})
-                        if len(emails_contents) == 1:
-                            print(f"read_latest_emails: sample email format: {emails_contents[0]}")
-                    ignore_message = False
-                    
-                    # break upon reaching max_emails
-                    if len(emails_contents) >= max_emails:
-                        break
-
-                except Exception as e:
-                    ignore_message = False
-                    print(f"read_latest_emails: error processing email {email_id}: {e}")
-                    continue
+        # calculate cutoff date
+        cutoff_date = datetime.now(timezone.utc) - timedelta(days=last_n_days)
+
+        # search for unseen emails (flags change between runs, so they are not mirrored)
+        unread_uids = None
+        if unread_only and folder == INBOX_FOLDER:
+            status, _ = imap_session.select(folder)
+            if status != "OK":
+                print(f"read_latest_emails: could not select folder '{folder}' ({status})")
+                return []
+            unread_uids = set(imap_session.search_uids("UNSEEN", "SINCE", cutoff_date.strftime("%d-%b-%Y")) or [])
+
+        # set up a list to hold ids, senders, dates and bodies
+        emails_contents = []
+
+        # from latest to the oldest UID:
+        for uid in sorted(mailbox_mirror["messages"], key=int, reverse=True):
+            mirrored_message = mailbox_mirror["messages"][uid]
+            if unread_uids is not None and int(uid) not in unread_uids:
+                continue
+
+            # ignoring the full message if attachments are present
+            if mirrored_message["has_attachment"]:
+                continue
+
+            # compare dates
+            email_date = get_mirrored_message_date(mirrored_message)
+            if isinstance(email_date, datetime) and email_date < cutoff_date:
+                continue
+
+            # ignore if sender is blacklisted (skip for sent folder)
+            from_ = mirrored_message["from"]
+            if folder != SENT_FOLDER and is_blacklisted(from_, blacklisted_emails, blacklisted_domains):
+                print(f"read_latest_emails: email '{from_}' is blacklisted: skipping")
+                continue
+
+            # append email id (UID) and folder, sender, date, subject and message body (and its unquoted/quoted split)
+            emails_contents.append({
+                "id": uid,
+                "folder": folder,
+                "from": from_,
+                "to": mirrored_message["to"],
+                "date": email_date,
+                "subject": mirrored_message["subject"],
+                "message_body": mirrored_message["message_body"],
+                "unquoted_body": mirrored_message["unquoted_body"],
+                "quoted_body": mirrored_message["quoted_body"]
+            })
+            if len(emails_contents) == 1:
+                print(f"read_latest_emails: sample email format: {emails_contents[0]}")
+
+            # break upon reaching max_emails
+            if len(emails_contents) >= max_emails:
+                break
 
         # return email contents
         return emails_contents
@@ -232,60 +177,57 @@ def read_latest_emails(
 # Helper 7: Save drafts #
 #########################
 def save_drafts(
+        imap_session,
         reply_bodies,
         original_subjects,
-        imap_email,
         smtp_email,
         recipient_emails,
-        password,
-        imap_server,
-        imap_port,
         drafts_folder
         ):
     # docs.python.org/3/library/smtplib.html
     # https://docs.python.org/3/library/imaplib.html
     import time
     import imaplib
-    from imaplib import IMAP4_SSL
     from email.utils import formatdate
     from email.mime.text import MIMEText
     from email.mime.multipart import MIMEMultipart
 
     try:
-        # getting a hold of the imap server with context manager:
-        with IMAP4_SSL(imap_server, imap_port) as imap:
-            # log in
-            imap.login(imap_email, password)
-
-            # for each email to save a draft for:
-            for i in range(len(original_subjects)):
-                # get reply body, subject, recipient email
-                reply_body = reply_bodies[i]
-                original_subject = original_subjects[i]
-                recipient_email = recipient_emails[i]
-
-                # create message container
-                message = MIMEMultipart()
-                message["From"] = smtp_email
-                message["To"] = recipient_email
-                message["Subject"] = f"Re: {original_subject}"
-                message["Date"] = formatdate(localtime=True)
-
-                # attach body
-                message.attach(MIMEText(reply_body, "plain", "utf-8"))
-
-                # select folder
-                status, _ = imap.select(drafts_folder)
-                if status != "OK":
-                    available = imap.list()[1]
-                    return False, f"save_drafts: folder '{drafts_folder}' not found. Server lists: {available}"
-
-                # save
-                imap.append(drafts_folder, "\\Draft", imaplib.Time2Internaldate(time.time()), message.as_bytes())
-
-                # courtesy wait
-                time.sleep(1)
-
+        # check the drafts folder once (on the run's IMAP session, see ImapSession)
+        if original_subjects:
+            status, _ = imap_session.select(drafts_folder)
+            if status != "OK":
+                available = imap_session.command("list")[1]
+                return False, f"save_drafts: folder '{drafts_folder}' not found. Server lists: {available}"
+
+        # for each email to save a draft for (a failed one does not stop the rest):
+        failed_drafts = []
+        for i in range(len(original_subjects)):
+            # get reply body, subject, recipient email
+            reply_body = reply_bodies[i]
+            original_subject = original_subjects[i]
+            recipient_email = recipient_emails[i]
+
+            # create message container
+            message = MIMEMultipart()
+            message["From"] = smtp_email
+            message["To"] = recipient_email
+            message["Subject"] = f"Re: {original_subject}"
+            message["Date"] = formatdate(localtime=True)
+
+            # attach body
+            message.attach(MIMEText(reply_body, "plain", "utf-8"))
+
+            # save (an APPEND is not retried if the connection drops: the draft may already be stored)
+            status, data = imap_session.command("append", drafts_folder, "\\Draft", imaplib.Time2Internaldate(time.time()), message.as_bytes())
+            if status != "OK":
+                failed_drafts.append(f"'Re: {original_subject}' to {recipient_email} ({status}: {data})")
+
+            # courtesy wait
+            time.sleep(1)
+
+        if failed_drafts:
+            return False, f"save_drafts: {len(failed_drafts)} drafts may not have been saved: {'; '.join(failed_drafts)}"
         return True, ""
     
     except Exception as e:
@@ -352,29 +294,391 @@ def send_emails(
 # Helper 9: Mark emails as read #
 #################################
 def mark_emails_as_read(
+        imap_session,
         email_ids,
-        imap_email,
-        password,
-        imap_server,
-        imap_port
+        inbox_folder
         ):
     # https://docs.python.org/3/library/imaplib.html
-    from imaplib import IMAP4_SSL
+    from helpers.imap_session import build_sequence_set
 
     try:
-        # getting a hold of the imap server with context manager:
-        with IMAP4_SSL(imap_server, imap_port) as imap:
-            # log in
-            imap.login(imap_email, password)
+        # select inbox (on the run's IMAP session, see ImapSession)
+        status, _ = imap_session.select(inbox_folder)
+        if status != "OK":
+            return False, f"mark_emails_as_read: could not select folder '{inbox_folder}'"
 
-            # select inbox
-            imap.select("INBOX")
-
-            # for each processed email, add Seen flag
-            for email_id in email_ids:
-                imap.store(email_id, "+FLAGS", "\\Seen")
+        # add Seen flag to all processed emails (UIDs) at once
+        status, _ = imap_session.command("uid", "STORE", build_sequence_set(email_ids), "+FLAGS", "\\Seen")
+        if status != "OK":
+            return False, f"mark_emails_as_read: UID STORE failed ({status})"
 
         return True, ""
 
     except Exception as e:
         return False, str(e)
+
+#########################################################################
+# Helper 10: Get a context email's thread context block and its tokens  #
+#            (built and tokenized once per email and truncation limits) #
+#########################################################################
+def get_context_email_block(tokenizer, context_email, max_unquoted_tokens, max_quoted_tokens, block_cache):
+    # IMAP ids are per-folder UIDs
+    cache_key = (
+        context_email.get("folder"),
+        context_email.get("id"),
+        max_unquoted_tokens,
+        max_quoted_tokens
+    )
+    if cache_key in block_cache:
+        return block_cache[cache_key]
+
+    context_email_body = compact_email_body_for_decoder(
+        tokenizer,
+        context_email.get("message_body"),
+        max_unquoted_tokens,
+        max_quoted_tokens,
+        "[text omitted: body missing]",
+        unquoted_fail_placeholder="[text omitted: tokenization failed]",
+        quoted_fail_placeholder="[quoted text omitted: tokenization failed]",
+        log_prefix="get_context_email_block: context email",
+        unquoted_and_quoted_body=(
+            (context_email["unquoted_body"], context_email["quoted_body"]) if "quoted_body" in context_email else None
+        )
+    )
+    context_email_date = context_email.get("date")
+    block_header = (
+        "From: " + (context_email.get("from") or "").strip() + "\n"
+        "To: " + (context_email.get("to") or "").strip() + "\n"
+        "Date: " + (str(context_email_date) if context_email_date else "") + "\n"
+        "Subject: " + (context_email.get("subject") or "").strip() + "\n"
+        "Body:\n"
+    )
+    block_text = f"{block_header}{context_email_body}\n[END MESSAGE]\n".strip()
+    try:
+        block_token_ids = tokenizer.encode(block_text, add_special_tokens=False)
+    except Exception as e:
+        print(f"get_context_email_block: error encoding block: {e}")
+        block_token_ids = []
+
+    block_cache[cache_key] = {"text": block_text, "token_ids": block_token_ids}
+    return block_cache[cache_key]
+
+#############################################################
+# Helper 11: Decode a fetched text part (transfer encoding, #
+#            then charset)                                  #
+#############################################################
+def decode_text_part(payload, transfer_encoding, charset):
+    import quopri
+    import base64
+
+    if transfer_encoding == "BASE64":
+        payload = base64.b64decode(payload)
+    elif transfer_encoding == "QUOTED-PRINTABLE":
+        payload = quopri.decodestring(payload)
+    return payload.decode(charset or "utf-8")
+
+############################################################
+# Helper 12: Extract the plain text body of a full message #
+#            (None if attachments are present)             #
+############################################################
+def extract_plain_text_body(message):
+    body = ""
+    if message.is_multipart():
+        # walking if multipart (e.g., HTML, attachments, plain text) to find plain text
+        for part in message.walk():
+            # ignoring the full message if attachments are present
+            if "attachment" in str(part.get("Content-Disposition")):
+                return None
+            # and using the plain text when reached (discarding other parts)
+            if part.get_content_type() == "text/plain":
+                try:
+                    body = part.get_payload(decode=True).decode(part.get_content_charset() or "utf-8")
+                except Exception as e:
+                    print(f"extract_plain_text_body: error extracting body: {e}")
+    # or decoding content if it is plain text
+    else:
+        try:
+            body = message.get_payload(decode=True).decode(message.get_content_charset() or "utf-8")
+        except Exception as e:
+            print(f"extract_plain_text_body: error extracting body: {e}")
+    return body
+
+#####################################################################
+# Helper 13: Get a mirrored message's date (datetime, or the header #
+#            text if it could not be parsed)                        #
+#####################################################################
+def get_mirrored_message_date(mirrored_message):
+    from datetime import datetime
+
+    if mirrored_message["date_parsed"]:
+        return datetime.fromisoformat(mirrored_message["date"])
+    return mirrored_message["date"]
+
+#######################################################################
+# Helper 14: Load a folder's mailbox mirror (empty if none is stored) #
+#######################################################################
+def load_mailbox_mirror(mirror_path, folder):
+    import os
+    import re
+    import json
+
+    empty_mirror = {"uidvalidity": None, "highestmodseq": None, "pending": False, "last_uid": 0, "messages": {}}
+    if mirror_path is None:
+        return empty_mirror
+    entry_path = os.path.join(mirror_path, f"{re.sub(r'[^A-Za-z0-9_-]', '_', folder)}.json")
+    try:
+        with open(entry_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return empty_mirror
+
+##############################################
+# Helper 15: Write a folder's mailbox mirror #
+##############################################
+def write_mailbox_mirror(mirror_path, folder, mailbox_mirror):
+    import os
+    import re
+    import json
+
+    os.makedirs(mirror_path, exist_ok=True)
+    entry_path = os.path.join(mirror_path, f"{re.sub(r'[^A-Za-z0-9_-]', '_', folder)}.json")
+    # write to a temporary file first: a partial mirror must never be read
+    temporary_path = f"{entry_path}.tmp"
+    try:
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(mailbox_mirror, f, ensure_ascii=False)
+        os.replace(temporary_path, entry_path)
+        return True
+    except (OSError, TypeError, ValueError) as e:
+        print(f"write_mailbox_mirror: failed to write {entry_path}: {e}")
+        return False
+
+######################################################################
+# Helper 16: Fetch messages for the mailbox mirror (headers and MIME #
+#            structure first, then only the text/plain part)         #
+######################################################################
+def fetch_mirror_messages(imap_session, uids):
+    # returns {UID (int): mirrored message}, messages missing from the responses are left out (retried next sync)
+    import re
+    import email
+    from email.utils import parseaddr, parsedate_to_datetime
+    from datetime import datetime, timezone
+    from config.email_agent import IMAP_FETCH_BATCH_SIZE
+    from helpers.data import get_unquoted_text
+    from helpers.imap_session import parse_imap_list, find_text_plain_part
+
+    mirrored_messages = {}
+    for batch_start in range(0, len(uids), IMAP_FETCH_BATCH_SIZE):
+        batch_uids = uids[batch_start:batch_start + IMAP_FETCH_BATCH_SIZE]
+
+        # 1st FETCH: headers, internal date and MIME structure only (BODY.PEEK keeps emails unread while they are
+        # processed)
+        fetched_headers = imap_session.fetch_messages(
+            batch_uids,
+            "(INTERNALDATE BODY.PEEK[HEADER.FIELDS (FROM TO SUBJECT DATE)] BODYSTRUCTURE)"
+        )
+
+        batch_messages, text_parts = {}, {}
+        for uid in batch_uids:
+            try:
+                # get message headers
+                header_sections = [
+                    section_literal
+                    for section, section_literal in fetched_headers.get(uid, {"sections": {}})["sections"].items()
+                    if section.upper().startswith("HEADER")
+                ]
+                if not header_sections:
+                    print(f"fetch_mirror_messages: email {uid} missing from FETCH response: skipping")
+                    continue
+                message = email.message_from_bytes(header_sections[0])
+
+                # parse date (kept as header text if parsing fails)
+                email_date, date_parsed = message.get("Date", ""), False
+                try:
+                    parsed_date = parsedate_to_datetime(email_date)
+                    if parsed_date.tzinfo is None:
+                        parsed_date = parsed_date.replace(tzinfo=timezone.utc)
+                    email_date, date_parsed = parsed_date.isoformat(), True
+                except Exception as e:
+                    print(f"fetch_mirror_messages: warning: could not parse date '{email_date}' for email {uid}: {e}")
+
+                # internal date (what SEARCH SINCE matches, in the server's time zone), None if missing
+                internal_date_match = re.search(r'INTERNALDATE "([^"]+)"', fetched_headers[uid]["text"])
+                internal_date = None
+                if internal_date_match:
+                    try:
+                        internal_date = datetime.strptime(internal_date_match.group(1).strip(), "%d-%b-%Y %H:%M:%S %z").isoformat()
+                    except ValueError as e:
+                        print(f"fetch_mirror_messages: warning: could not parse internal date of email {uid}: {e}")
+
+                # locate attachments and plain text ({"section": None} if the structure cannot be read here:
+                # the full message is fetched instead)
+                fetched_text = fetched_headers[uid]["text"]
+                try:
+                    bodystructure_start = fetched_text.upper().index("BODYSTRUCTURE (") + len("BODYSTRUCTURE ")
+                    has_attachment, text_part = find_text_plain_part(parse_imap_list(fetched_text, bodystructure_start)[0])
+                except Exception as e:
+                    print(f"fetch_mirror_messages: could not read structure of email {uid}, fetching it in full: {e}")
+                    has_attachment, text_part = False, {"section": None}
+
+                batch_messages[uid] = {
+                    "from": parseaddr(decode_email_header(message.get("From", "")))[1],
+                    "to": decode_email_header(message.get("To", "")),
+                    "subject": decode_email_header(message.get("Subject", "")),
+                    "date": email_date,
+                    "date_parsed": date_parsed,
+                    "internal_date": internal_date,
+                    # messages with attachments are mirrored without body (and never read)
+                    "has_attachment": has_attachment,
+                    "message_body": ""
+                }
+                if text_part and not has_attachment:
+                    text_parts[uid] = text_part
+
+            except Exception as e:
+                print(f"fetch_mirror_messages: error processing email {uid}: {e}")
+                continue
+
+        # 2nd FETCH: the text/plain part, one FETCH per distinct section (usually 1 or 2)
+        fetched_bodies = {}
+        for section in {text_part["section"] for text_part in text_parts.values()}:
+            fetched_bodies.update(imap_session.fetch_messages(
+                [uid for uid, text_part in text_parts.items() if text_part["section"] == section],
+                f"(BODY.PEEK[{section}])" if section is not None else "(BODY.PEEK[])"
+            ))
+
+        for uid, mirrored_message in batch_messages.items():
+            text_part = text_parts.get(uid)
+            if text_part:
+                fetched_body = fetched_bodies.get(uid, {"sections": {}})["sections"].get(text_part["section"] or "")
+                if fetched_body is None:
+                    print(f"fetch_mirror_messages: body of email {uid} missing from FETCH response: skipping")
+                    continue
+                try:
+                    if text_part["section"] is None:
+                        body = extract_plain_text_body(email.message_from_bytes(fetched_body))
+                        if body is None:
+                            mirrored_message["has_attachment"] = True
+                        else:
+                            mirrored_message["message_body"] = body
+                    else:
+                        mirrored_message["message_body"] = decode_text_part(
+                            fetched_body,
+                            text_part["encoding"],
+                            text_part["charset"]
+                        )
+                except Exception as e:
+                    print(f"fetch_mirror_messages: error extracting body: {e}")
+
+            # unquoted/quoted split, computed once per message
+            mirrored_message["unquoted_body"], mirrored_message["quoted_body"] = get_unquoted_text(
+                mirrored_message["message_body"],
+                return_quoted=True
+            )
+            mirrored_messages[uid] = mirrored_message
+
+    return mirrored_messages
+
+#####################################################################
+# Helper 17: Sync a folder's mailbox mirror (keyed by UIDVALIDITY   #
+#            and UID): fetch only the messages it does not have yet #
+#####################################################################
+def sync_mailbox_mirror(imap_session, folder, last_n_days, mirror_path):
+    # mirror_path None: the mirror is built in memory for this run only (and only the latest
+    # CONTEXT_EMAILS_PER_FOLDER messages are fetched)
+    # returns (mailbox mirror, whether the stored mirror was written)
+    from datetime import datetime, timedelta, timezone
+    from config.email_agent import MAILBOX_MIRROR_MAX_FETCH_PER_SYNC, CONTEXT_EMAILS_PER_FOLDER
+
+    mailbox_mirror = load_mailbox_mirror(mirror_path, folder)
+    mirror_changed = False
+    try:
+        status, _ = imap_session.select(folder)
+        if status != "OK":
+            print(f"sync_mailbox_mirror: could not select folder '{folder}' ({status}): using the stored mirror")
+            return mailbox_mirror, False
+
+        # UIDs are only valid under the UIDVALIDITY they were mirrored with
+        uidvalidity = imap_session.selected_uidvalidity
+        if mailbox_mirror["uidvalidity"] != uidvalidity:
+            if mailbox_mirror["messages"]:
+                print(f"sync_mailbox_mirror: '{folder}' UIDVALIDITY changed: mirroring it again")
+            mailbox_mirror = load_mailbox_mirror(None, folder)
+            mailbox_mirror["uidvalidity"] = uidvalidity
+            mirror_changed = True
+
+        # messages older than the window leave the mirror (no round trip), by the same criterion as SEARCH SINCE:
+        # the internal date's day (the header date for messages mirrored without it), so pruned messages are not
+        # matched (and fetched again) by the searches below
+        cutoff_date = datetime.now(timezone.utc) - timedelta(days=last_n_days)
+        for uid in list(mailbox_mirror["messages"]):
+            mirrored_message = mailbox_mirror["messages"][uid]
+            if mirrored_message.get("internal_date"):
+                email_date = datetime.fromisoformat(mirrored_message["internal_date"])
+            else:
+                email_date = get_mirrored_message_date(mirrored_message)
+            if isinstance(email_date, datetime) and email_date.date() < cutoff_date.date():
+                del mailbox_mirror["messages"][uid]
+                mirror_changed = True
+
+        # CONDSTORE: an unchanged HIGHESTMODSEQ means no message was added, changed or expunged since the last sync
+        highestmodseq = imap_session.selected_highestmodseq
+        if (
+            imap_session.condstore_enabled and
+            highestmodseq is not None and
+            highestmodseq == mailbox_mirror["highestmodseq"] and
+            not mailbox_mirror["pending"]
+        ):
+            print(f"sync_mailbox_mirror: '{folder}' unchanged (HIGHESTMODSEQ {highestmodseq})")
+        else:
+            since_date = cutoff_date.strftime("%d-%b-%Y")
+            last_uid = mailbox_mirror["last_uid"]
+
+            # new messages: UIDs above the last seen one, in the window (server-side, by internal date)
+            # ("n:*" also matches the highest UID when it is below n)
+            new_uids = imap_session.search_uids("UID", f"{last_uid + 1}:*", "SINCE", since_date)
+            if new_uids is None:
+                print(f"sync_mailbox_mirror: could not search '{folder}': using the stored mirror")
+                return mailbox_mirror, False
+            new_uids = [uid for uid in new_uids if uid > last_uid]
+
+            # UIDs up to the last seen one still in the window: expunged (or moved) messages leave the mirror, and
+            # messages left over by a capped sync are fetched with the new ones
+            if last_uid:
+                seen_uids = imap_session.search_uids("UID", f"1:{last_uid}", "SINCE", since_date)
+                if seen_uids is None:
+                    print(f"sync_mailbox_mirror: could not search '{folder}': using the stored mirror")
+                    return mailbox_mirror, False
+                seen_uid_set = set(seen_uids)
+                for uid in list(mailbox_mirror["messages"]):
+                    if int(uid) not in seen_uid_set:
+                        del mailbox_mirror["messages"][uid]
+                        mirror_changed = True
+                new_uids = [uid for uid in seen_uids if str(uid) not in mailbox_mirror["messages"]] + new_uids
+
+            # latest first, capped per sync (in memory: only what this run reads)
+            new_uids = new_uids[::-1]
+            max_fetch = MAILBOX_MIRROR_MAX_FETCH_PER_SYNC if mirror_path is not None else CONTEXT_EMAILS_PER_FOLDER
+            mirrored_messages = fetch_mirror_messages(imap_session, new_uids[:max_fetch])
+            mailbox_mirror["messages"].update({str(uid): message for uid, message in mirrored_messages.items()})
+            pending = mirror_path is not None and len(mirrored_messages) < len(new_uids)
+            # (nothing to write if no message was fetched and the sync state is unchanged)
+            mirror_changed = mirror_changed or bool(mirrored_messages) or (pending, highestmodseq) != (
+                mailbox_mirror["pending"],
+                mailbox_mirror["highestmodseq"]
+            )
+            mailbox_mirror["pending"] = pending
+            mailbox_mirror["highestmodseq"] = highestmodseq
+            print(
+                f"sync_mailbox_mirror: '{folder}' {len(mirrored_messages)} new messages fetched "
+                f"(above UID {last_uid} or left over), {len(mailbox_mirror['messages'])} mirrored"
+                + (f", {len(new_uids) - len(mirrored_messages)} left for the next sync" if mailbox_mirror["pending"] else "")
+            )
+            mailbox_mirror["last_uid"] = max([mailbox_mirror["last_uid"]] + [int(uid) for uid in mailbox_mirror["messages"]])
+
+    except Exception as e:
+        print(f"sync_mailbox_mirror: error syncing '{folder}': {e}")
+        return mailbox_mirror, False
+
+    mirror_written = mirror_path is not None and mirror_changed and write_mailbox_mirror(mirror_path, folder, mailbox_mirror)
+    return mailbox_mirror, mirror_written
@@ -0,0 +1,256 @@
+###################################################################
+# Helper 1: Compress message numbers into an IMAP sequence set    #
+#           (e.g., [7, 1, 2, 3, 5] -> "1:3,5,7", one FETCH/STORE; #
+#           message numbers or UIDs)                              #
+###################################################################
+def build_sequence_set(message_numbers):
+    numbers = sorted({int(message_number) for message_number in message_numbers})
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+#################################################################
+# Helper 2: Parse an IMAP parenthesized list (e.g., a message's #
+#           BODYSTRUCTURE) starting at text[start]              #
+#################################################################
+def parse_imap_list(text, start=0):
+    # returns (nested lists of str/None, index after the list): quoted strings and atoms are str, NIL is None
+    if text[start] != "(":
+        raise ValueError(f"expected '(' at {start}")
+    stack = [[]]
+    index = start + 1
+    while stack:
+        char = text[index]
+        if char == "(":
+            stack.append([])
+            index += 1
+        elif char == ")":
+            closed_list = stack.pop()
+            if stack:
+                stack[-1].append(closed_list)
+            index += 1
+        elif char == " ":
+            index += 1
+        elif char == '"':
+            value, index = [], index + 1
+            while text[index] != '"':
+                if text[index] == "\\":
+                    index += 1
+                value.append(text[index])
+                index += 1
+            stack[-1].append("".join(value))
+            index += 1
+        elif char == "{":
+            # literals are split out of the response by imaplib
+            raise ValueError("literal inside list")
+        else:
+            atom_end = index
+            while text[atom_end] not in " ()":
+                atom_end += 1
+            atom = text[index:atom_end]
+            stack[-1].append(None if atom.upper() == "NIL" else atom)
+            index = atom_end
+    return closed_list, index
+
+######################################################################
+# Helper 3: Find attachments and the text/plain part (section,       #
+#           transfer encoding and charset) in a parsed BODYSTRUCTURE #
+######################################################################
+def find_text_plain_part(bodystructure, section=""):
+    # returns (has_attachment, text_part), text_part None if there is no text/plain part (outside attachments);
+    # text/plain parts later in the message win, as when walking it with email.message.Message.walk
+    def is_attachment(disposition):
+        return isinstance(disposition, list) and bool(disposition) and str(disposition[0]).lower() == "attachment"
+
+    # multipart: child parts (numbered from 1), subtype, then extension data (params, disposition, ...)
+    if isinstance(bodystructure[0], list):
+        child_count = next((i for i, value in enumerate(bodystructure) if not isinstance(value, list)), len(bodystructure))
+        child_parts = bodystructure[:child_count]
+        extension_data = bodystructure[child_count + 1:]
+        has_attachment = len(extension_data) > 1 and is_attachment(extension_data[1])
+        text_part = None
+        for i, child_part in enumerate(child_parts):
+            child_has_attachment, child_text_part = find_text_plain_part(child_part, f"{section}{i + 1}.")
+            has_attachment = has_attachment or child_has_attachment
+            text_part = child_text_part or text_part
+        return has_attachment, text_part
+
+    # single part: type, subtype, params, id, description, encoding, size, then per-type fields and
+    # extension data (md5, disposition, ...)
+    content_type = f"{bodystructure[0]}/{bodystructure[1]}".lower()
+    if content_type == "text/plain":
+        disposition_index = 9 # after lines, md5
+    elif content_type == "message/rfc822":
+        disposition_index = 11 # after envelope, body, lines, md5
+    else:
+        disposition_index = 8 # after md5
+    has_attachment = len(bodystructure) > disposition_index and is_attachment(bodystructure[disposition_index])
+    if content_type != "text/plain" or has_attachment:
+        return has_attachment, None
+    params = bodystructure[2] or []
+    charset = next((params[i + 1] for i in range(0, len(params) - 1, 2) if str(params[i]).lower() == "charset"), None)
+    # a single-part message's body is section 1
+    return False, {"section": section[:-1] or "1", "encoding": (bodystructure[5] or "7BIT").upper(), "charset": charset}
+
+# commands that are safe to send again after a dropped connection (the server may have run an APPEND before
+# the link dropped: sending it again could store the message twice)
+IDEMPOTENT_COMMANDS = {"SELECT", "SEARCH", "FETCH", "STORE", "LIST"}
+
+########################################################################
+# IMAP session: one authenticated connection for a whole run, counting #
+# round trips per phase (reconnects once if the server drops the link) #
+########################################################################
+class ImapSession:
+    def __init__(self, imap_server, imap_port, imap_email, password, worker_name="imap_session"):
+        self.imap_server = imap_server
+        self.imap_port = imap_port
+        self.imap_email = imap_email
+        self.password = password
+        self.worker_name = worker_name
+        self.imap = None
+        self.selected_folder = None
+        self.selected_readonly = None
+        # of the selected folder: mirrored UIDs are only valid under the same UIDVALIDITY, and an unchanged
+        # HIGHESTMODSEQ (CONDSTORE servers) means nothing changed since the last sync
+        self.selected_uidvalidity = None
+        self.selected_highestmodseq = None
+        self.condstore_enabled = False
+        self.phase = "connect"
+        # round trips (commands sent to the server) by phase, in phase order
+        self.round_trips = {}
+
+    def set_phase(self, phase):
+        self.phase = phase
+
+    def _count_round_trip(self):
+        self.round_trips[self.phase] = self.round_trips.get(self.phase, 0) + 1
+
+    def connect(self):
+        # https://docs.python.org/3/library/imaplib.html
+        from imaplib import IMAP4_SSL
+
+        self.imap = IMAP4_SSL(self.imap_server, self.imap_port)
+        self._count_round_trip()
+        self.imap.login(self.imap_email, self.password)
+        self._count_round_trip()
+        self.selected_folder, self.selected_readonly = None, None
+        # servers may only advertise their extensions (e.g., CONDSTORE, ENABLE) after login: read them again (kept
+        # where imaplib's enable checks them)
+        self._count_round_trip()
+        status, capability_data = self.imap.capability()
+        if status == "OK" and capability_data and capability_data[-1]:
+            self.imap.capabilities = tuple(capability_data[-1].decode("ascii", errors="replace").upper().split())
+        # CONDSTORE servers report each folder's HIGHESTMODSEQ on SELECT once enabled
+        self.condstore_enabled = False
+        if "CONDSTORE" in self.imap.capabilities and "ENABLE" in self.imap.capabilities:
+            self._count_round_trip()
+            status, _ = self.imap.enable("CONDSTORE")
+            self.condstore_enabled = status == "OK"
+
+    def command(self, command_name, *args):
+        # runs imaplib's command_name (e.g., "fetch", "store", "append") on the session's connection
+        import imaplib
+
+        if self.imap is None:
+            self.connect()
+        try:
+            self._count_round_trip()
+            return getattr(self.imap, command_name)(*args)
+        except imaplib.IMAP4.abort as e:
+            # e.g., the server closed an idle connection during generation: log in again and reselect
+            print(f"{self.worker_name}: connection dropped ({e}), reconnecting")
+            selected_folder, selected_readonly = self.selected_folder, self.selected_readonly
+            self.connect()
+            if selected_folder is not None:
+                self.select(selected_folder, readonly=selected_readonly)
+            # then retry idempotent commands only (UID commands by their own name, e.g., UID FETCH)
+            imap_command = str(args[0] if command_name == "uid" and args else command_name).upper()
+            if imap_command not in IDEMPOTENT_COMMANDS:
+                print(f"{self.worker_name}: {imap_command} not retried (the server may have completed it)")
+                return "NO", [f"connection dropped during {imap_command} ({e}), not retried".encode()]
+            self._count_round_trip()
+            return getattr(self.imap, command_name)(*args)
+
+    def select(self, folder, readonly=False):
+        # the selected folder is kept across calls (no round trip to select it again)
+        if self.imap is not None and folder == self.selected_folder and readonly == self.selected_readonly:
+            return "OK", None
+        status, data = self.command("select", folder, readonly)
+        if status == "OK":
+            self.selected_folder, self.selected_readonly = folder, readonly
+            # response codes of the SELECT (no round trip)
+            _, uidvalidity = self.imap.response("UIDVALIDITY")
+            _, highestmodseq = self.imap.response("HIGHESTMODSEQ")
+            self.selected_uidvalidity = int(uidvalidity[-1]) if uidvalidity and uidvalidity[-1] else None
+            self.selected_highestmodseq = int(highestmodseq[-1]) if highestmodseq and highestmodseq[-1] else None
+        else:
+            self.selected_folder, self.selected_readonly = None, None
+            self.selected_uidvalidity, self.selected_highestmodseq = None, None
+        return status, data
+
+    def search_uids(self, *search_criteria):
+        # UID SEARCH in the selected folder, returns UIDs (int, ascending)
+        status, search_data = self.command("uid", "SEARCH", *search_criteria)
+        if status != "OK":
+            print(f"{self.worker_name}: UID SEARCH failed ({status})")
+            return None
+        return sorted(int(uid) for uid in (search_data[0] or b"").split())
+
+    def fetch_messages(self, uids, message_parts):
+        # one UID FETCH for all uids, returns {UID (int): {"text": response without its literals (str),
+        # "sections": {BODY[] section, e.g., "1.1" or "HEADER.FIELDS (FROM)": literal (bytes)}}}
+        import re
+
+        if not uids:
+            return {}
+        status, fetch_data = self.command("uid", "FETCH", build_sequence_set(uids), message_parts)
+        if status != "OK":
+            print(f"{self.worker_name}: UID FETCH failed ({status})")
+            return {}
+        fetched_messages = {}
+        fetched_message = None
+        for fetch_item in fetch_data:
+            # a message's response starts with its sequence number, e.g., (b"12 (UID 345 BODY[] {3456}", literal)
+            # then b")", or b"12 (UID 345 BODYSTRUCTURE (...))" without literals
+            response_text = fetch_item[0] if isinstance(fetch_item, tuple) else fetch_item
+            if response_text is None:
+                continue
+            message_number_match = re.match(rb"(\d+) \(", response_text)
+            if message_number_match:
+                fetched_message = {"text": "", "sections": {}}
+                fetched_messages[message_number_match.group(1)] = fetched_message
+            if fetched_message is None:
+                continue
+            fetched_message["text"] += response_text.decode("utf-8", errors="replace")
+            # literals of BODY[...] items (others, e.g., inside BODYSTRUCTURE, are left out)
+            section_match = re.search(r"BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$", fetched_message["text"])
+            if isinstance(fetch_item, tuple) and section_match:
+                fetched_message["sections"][section_match.group(1)] = fetch_item[1]
+
+        # by UID (part of every UID FETCH response, before or after the literals)
+        fetched_messages_by_uid = {}
+        for fetched_message in fetched_messages.values():
+            uid_match = re.search(r"\bUID (\d+)", fetched_message["text"])
+            if uid_match:
+                fetched_messages_by_uid[int(uid_match.group(1))] = fetched_message
+        return fetched_messages_by_uid
+
+    def print_round_trips(self):
+        phase_round_trips = ", ".join(f"{phase} {round_trips}" for phase, round_trips in self.round_trips.items())
+        print(f"{self.worker_name}: {sum(self.round_trips.values())} IMAP round trips ({phase_round_trips})")
+
+    def logout(self):
+        if self.imap is None:
+            return
+        try:
+            self._count_round_trip()
+            self.imap.logout()
+        except Exception as e:
+            print(f"{self.worker_name}: error logging out: {e}")
+        self.imap = None
+        self.selected_folder, self.selected_readonly = None, None
+        self.selected_uidvalidity, self.selected_highestmodseq = None, None
@@ -25,13 +25,38 @@ async def run_crawler_agent():
     import os
     import json
     import glob
+    import time
     import asyncio
     import datetime
     from transformers import AutoTokenizer
     from helpers.crawler_agent import crawl
-    from helpers.decoder import count_tokens
+    from helpers.decoder import (
+        count_tokens,
+        render_decoder_prompt,
+        get_response_cache_key,
+        read_response_cache,
+        write_response_cache,
+        evict_response_cache,
+        build_decoder_metrics,
+        write_decoder_metrics,
+        record_decoder_round_trip
+    )
+    from helpers.decoder_backends import get_decoder_backend
     from llama_index.core.node_parser import SentenceSplitter
-    from config.decoder import MODEL_PROFILES as DECODER_MODEL_PROFILES, DATA_CLEANER_PROFILE, EMAIL_WRITER_PROFILE
+    from config.decoder import (
+        MODEL_PROFILES as DECODER_MODEL_PROFILES,
+        DATA_CLEANER_PROFILE,
+        EMAIL_WRITER_PROFILE,
+        DECODER_BACKEND,
+        USE_RESPONSE_CACHE,
+        RESPONSE_CACHE_PATH,
+        RESPONSE_CACHE_TTL_SECONDS,
+        RESPONSE_CACHE_MAX_SIZE_MB,
+        RESPONSE_CACHE_OPT_OUT_PROFILES,
+        RESPONSE_CACHE_SAMPLING_PARAMS,
+        USE_DECODER_METRICS,
+        DECODER_METRICS_PATH
+    )
     from config.encoder import ENCODERS
     from config.crawler_agent import (
         START_URL,
@@ -130,10 +155,101 @@ async def run_crawler_agent():
 
             # chunk for decoder
             text_chunks = lm_splitter.split_text(content["manually_cleaned"]["text"])
-            
+
+            # run decoder on one chunk. context_ready is set as soon as the chunk's abstract, summary and
+            # cleaned text are known (streamed), so the next chunk can start while this one writes its Q&A
+            async def clean_chunk(idx, prompt, model_config, context_ready):
+                nonlocal previous_cleaned_text
+                lm_cleaned_content, prompt_text, metrics = None, None, None
+                streamed_fields = {}
+                try:
+                    # render the chat template and tokenize once: the decoder takes the ids as they are
+                    rendered_prompt_text, prompt_ids = render_decoder_prompt(
+                        decoder_tokenizer,
+                        [],
+                        prompt,
+                        model_config["system_prompt"],
+                        model_config["enable_thinking"]
+                    )
+
+                    # reuse the output of an identical request (e.g., re-crawl of an unchanged page)
+                    cache_key, cached_response = None, None
+                    if use_response_cache:
+                        cache_key = get_response_cache_key(
+                            model_config["model_path"],
+                            DATA_CLEANER_PROFILE,
+                            rendered_prompt_text,
+                            {param: model_config.get(param) for param in RESPONSE_CACHE_SAMPLING_PARAMS}
+                        )
+                        cached_response = read_response_cache(RESPONSE_CACHE_PATH, cache_key, RESPONSE_CACHE_TTL_SECONDS)
+
+                    decoder_call_start_time = time.perf_counter()
+                    if cached_response is not None:
+                        print(f"run_crawler_agent: response cache hit for chunk {idx} of {url}")
+                        lm_cleaned_content, prompt_text = cached_response["output"], cached_response["prompt_text"]
+                        metrics = build_decoder_metrics(
+                            "run_crawler_agent",
+                            DATA_CLEANER_PROFILE,
+                            model_config["model_path"],
+                            decoder_call_start_time,
+                            len(prompt_ids),
+                            cache_hits={"response": True}
+                        )
+                    else:
+                        async for event in decoder_backend.stream_aio(
+                            context=[],
+                            current_turn_input_text=prompt,
+                            current_turn_image_in_bytes=None,
+                            **model_config,
+                            decoder_profile=DATA_CLEANER_PROFILE,
+                            prompt_ids=prompt_ids
+                        ):
+                            if event["type"] == "field":
+                                streamed_fields.setdefault(event["name"], event["content"])
+                                if (not context_ready.is_set() and
+                                    all(name in streamed_fields for name in ("abstract", "summary", "cleanedtext"))):
+                                    # update abstracts, summaries, last cleaned_text (for context)
+                                    if streamed_fields["abstract"] and streamed_fields["summary"]:
+                                        page_history[idx] = {
+                                            "abstract": streamed_fields["abstract"],
+                                            "summary": streamed_fields["summary"]
+                                        }
+                                    if streamed_fields["cleanedtext"]:
+                                        previous_cleaned_text = streamed_fields["cleanedtext"]
+                                    context_ready.set()
+                            elif event["type"] == "result":
+                                lm_cleaned_content, prompt_text = event["output"], event["prompt_text"]
+                                metrics = event.get("metrics")
+                    if cached_response is None:
+                        metrics = record_decoder_round_trip(metrics, decoder_call_start_time)
+                    if metrics is not None:
+                        decoder_metrics.append({**metrics, "url": url, "chunk": idx})
+
+                    # failed generations (None) are not cached, so they are retried
+                    if cached_response is None and cache_key is not None and lm_cleaned_content is not None:
+                        write_response_cache(RESPONSE_CACHE_PATH, cache_key, lm_cleaned_content, prompt_text)
+                except Exception as e:
+                    print(f"run_crawler_agent: decoder generation failed: {e}")
+                finally:
+                    # update context from the full result (if it was not streamed)
+                    if not context_ready.is_set():
+                        if lm_cleaned_content and len(lm_cleaned_content) == 5:
+                            abstract, summary, cleanedtext, _, _ = lm_cleaned_content
+                            if abstract and summary:
+                                page_history[idx] = {
+                                     "abstract": abstract,
+                                     "summary": summary
+                                }
+                            if cleanedtext:
+                                previous_cleaned_text = cleanedtext
+                        context_ready.set()
+                return lm_cleaned_content, prompt_text
+
+            chunk_tasks = []
             for idx, chunk_text in enumerate(text_chunks):
-                # get current date and time
-                current_date_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") # e.g., "2026-02-02 09:00:00"
+                # get current date
+                # NOTE: date only, so re-crawls on the same day send identical prompts (response cache)
+                current_date_time = datetime.datetime.now().strftime("%Y-%m-%d") # e.g., "2026-02-02"
 
                 # select decoder configuration for data cleaning
                 model_config = DECODER_MODEL_PROFILES[DATA_CLEANER_PROFILE].copy()
@@ -170,34 +286,21 @@ async def run_crawler_agent():
                     print(f"run_crawler_agent: error formatting prompt template: {e}")
                     continue
 
-                # run decoder (without "template" in model_config)
-                try:
-                    lm_cleaned_content, prompt_text = await run_qwen3_lm_or_vlm.remote.aio(
-                        context=[],
-                        current_turn_input_text=prompt,
-                        current_turn_image_in_bytes=None,
-                        **model_config,
-                        decoder_profile=DATA_CLEANER_PROFILE
-                    )
-                except Exception as e:
-                    print(f"run_crawler_agent: decoder generation failed: {e}")
-                    continue
+                # run decoder (without "template" in model_config), and wait only for the context
+                # the next chunk needs
+                context_ready = asyncio.Event()
+                chunk_tasks.append((idx, asyncio.create_task(clean_chunk(idx, prompt, model_config, context_ready))))
+                await context_ready.wait()
+
+            for idx, chunk_task in chunk_tasks:
+                lm_cleaned_content, prompt_text = await chunk_task
 
-                if DECODER_MODEL_PROFILES[DATA_CLEANER_PROFILE]["return_prompt_text"]:
+                if DECODER_MODEL_PROFILES[DATA_CLEANER_PROFILE]["return_prompt_text"] and prompt_text is not None:
                     print(f"{prompt_text}\n\n")
 
                 if lm_cleaned_content and len(lm_cleaned_content) == 5:
                     abstract, summary, cleanedtext, questions, answers = lm_cleaned_content
-                    
-                    # update abstracts, summaries, last cleaned_text (for context)
-                    if abstract and summary:
-                        page_history[idx] = {
-                             "abstract": abstract,
-                             "summary": summary
-                        }
-                    if cleanedtext:
-                        previous_cleaned_text = cleanedtext
-                        
+
                     # process abstract
                     if abstract:
                         abstract_decoder_tokens = count_tokens(decoder_tokenizer, abstract)
@@ -412,12 +515,23 @@ async def run_crawler_agent():
             print(f"run_crawler_agent: error loading tokenizers or creating splitter: {e}")
             return
 
-        # find decoder service
+        # find decoder service, or run a local/fake decoder (e.g., DECODER_BACKEND=fake on a laptop or CI box)
+        decoder_backend_name = os.getenv("DECODER_BACKEND", DECODER_BACKEND)
         try:
-            run_qwen3_lm_or_vlm = modal.Function.from_name("decoder", "run_qwen3_lm_or_vlm")
+            decoder_backend = get_decoder_backend(decoder_backend_name)
         except Exception as e:
-            print(f"run_crawler_agent: failed to find decoder service. Is it deployed? Error: {e}")
+            print(f"run_crawler_agent: failed to find decoder service ({decoder_backend_name}). Is it deployed? Error: {e}")
             return
+
+        # response cache (unless the data cleaner profile opts out, or the backend does not run the profile's model)
+        use_response_cache = (
+            USE_RESPONSE_CACHE and
+            decoder_backend.use_response_cache and
+            DATA_CLEANER_PROFILE not in RESPONSE_CACHE_OPT_OUT_PROFILES
+        )
+
+        # per-request decoder metrics (appended to DECODER_METRICS_PATH)
+        decoder_metrics = []
     
         # crawl
         url_content_dict = crawl(
@@ -604,8 +718,11 @@ async def run_crawler_agent():
             save_chunks(lm_summary_chunks, files["lm_summary_chunks"]["json"], files["lm_summary_chunks"]["txt"], "LM SUMMARY")
             save_chunks(lm_q_and_a_chunks, files["lm_q_and_a_chunks"]["json"], files["lm_q_and_a_chunks"]["txt"], "LM Q&A")
 
+            evicted = evict_response_cache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_SIZE_MB)
+            if USE_DECODER_METRICS:
+                write_decoder_metrics(DECODER_METRICS_PATH, "run_crawler_agent", decoder_metrics)
             rag_volume.commit()
-            print(f"run_crawler_agent: data saved and volume committed")
+            print(f"run_crawler_agent: data saved and volume committed ({evicted} response cache entries evicted)")
             print(f"run_crawler_agent: max token lengths:\n{max_token_lengths}")
 
         except Exception as e:
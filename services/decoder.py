@@ -1,288 +1,901 @@
 import modal
 
-from config.general import modal_secret
+from config.general import modal_secret, rag_volume, VOLUME_PATH
 from config.decoder import (
     image,
     GPU,
     TIMEOUT,
     SCALEDOWN_WINDOW,
     MIN_CONTAINERS,
-    EMAIL_WRITER_PROFILE,
-    THREAD_GROUPER_PROFILE,
-    DATA_CLEANER_PROFILE
+    USE_MEMORY_SNAPSHOT,
+    EMAIL_WRITER_PROFILE
 )
 
 # Modal
 app = modal.App("decoder")
 
-@app.function(
+@app.cls(
         image=image,
         gpu=GPU,
         secrets=[modal_secret],
         timeout=TIMEOUT,
         scaledown_window=SCALEDOWN_WINDOW,
-        min_containers=MIN_CONTAINERS
+        min_containers=MIN_CONTAINERS,
+        volumes={VOLUME_PATH: rag_volume},
+        # https://modal.com/docs/guide/memory-snapshot
+        enable_memory_snapshot=USE_MEMORY_SNAPSHOT,
+        experimental_options={"enable_gpu_snapshot": USE_MEMORY_SNAPSHOT}
         )
-def run_qwen3_lm_or_vlm(
-    context,
-    current_turn_input_text,
-    model_path,
-    is_vision_model,
-    current_turn_image_in_bytes,
-    system_prompt,
-    max_new_tokens,
-    temperature,
-    top_p,
-    top_k,
-    use_flash_attention_2,
-    enable_thinking,
-    return_prompt_text=False,
-    decoder_profile=EMAIL_WRITER_PROFILE
-    ):
-    import io
-    import torch
-    from PIL import Image
-    from peft import AutoPeftModelForCausalLM
-    from transformers import AutoTokenizer, AutoModelForCausalLM, AutoProcessor, Qwen3VLForConditionalGeneration
-    from helpers.decoder import remove_think_tokens, extract_message_content, extract_lm_cleaned_content, extract_thread_content
-    from config.decoder import (
-        NO_MESSAGE_OPENING_TAG,
-        NO_MESSAGE_CLOSING_TAG,
-        MESSAGE_OPENING_TAG,
-        MESSAGE_CLOSING_TAG,
-        ABSTRACT_OPENING_TAG,
-        ABSTRACT_CLOSING_TAG,
-        SUMMARY_OPENING_TAG,
-        SUMMARY_CLOSING_TAG,
-        CLEANED_TEXT_OPENING_TAG,
-        CLEANED_TEXT_CLOSING_TAG,
-        THREAD_OPENING_TAG,
-        THREAD_CLOSING_TAG,
-        THREAD_MESSAGE_OPENING_TAG,
-        THREAD_MESSAGE_CLOSING_TAG,
-        THREAD_FROM_OPENING_TAG,
-        THREAD_FROM_CLOSING_TAG,
-        THREAD_TO_OPENING_TAG,
-        THREAD_TO_CLOSING_TAG,
-        THREAD_SUBJECT_OPENING_TAG,
-        THREAD_SUBJECT_CLOSING_TAG,
-        THREAD_BODY_OPENING_TAG,
-        THREAD_BODY_CLOSING_TAG,
-        QUESTION_OPENING_TAG,
-        QUESTION_CLOSING_TAG,
-        ANSWER_OPENING_TAG,
-        ANSWER_CLOSING_TAG
-    )
-    
-    #######################################
-    # Cache model (if not cached already) #
-    #######################################
-    if (not hasattr(run_qwen3_lm_or_vlm, "model") or
-        getattr(run_qwen3_lm_or_vlm, "model_path", None) != model_path or
-        getattr(run_qwen3_lm_or_vlm, "is_vision_model", None) != is_vision_model):
-
-        print(f"run_qwen3_lm_or_vlm: loading model from {model_path} (is_vision_model: {is_vision_model})...")
-        
-        ##################################################################
-        # Model could be LoRA adapter (to load on top of the base model) #
-        ##################################################################
-        try:
-            run_qwen3_lm_or_vlm.model = AutoPeftModelForCausalLM.from_pretrained(
-                model_path,
-                dtype="auto",
-                device_map="auto",
-                attn_implementation="sdpa" if not use_flash_attention_2 else "flash_attention_2"
+class Qwen3Decoder:
+    # with USE_MEMORY_SNAPSHOT, runs once (before the snapshot is taken): cold starts restore loaded, warmed-up models
+    @modal.enter(snap=USE_MEMORY_SNAPSHOT)
+    def preload_models(self):
+        import torch
+        from collections import OrderedDict
+        from config.decoder import MODEL_PROFILES, PRELOAD_PROFILES
+        from helpers.decoder import prepare_decoder_inputs
+
+        # resident (base) models (and processors/tokenizers) by (model_path, is_vision_model), LRU first
+        self.models = OrderedDict()
+        self.model_sizes_gb = {}
+        self.model_registry_stats = {"hits": 0, "misses": 0, "evictions": 0}
+        # LoRA adapter path -> base model path (adapters are attached to their resident base model)
+        self.lora_base_model_paths = {}
+        # prefix KV caches by (model_path, decoder_profile, adapter_name)
+        self.prefix_caches = {}
+
+        ########################################################################
+        # Load the configured profiles' models and warm them up (CUDA kernels, #
+        # allocator) with a dummy generate, before the first request arrives   #
+        ########################################################################
+        warmed_up_models = set()
+        for decoder_profile in PRELOAD_PROFILES:
+            profile_config = MODEL_PROFILES[decoder_profile]
+            model_key = (profile_config["model_path"], profile_config["is_vision_model"], profile_config["is_lora_adapter"])
+            model, processor, _ = self._get_model(
+                profile_config["model_path"],
+                profile_config["is_vision_model"],
+                profile_config["is_lora_adapter"],
+                profile_config["use_flash_attention_2"]
             )
-        #################
-        # Or base model #
-        #################
-        except Exception:
-            if is_vision_model:
-                run_qwen3_lm_or_vlm.model = Qwen3VLForConditionalGeneration.from_pretrained(
-                    model_path,
-                    dtype="auto",
-                    device_map="auto",
-                    attn_implementation="sdpa" if not use_flash_attention_2 else "flash_attention_2"
-                )
-            else:
-                run_qwen3_lm_or_vlm.model = AutoModelForCausalLM.from_pretrained(
-                    model_path,
-                    dtype="auto",
-                    device_map="auto",
-                    attn_implementation="sdpa" if not use_flash_attention_2 else "flash_attention_2"
-                )
-        if is_vision_model:
-            run_qwen3_lm_or_vlm.processor = AutoProcessor.from_pretrained(model_path)
-        else:
-            run_qwen3_lm_or_vlm.tokenizer = AutoTokenizer.from_pretrained(model_path)
-        run_qwen3_lm_or_vlm.model_path = model_path
-        run_qwen3_lm_or_vlm.is_vision_model = is_vision_model
-        
-        print("run_qwen3_lm_or_vlm: model and processor loaded and cached")
-
-    ################################################
-    # Use the cached model and processor/tokenizer #
-    ################################################
-    model = run_qwen3_lm_or_vlm.model
-    processor = run_qwen3_lm_or_vlm.processor if is_vision_model else run_qwen3_lm_or_vlm.tokenizer
-
-    messages = []
-
-    def form_vlm_input_turn_content(input_text, input_image_in_bytes):
-        content = [{"type": "text", "text": input_text}]
-        if input_image_in_bytes:
-            context_image_pil = Image.open(io.BytesIO(input_image_in_bytes))
-        else:
-            context_image_pil = None
-        if context_image_pil:
-            content.insert(0, {"type": "image", "image": context_image_pil})
-        return content
-    
-    #####################
-    # Add system prompt #
-    #####################
-    messages.append({
-        "role": "system", 
-        "content": [{"type": "text", "text": system_prompt}] if is_vision_model else system_prompt
-    })
-
-    #######################################
-    # Add context (both input and output) #
-    #######################################
-    for context_turn in context:
-        if is_vision_model:
-            context_input_turn_content = form_vlm_input_turn_content(context_turn["input_text"], context_turn.get("input_image"))
-        messages.append({
-            "role": "user",
-            "content": context_input_turn_content if is_vision_model else context_turn["input_text"]
-        })
-        messages.append({
-            "role": "assistant",
-            "content": [{"type": "text", "text": context_turn["output_text"]}] if is_vision_model else context_turn["output_text"]
-        })
-    
-    ##########################
-    # Add current turn input #
-    ##########################
-    if is_vision_model:
-        current_input_turn_content = form_vlm_input_turn_content(current_turn_input_text, current_turn_image_in_bytes)
-    messages.append({
-        "role": "user",
-        "content": current_input_turn_content if is_vision_model else current_turn_input_text
-    })
-
-    ###################################################################
-    # Store entire prompt before tokenization (if return_prompt_text) #
-    ###################################################################
-    if return_prompt_text:
-        if is_vision_model:
-            prompt_text = processor.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True,
+            if model_key in warmed_up_models:
+                continue
+            inputs, _ = prepare_decoder_inputs(
+                model,
+                processor,
+                [],
+                "Hi",
+                None,
+                profile_config["system_prompt"],
+                profile_config["is_vision_model"],
+                profile_config["enable_thinking"],
+                False
             )
-        else:
-            prompt_text = processor.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True,
-                enable_thinking=enable_thinking
+            with torch.no_grad():
+                model.generate(**inputs, max_new_tokens=1, do_sample=False)
+            warmed_up_models.add(model_key)
+            print(f"Qwen3Decoder: '{decoder_profile}' model warmed up")
+
+    def _get_model(self, model_path, is_vision_model, is_lora_adapter, use_flash_attention_2):
+        # returns (model, processor, adapter_name), adapter_name being None for base models
+        import os
+        from config.decoder import USE_SERIALIZED_MODELS, SERIALIZED_MODELS_PATH, MODEL_REGISTRY_GPU_MEMORY_BUDGET_GB
+        from helpers.decoder import (
+            load_decoder_model,
+            get_serialized_model_path,
+            serialize_decoder_model,
+            get_resident_model,
+            get_lora_base_model_path,
+            attach_lora_adapter
+        )
+
+        # LoRA adapters share their base model (loaded once, adapters switched per request)
+        base_model_path = model_path
+        if is_lora_adapter:
+            if model_path not in self.lora_base_model_paths:
+                self.lora_base_model_paths[model_path] = get_lora_base_model_path(model_path)
+            base_model_path = self.lora_base_model_paths[model_path]
+
+        def load_model():
+            # load the serialized copy on the volume (if any) instead of downloading from the Hub
+            serialized_model_path = None
+            if USE_SERIALIZED_MODELS:
+                serialized_model_path = get_serialized_model_path(SERIALIZED_MODELS_PATH, base_model_path, False)
+            is_serialized = serialized_model_path is not None and os.path.isdir(serialized_model_path)
+
+            model, processor = load_decoder_model(
+                serialized_model_path if is_serialized else base_model_path,
+                is_vision_model,
+                False,
+                use_flash_attention_2,
+                worker_name="Qwen3Decoder"
             )
-    
-    ##################################################################
-    # Apply chat template to prompt, tokenize and move ids to device #
-    ##################################################################
-    if is_vision_model:
-        inputs = processor.apply_chat_template(
-            messages,
-            tokenize=True,
-            add_generation_prompt=True,
-            return_dict=True,
-            return_tensors="pt"
+
+            # first load: serialize it for the next cold starts
+            if serialized_model_path is not None and not is_serialized:
+                os.makedirs(SERIALIZED_MODELS_PATH, exist_ok=True)
+                if serialize_decoder_model(model, processor, serialized_model_path, worker_name="Qwen3Decoder"):
+                    rag_volume.commit()
+            return model, processor
+
+        model_key = (base_model_path, is_vision_model)
+        model, processor = get_resident_model(
+            self,
+            model_key,
+            load_model,
+            MODEL_REGISTRY_GPU_MEMORY_BUDGET_GB,
+            worker_name="Qwen3Decoder"
         )
-    else:
-        inputs = processor.apply_chat_template(
-            messages,
-            tokenize=True,
-            add_generation_prompt=True,
-            return_dict=True,
-            return_tensors="pt",
-            enable_thinking=enable_thinking
+        if not is_lora_adapter:
+            return model, processor, None
+
+        # attach the adapter (once, updating the registry entry with the wrapped model)
+        model, adapter_name = attach_lora_adapter(self, model_key, model_path, worker_name="Qwen3Decoder")
+        return model, processor, adapter_name
+
+    def _get_request_models(self, model_path, is_vision_model, is_lora_adapter, use_flash_attention_2, draft_model_path, kv_cache_mode):
+        # returns (model, processor, adapter_name, assistant_model, cache_hits), assistant_model being None without
+        # speculative decoding
+        model_registry_hits = self.model_registry_stats["hits"]
+        model, processor, adapter_name = self._get_model(model_path, is_vision_model, is_lora_adapter, use_flash_attention_2)
+        # (the main model's registry hit only, before the draft model is fetched)
+        cache_hits = {"model": self.model_registry_stats["hits"] > model_registry_hits}
+        # draft model for speculative decoding (text models only, and not with a KV cache mode)
+        assistant_model = None
+        if draft_model_path and not is_vision_model and kv_cache_mode is None:
+            assistant_model, _, _ = self._get_model(draft_model_path, False, False, use_flash_attention_2)
+        return model, processor, adapter_name, assistant_model, cache_hits
+
+    def _admit_request(
+        self,
+        model,
+        prompt_length,
+        max_new_tokens,
+        max_context_tokens,
+        kv_cache_mode,
+        decoder_profile,
+        model_path,
+        request_start_time,
+        cache_hits,
+        worker_name,
+        batch_size=1
+        ):
+        # caps generation to the context left after the (padded) prompt, and admits as many of batch_size prompts
+        # as fit the container's token budget with it
+        # returns (capped max_new_tokens, admitted prompts, metrics), metrics of the rejected request if a single
+        # prompt does not fit (None otherwise)
+        from config.decoder import DECODER_TOKEN_BUDGET, KV_CACHE_MODE_TOKEN_BUDGET_FACTORS
+        from helpers.decoder import cap_max_new_tokens, build_decoder_metrics
+
+        max_new_tokens = cap_max_new_tokens(model, prompt_length, max_new_tokens, max_context_tokens)
+        # (a quantized or offloaded KV cache takes less GPU memory per token)
+        token_budget = DECODER_TOKEN_BUDGET * KV_CACHE_MODE_TOKEN_BUDGET_FACTORS.get(kv_cache_mode, 1)
+        admitted_batch_size = min(token_budget // (prompt_length + max_new_tokens), batch_size) if max_new_tokens else 0
+        if admitted_batch_size or batch_size > 1:
+            return max_new_tokens, admitted_batch_size, None
+
+        print(
+            f"{worker_name}: rejected request ({prompt_length} prompt tokens, {max_new_tokens} new tokens, "
+            f"budget {token_budget})"
         )
-    inputs = inputs.to(model.device)
-
-    ##################################
-    # Generate response as token ids #
-    ##################################
-    with torch.no_grad():
-        generated_ids = model.generate(
-            **inputs, 
-            max_new_tokens=max_new_tokens, 
-            use_cache=True, 
-            temperature=temperature, 
-            top_p=top_p,
-            top_k=top_k,
-            do_sample=True,
+        metrics = build_decoder_metrics(
+            worker_name,
+            decoder_profile,
+            model_path,
+            request_start_time,
+            prompt_length,
+            cache_hits=cache_hits
         )
+        return max_new_tokens, 0, metrics
 
-    ############################
-    # Decode token ids to text #
-    ############################
-    generated_ids_trimmed = [out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)]
-    output_text = processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-    output_text = output_text[0] if output_text else None
-
-    print(f"{output_text}\n\n")
-
-    ########################################
-    # Remove think tokens if thinking mode #
-    ########################################
-    if enable_thinking:
-        output_text = remove_think_tokens(output_text)    
-
-    ##########################################################
-    # Extract reply if LM think it has enough info to answer #
-    ##########################################################
-    if decoder_profile == EMAIL_WRITER_PROFILE:
-        output_text = extract_message_content(
-            output_text,
-            NO_MESSAGE_OPENING_TAG,
-            NO_MESSAGE_CLOSING_TAG,
-            MESSAGE_OPENING_TAG,
-            MESSAGE_CLOSING_TAG
+    @modal.method()
+    def get_model_registry_stats(self):
+        return {
+            **self.model_registry_stats,
+            "resident_models": [
+                {"model_key": list(model_key), "size_gb": round(self.model_sizes_gb[model_key], 2)}
+                for model_key in self.models
+            ]
+        }
+
+    @modal.method()
+    def benchmark_kv_cache_mode(self, decoder_profile, kv_cache_mode, context_tokens, max_new_tokens, max_batch_size):
+        # doubles the number of concurrent sequences (synthetic prompts of context_tokens) until the GPU runs out of
+        # memory, returns {"batch_size", "tokens_per_second", "peak_gpu_memory_gb"} per batch size that fit
+        import time
+        import torch
+        from config.decoder import MODEL_PROFILES
+        from helpers.decoder import build_decoder_inputs_from_ids, get_kv_cache_generate_kwargs
+
+        profile_config = MODEL_PROFILES[decoder_profile]
+        model, processor, _ = self._get_model(
+            profile_config["model_path"],
+            False,
+            profile_config["is_lora_adapter"],
+            profile_config["use_flash_attention_2"]
         )
-    elif decoder_profile == THREAD_GROUPER_PROFILE:
-        output_text = extract_thread_content(
-            output_text,
-            THREAD_OPENING_TAG,
-            THREAD_CLOSING_TAG,
-            THREAD_MESSAGE_OPENING_TAG,
-            THREAD_MESSAGE_CLOSING_TAG,
-            THREAD_FROM_OPENING_TAG,
-            THREAD_FROM_CLOSING_TAG,
-            THREAD_TO_OPENING_TAG,
-            THREAD_TO_CLOSING_TAG,
-            THREAD_SUBJECT_OPENING_TAG,
-            THREAD_SUBJECT_CLOSING_TAG,
-            THREAD_BODY_OPENING_TAG,
-            THREAD_BODY_CLOSING_TAG
+        filler_ids = processor.encode("The quick brown fox jumps over the lazy dog. ", add_special_tokens=False)
+        prompt_ids = (filler_ids * (context_tokens // len(filler_ids) + 1))[:context_tokens]
+        kv_cache_kwargs = get_kv_cache_generate_kwargs(kv_cache_mode, worker_name="benchmark_kv_cache_mode")
+
+        results = []
+        batch_size = 1
+        while batch_size <= max_batch_size:
+            inputs = build_decoder_inputs_from_ids(prompt_ids)
+            inputs = {key: value.repeat(batch_size, 1).to(model.device) for key, value in inputs.items()}
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+            start_time = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    # exactly max_new_tokens per sequence (no early EOS)
+                    model.generate(
+                        **inputs,
+                        **kv_cache_kwargs,
+                        max_new_tokens=max_new_tokens,
+                        min_new_tokens=max_new_tokens,
+                        do_sample=False
+                    )
+            except torch.cuda.OutOfMemoryError:
+                print(f"benchmark_kv_cache_mode: {kv_cache_mode} at {context_tokens} tokens: out of memory with {batch_size} sequences")
+                break
+            elapsed_time = time.perf_counter() - start_time
+            results.append({
+                "batch_size": batch_size,
+                "tokens_per_second": round(batch_size * max_new_tokens / elapsed_time, 1),
+                "peak_gpu_memory_gb": round(torch.cuda.max_memory_allocated() / 1024**3, 2)
+            })
+            print(f"benchmark_kv_cache_mode: {kv_cache_mode} at {context_tokens} tokens: {results[-1]}")
+            batch_size *= 2
+        torch.cuda.empty_cache()
+        return results
+
+    @modal.method()
+    def run_qwen3_lm_or_vlm(
+        self,
+        context,
+        current_turn_input_text,
+        model_path,
+        is_vision_model,
+        current_turn_image_in_bytes,
+        system_prompt,
+        max_new_tokens,
+        temperature,
+        top_p,
+        top_k,
+        use_flash_attention_2,
+        enable_thinking,
+        is_lora_adapter=False,
+        draft_model_path=None,
+        max_context_tokens=None,
+        thinking_budget=None,
+        kv_cache_mode=None,
+        return_prompt_text=False,
+        decoder_profile=EMAIL_WRITER_PROFILE,
+        prompt_ids=None
+        ):
+        # returns (output, prompt_text, metrics), metrics as in build_decoder_metrics
+        import time
+        from helpers.decoder import (
+            prepare_decoder_inputs,
+            generate_decoder_ids,
+            extract_decoder_profile_content,
+            build_decoder_metrics
+        )
+        request_start_time = time.perf_counter()
+
+        ################################################################
+        # Use the preloaded model and processor/tokenizer (or load it) #
+        ################################################################
+        model, processor, adapter_name, assistant_model, cache_hits = self._get_request_models(
+            model_path,
+            is_vision_model,
+            is_lora_adapter,
+            use_flash_attention_2,
+            draft_model_path,
+            kv_cache_mode
+        )
+
+        ##########################################################################
+        # Add system prompt, context and current turn input, store entire prompt #
+        # (if return_prompt_text), tokenize and move ids to device (or take the  #
+        # caller's prompt_ids, see render_decoder_prompt)                        #
+        ##########################################################################
+        inputs, prompt_text = prepare_decoder_inputs(
+            model,
+            processor,
+            context,
+            current_turn_input_text,
+            current_turn_image_in_bytes,
+            system_prompt,
+            is_vision_model,
+            enable_thinking,
+            return_prompt_text,
+            prompt_ids=prompt_ids,
+            cache_owner=self,
+            worker_name="run_qwen3_lm_or_vlm"
+        )
+
+        ######################################################################
+        # Cap generation to the context left after the prompt, and admit the #
+        # request if prompt and generation fit the container's token budget  #
+        ######################################################################
+        prompt_length = inputs.input_ids.shape[1]
+        max_new_tokens, _, metrics = self._admit_request(
+            model,
+            prompt_length,
+            max_new_tokens,
+            max_context_tokens,
+            kv_cache_mode,
+            decoder_profile,
+            model_path,
+            request_start_time,
+            cache_hits,
+            "run_qwen3_lm_or_vlm"
         )
-    elif decoder_profile == DATA_CLEANER_PROFILE:
-        output_text = extract_lm_cleaned_content(
+        if metrics is not None:
+            return (None, prompt_text, metrics)
+
+        ########################################################################
+        # Generate response as token ids (from the shared prefix KV cache, and #
+        # stopping right after the profile's closing tag)                      #
+        ########################################################################
+        generation_stats = {}
+        generated_ids = generate_decoder_ids(
+            self,
+            model,
+            processor,
+            inputs,
+            model_path,
+            is_vision_model,
+            decoder_profile,
+            enable_thinking,
+            max_new_tokens,
+            temperature,
+            top_p,
+            top_k,
+            worker_name="run_qwen3_lm_or_vlm",
+            adapter_names=[adapter_name],
+            assistant_model=assistant_model,
+            thinking_budget=thinking_budget,
+            kv_cache_mode=kv_cache_mode,
+            generation_stats=generation_stats
+        )
+
+        ############################
+        # Decode token ids to text #
+        ############################
+        generated_ids_trimmed = [out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)]
+        output_text = processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        output_text = output_text[0] if output_text else None
+
+        print(f"{output_text}\n\n")
+
+        ###############################################################
+        # Remove think tokens and extract content for decoder_profile #
+        ###############################################################
+        output_text = extract_decoder_profile_content(
             output_text,
-            ABSTRACT_OPENING_TAG,
-            ABSTRACT_CLOSING_TAG,
-            SUMMARY_OPENING_TAG,
-            SUMMARY_CLOSING_TAG,
-            CLEANED_TEXT_OPENING_TAG,
-            CLEANED_TEXT_CLOSING_TAG,
-            QUESTION_OPENING_TAG,
-            QUESTION_CLOSING_TAG,
-            ANSWER_OPENING_TAG,
-            ANSWER_CLOSING_TAG
+            decoder_profile,
+            enable_thinking,
+            worker_name="run_qwen3_lm_or_vlm"
+        )
+
+        ########################################################
+        # Request metrics (tokens, timing, memory, cache hits) #
+        ########################################################
+        metrics = build_decoder_metrics(
+            "run_qwen3_lm_or_vlm",
+            decoder_profile,
+            model_path,
+            request_start_time,
+            prompt_length,
+            generation_stats=generation_stats,
+            cache_hits=cache_hits
+        )
+
+        return (output_text, prompt_text, metrics)
+
+    @modal.method()
+    def run_qwen3_lm_or_vlm_stream(
+        self,
+        context,
+        current_turn_input_text,
+        model_path,
+        is_vision_model,
+        current_turn_image_in_bytes,
+        system_prompt,
+        max_new_tokens,
+        temperature,
+        top_p,
+        top_k,
+        use_flash_attention_2,
+        enable_thinking,
+        is_lora_adapter=False,
+        draft_model_path=None,
+        max_context_tokens=None,
+        thinking_budget=None,
+        kv_cache_mode=None,
+        return_prompt_text=False,
+        decoder_profile=EMAIL_WRITER_PROFILE,
+        prompt_ids=None
+        ):
+        # yields {"type": "delta", "text"} per decoded piece, {"type": "field", "name", "content"}
+        # per completed profile tag and, last, {"type": "result", "output", "prompt_text", "metrics"}
+        import time
+        from threading import Thread
+        from transformers import TextIteratorStreamer
+        from config.decoder import PROFILE_STOP_TAGS, PROFILE_FIELD_TAGS
+        from helpers.decoder import (
+            prepare_decoder_inputs,
+            generate_decoder_ids,
+            extract_decoder_profile_content,
+            create_tag_stream_state,
+            feed_tag_stream,
+            build_decoder_metrics
         )
-    else:
-        print(f"run_qwen3_lm_or_vlm: unknown decoder_profile '{decoder_profile}'")
-        output_text = None
-    
-    return (output_text, prompt_text) if return_prompt_text else (output_text, None)
+        request_start_time = time.perf_counter()
+
+        ################################################################
+        # Use the preloaded model and processor/tokenizer (or load it) #
+        ################################################################
+        model, processor, adapter_name, assistant_model, cache_hits = self._get_request_models(
+            model_path,
+            is_vision_model,
+            is_lora_adapter,
+            use_flash_attention_2,
+            draft_model_path,
+            kv_cache_mode
+        )
+
+        ##########################################################################
+        # Add system prompt, context and current turn input, store entire prompt #
+        # (if return_prompt_text), tokenize and move ids to device (or take the  #
+        # caller's prompt_ids, see render_decoder_prompt)                        #
+        ##########################################################################
+        inputs, prompt_text = prepare_decoder_inputs(
+            model,
+            processor,
+            context,
+            current_turn_input_text,
+            current_turn_image_in_bytes,
+            system_prompt,
+            is_vision_model,
+            enable_thinking,
+            return_prompt_text,
+            prompt_ids=prompt_ids,
+            cache_owner=self,
+            worker_name="run_qwen3_lm_or_vlm_stream"
+        )
+
+        ######################################################################
+        # Cap generation to the context left after the prompt, and admit the #
+        # request if prompt and generation fit the container's token budget  #
+        ######################################################################
+        prompt_length = inputs.input_ids.shape[1]
+        max_new_tokens, _, metrics = self._admit_request(
+            model,
+            prompt_length,
+            max_new_tokens,
+            max_context_tokens,
+            kv_cache_mode,
+            decoder_profile,
+            model_path,
+            request_start_time,
+            cache_hits,
+            "run_qwen3_lm_or_vlm_stream"
+        )
+        if metrics is not None:
+            yield {"type": "result", "output": None, "prompt_text": prompt_text, "metrics": metrics}
+            return
+
+        #############################################################
+        # Generate in a background thread, decoding into a streamer #
+        #############################################################
+        streamer = TextIteratorStreamer(
+            processor.tokenizer if is_vision_model else processor,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False
+        )
+        generation_errors = []
+        generation_stats = {}
+
+        def generate():
+            try:
+                generate_decoder_ids(
+                    self,
+                    model,
+                    processor,
+                    inputs,
+                    model_path,
+                    is_vision_model,
+                    decoder_profile,
+                    enable_thinking,
+                    max_new_tokens,
+                    temperature,
+                    top_p,
+                    top_k,
+                    worker_name="run_qwen3_lm_or_vlm_stream",
+                    streamer=streamer,
+                    adapter_names=[adapter_name],
+                    assistant_model=assistant_model,
+                    thinking_budget=thinking_budget,
+                    kv_cache_mode=kv_cache_mode,
+                    generation_stats=generation_stats
+                )
+            except Exception as e:
+                generation_errors.append(e)
+                # unblock the consumer loop
+                streamer.end()
+
+        generation_thread = Thread(target=generate)
+        generation_thread.start()
+
+        ########################################################
+        # Yield token deltas and profile fields as they arrive #
+        ########################################################
+        tag_stream_state = create_tag_stream_state(
+            PROFILE_FIELD_TAGS.get(decoder_profile, []),
+            PROFILE_STOP_TAGS.get(decoder_profile, []),
+            enable_thinking
+        )
+        output_text_deltas = []
+        for text_delta in streamer:
+            if not text_delta:
+                continue
+            output_text_deltas.append(text_delta)
+            yield {"type": "delta", "text": text_delta}
+            for field_name, field_content in feed_tag_stream(tag_stream_state, text_delta):
+                yield {"type": "field", "name": field_name, "content": field_content}
+        generation_thread.join()
+
+        metrics = build_decoder_metrics(
+            "run_qwen3_lm_or_vlm_stream",
+            decoder_profile,
+            model_path,
+            request_start_time,
+            prompt_length,
+            generation_stats=generation_stats,
+            cache_hits=cache_hits
+        )
+        if generation_errors:
+            print(f"run_qwen3_lm_or_vlm_stream: generation failed: {generation_errors[0]}")
+            yield {"type": "result", "output": None, "prompt_text": prompt_text, "metrics": metrics}
+            return
+
+        ###############################################################
+        # Remove think tokens and extract content for decoder_profile #
+        ###############################################################
+        output = extract_decoder_profile_content(
+            "".join(output_text_deltas),
+            decoder_profile,
+            enable_thinking,
+            worker_name="run_qwen3_lm_or_vlm_stream"
+        )
+        yield {"type": "result", "output": output, "prompt_text": prompt_text, "metrics": metrics}
+
+    @modal.method()
+    def run_qwen3_lm_or_vlm_batch(
+        self,
+        context,
+        current_turn_input_texts,
+        model_path,
+        is_vision_model,
+        current_turn_images_in_bytes,
+        system_prompt,
+        max_new_tokens,
+        temperature,
+        top_p,
+        top_k,
+        use_flash_attention_2,
+        enable_thinking,
+        is_lora_adapter=False,
+        draft_model_path=None,
+        max_context_tokens=None,
+        thinking_budget=None,
+        kv_cache_mode=None,
+        return_prompt_text=False,
+        decoder_profile=EMAIL_WRITER_PROFILE,
+        lora_adapter_paths=None,
+        prompt_ids=None
+        ):
+        # lora_adapter_paths: optional per-prompt LoRA adapters (None for model_path) sharing model_path's base model,
+        # generated in the same (mixed-adapter) batches
+        # prompt_ids: optional per-prompt ids already rendered and tokenized by the caller (text models, see
+        # render_decoder_prompt)
+        # returns one (output, prompt_text, metrics) per prompt, metrics as in build_decoder_metrics
+        import time
+        from config.decoder import MAX_BATCH_SIZE
+        from helpers.decoder import (
+            build_decoder_messages,
+            apply_decoder_chat_template,
+            tokenize_decoder_prompt,
+            get_vlm_turn_images,
+            build_vlm_inputs,
+            build_decoder_inputs_from_ids,
+            generate_decoder_ids,
+            extract_decoder_profile_content,
+            build_decoder_metrics
+        )
+        request_start_time = time.perf_counter()
+
+        if not current_turn_input_texts:
+            return []
+
+        # images (if any) must be aligned with input texts
+        if current_turn_images_in_bytes is None:
+            current_turn_images_in_bytes = [None] * len(current_turn_input_texts)
+        if len(current_turn_images_in_bytes) != len(current_turn_input_texts):
+            print(
+                "run_qwen3_lm_or_vlm_batch: current_turn_images_in_bytes and current_turn_input_texts "
+                f"differ in length ({len(current_turn_images_in_bytes)} vs {len(current_turn_input_texts)})"
+            )
+            return [(None, None, None)] * len(current_turn_input_texts)
+        if lora_adapter_paths is not None and len(lora_adapter_paths) != len(current_turn_input_texts):
+            print(
+                "run_qwen3_lm_or_vlm_batch: lora_adapter_paths and current_turn_input_texts "
+                f"differ in length ({len(lora_adapter_paths)} vs {len(current_turn_input_texts)})"
+            )
+            return [(None, None, None)] * len(current_turn_input_texts)
+        if prompt_ids is not None and len(prompt_ids) != len(current_turn_input_texts):
+            print(
+                "run_qwen3_lm_or_vlm_batch: prompt_ids and current_turn_input_texts "
+                f"differ in length ({len(prompt_ids)} vs {len(current_turn_input_texts)})"
+            )
+            return [(None, None, None)] * len(current_turn_input_texts)
+
+        ################################################################
+        # Use the preloaded model and processor/tokenizer (or load it) #
+        ################################################################
+        # NOTE: draft_model_path is ignored, speculative decoding is single-prompt only
+        model, processor, adapter_name, _, cache_hits = self._get_request_models(
+            model_path,
+            is_vision_model,
+            is_lora_adapter,
+            use_flash_attention_2,
+            None,
+            kv_cache_mode
+        )
+        adapter_names = [adapter_name] * len(current_turn_input_texts)
+
+        # attach per-prompt adapters to the same base model (mixed-adapter batches, the 1st attached adapter wraps
+        # the base model)
+        if lora_adapter_paths is not None:
+            base_model_path = self.lora_base_model_paths.get(model_path, model_path)
+            for i, adapter_path in enumerate(lora_adapter_paths):
+                if adapter_path is None:
+                    continue
+                adapter_model, _, adapter_names[i] = self._get_model(adapter_path, is_vision_model, True, use_flash_attention_2)
+                if self.lora_base_model_paths[adapter_path] != base_model_path:
+                    print(f"run_qwen3_lm_or_vlm_batch: adapter {adapter_path} does not share base model {base_model_path}")
+                    return [(None, None, None)] * len(current_turn_input_texts)
+                model = adapter_model
+
+        results = []
+
+        ######################################################################
+        # Generate in micro-batches of up to MAX_BATCH_SIZE (shared profile) #
+        ######################################################################
+        # (smaller micro-batches when prompts and generation would not fit the container's token budget)
+        batch_start, batch_size = 0, MAX_BATCH_SIZE
+        while batch_start < len(current_turn_input_texts):
+            batch_input_texts = current_turn_input_texts[batch_start:batch_start + batch_size]
+            batch_images_in_bytes = current_turn_images_in_bytes[batch_start:batch_start + batch_size]
+            batch_adapter_names = adapter_names[batch_start:batch_start + batch_size]
+
+            # the caller's prompt_ids (left-padded), or add system prompt, (shared) context and current turn input per
+            # prompt, render the chat template once and tokenize (left-padded) the rendered prompts (VLMs: the images
+            # of all prompts preprocessed in one call, the shared context's images reused from the cache)
+            if prompt_ids is not None and not is_vision_model:
+                batch_prompt_ids = prompt_ids[batch_start:batch_start + batch_size]
+                inputs = build_decoder_inputs_from_ids(batch_prompt_ids, processor.pad_token_id)
+                prompt_texts = (
+                    processor.batch_decode(batch_prompt_ids) if return_prompt_text else [None] * len(batch_prompt_ids)
+                )
+            else:
+                batch_messages = [
+                    build_decoder_messages(context, input_text, image_in_bytes, system_prompt, is_vision_model)
+                    for input_text, image_in_bytes in zip(batch_input_texts, batch_images_in_bytes)
+                ]
+                rendered_prompt_texts = apply_decoder_chat_template(processor, batch_messages, is_vision_model, enable_thinking, tokenize=False)
+                if is_vision_model:
+                    inputs = build_vlm_inputs(
+                        self,
+                        processor,
+                        rendered_prompt_texts,
+                        [get_vlm_turn_images(context, image_in_bytes) for image_in_bytes in batch_images_in_bytes],
+                        "run_qwen3_lm_or_vlm_batch"
+                    )
+                else:
+                    inputs = tokenize_decoder_prompt(processor, rendered_prompt_texts)
+                prompt_texts = rendered_prompt_texts if return_prompt_text else [None] * len(batch_messages)
+            inputs = inputs.to(model.device)
+
+            # cap generation to the context left after the (padded) prompts, and admit as many prompts as fit the budget
+            prompt_length = inputs.input_ids.shape[1]
+            batch_max_new_tokens, admitted_batch_size, metrics = self._admit_request(
+                model,
+                prompt_length,
+                max_new_tokens,
+                max_context_tokens,
+                kv_cache_mode,
+                decoder_profile,
+                model_path,
+                request_start_time,
+                cache_hits,
+                "run_qwen3_lm_or_vlm_batch",
+                batch_size=len(batch_input_texts)
+            )
+            if admitted_batch_size < len(batch_input_texts):
+                # a single prompt that does not fit is rejected
+                if metrics is not None:
+                    results.append((None, prompt_texts[0], metrics))
+                    batch_start, batch_size = batch_start + 1, MAX_BATCH_SIZE
+                else:
+                    batch_size = max(admitted_batch_size, 1)
+                continue
+
+            # generate responses as token ids (each sequence stops right after its profile's closing tag)
+            generation_stats = {}
+            generated_ids = generate_decoder_ids(
+                self,
+                model,
+                processor,
+                inputs,
+                model_path,
+                is_vision_model,
+                decoder_profile,
+                enable_thinking,
+                batch_max_new_tokens,
+                temperature,
+                top_p,
+                top_k,
+                worker_name="run_qwen3_lm_or_vlm_batch",
+                adapter_names=batch_adapter_names,
+                thinking_budget=thinking_budget,
+                kv_cache_mode=kv_cache_mode,
+                generation_stats=generation_stats
+            )
+
+            # decode token ids to text (left padding: every prompt ends at the same position)
+            generated_ids_trimmed = [out_ids[prompt_length:] for out_ids in generated_ids]
+            output_texts = processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+            # remove think tokens and extract content for decoder_profile (timing is shared by the micro-batch,
+            # input tokens exclude padding)
+            input_token_counts = inputs.attention_mask.sum(dim=1).tolist()
+            for row, (output_text, prompt_text) in enumerate(zip(output_texts, prompt_texts)):
+                print(f"{output_text}\n\n")
+                output_text = extract_decoder_profile_content(
+                    output_text,
+                    decoder_profile,
+                    enable_thinking,
+                    worker_name="run_qwen3_lm_or_vlm_batch"
+                )
+                metrics = build_decoder_metrics(
+                    "run_qwen3_lm_or_vlm_batch",
+                    decoder_profile,
+                    model_path,
+                    request_start_time,
+                    input_token_counts[row],
+                    generation_stats=generation_stats,
+                    row=row,
+                    cache_hits=cache_hits
+                )
+                results.append((output_text, prompt_text, metrics))
+
+            print(f"run_qwen3_lm_or_vlm_batch: generated {len(results)}/{len(current_turn_input_texts)} responses")
+            batch_start, batch_size = batch_start + len(batch_input_texts), MAX_BATCH_SIZE
+
+        return results
+
+@app.local_entrypoint()
+def benchmark_cold_start(runs: int = 3, label: str = ""):
+    # usage: modal run services/decoder.py::benchmark_cold_start --runs 3 --label before
+    # (against the deployed Qwen3Decoder, toggle USE_MEMORY_SNAPSHOT / USE_SERIALIZED_MODELS and redeploy to compare)
+    import os
+    import json
+    import time
+    from datetime import datetime, timezone
+    from config.eval import RESULTS_DIR_NAME
+    from config.decoder import (
+        MODEL_PROFILES,
+        USE_SERIALIZED_MODELS,
+        COLD_START_BENCHMARK_FILE
+    )
+
+    profile_config = MODEL_PROFILES[EMAIL_WRITER_PROFILE].copy()
+    for key in ["prompt_template", "max_context_tokens", "max_chunk_size"]:
+        profile_config.pop(key, None)
+    profile_config["max_new_tokens"] = 16
+    profile_config["enable_thinking"] = False
+
+    decoder = modal.Cls.from_name("decoder", "Qwen3Decoder")()
+    os.makedirs(RESULTS_DIR_NAME, exist_ok=True)
+    results_path = os.path.join(RESULTS_DIR_NAME, COLD_START_BENCHMARK_FILE)
+
+    for run in range(runs):
+        # wait for the previous container to scale down, so every run is a cold start
+        if run > 0:
+            time.sleep(SCALEDOWN_WINDOW + 30)
+
+        #########################################################
+        # Time to first token (and to result) from a cold start #
+        #########################################################
+        start_time = time.perf_counter()
+        time_to_first_token = None
+        for event in decoder.run_qwen3_lm_or_vlm_stream.remote_gen(
+            context=[],
+            current_turn_input_text="Hi",
+            current_turn_image_in_bytes=None,
+            **profile_config,
+            decoder_profile=EMAIL_WRITER_PROFILE
+        ):
+            if event["type"] == "delta" and time_to_first_token is None:
+                time_to_first_token = time.perf_counter() - start_time
+        total_time = time.perf_counter() - start_time
+
+        result = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "label": label,
+            "run": run + 1,
+            "use_memory_snapshot": USE_MEMORY_SNAPSHOT,
+            "use_serialized_models": USE_SERIALIZED_MODELS,
+            "time_to_first_token_s": round(time_to_first_token, 2) if time_to_first_token is not None else None,
+            "total_time_s": round(total_time, 2)
+        }
+        with open(results_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+        print(f"benchmark_cold_start: {result}")
+
+    print(f"benchmark_cold_start: results appended to {results_path}")
+
+@app.local_entrypoint()
+def benchmark_kv_cache(
+        context_lengths: str = "8192,16384,32768",
+        kv_cache_modes: str = "none,quantized,offloaded",
+        max_new_tokens: int = 128,
+        max_batch_size: int = 64,
+        label: str = ""
+        ):
+    # usage: modal run services/decoder.py::benchmark_kv_cache --label l40s
+    # (max concurrent sequences and tok/s of the email writer profile's model per KV cache mode and context length)
+    import os
+    import json
+    from datetime import datetime, timezone
+    from config.eval import RESULTS_DIR_NAME
+    from config.decoder import KV_CACHE_BENCHMARK_FILE
+
+    decoder = modal.Cls.from_name("decoder", "Qwen3Decoder")()
+    os.makedirs(RESULTS_DIR_NAME, exist_ok=True)
+    results_path = os.path.join(RESULTS_DIR_NAME, KV_CACHE_BENCHMARK_FILE)
+
+    for kv_cache_mode in kv_cache_modes.split(","):
+        for context_tokens in [int(length) for length in context_lengths.split(",")]:
+            batch_results = decoder.benchmark_kv_cache_mode.remote(
+                EMAIL_WRITER_PROFILE,
+                None if kv_cache_mode == "none" else kv_cache_mode,
+                context_tokens,
+                max_new_tokens,
+                max_batch_size
+            )
+            result = {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "label": label,
+                "gpu": GPU,
+                "kv_cache_mode": kv_cache_mode,
+                "context_tokens": context_tokens,
+                "max_new_tokens": max_new_tokens,
+                "max_concurrent_sequences": batch_results[-1]["batch_size"] if batch_results else 0,
+                "tokens_per_second": batch_results[-1]["tokens_per_second"] if batch_results else None,
+                "batch_results": batch_results
+            }
+            with open(results_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(result) + "\n")
+            print(
+                f"benchmark_kv_cache: {kv_cache_mode} at {context_tokens} tokens: "
+                f"{result['max_concurrent_sequences']} concurrent sequences, {result['tokens_per_second']} tok/s"
+            )
+
+    print(f"benchmark_kv_cache: results appended to {results_path}")
@@ -1,5 +1,5 @@
 import modal
-from config.general import modal_secret
+from config.general import modal_secret, rag_volume, VOLUME_PATH
 from config.email_agent import (
     image,
     MODAL_TIMEOUT,
@@ -15,21 +15,44 @@ app = modal.App("email-agent")
         # with Cron format "Minute Hour Day Month DayOfWeek":
         schedule=modal.Cron(f"{EMAIL_MINUTE} {EMAIL_HOUR} * * *", timezone="Europe/Madrid"),
         secrets=[modal_secret],
+        volumes={VOLUME_PATH: rag_volume},
         timeout=MODAL_TIMEOUT,
         # https://modal.com/docs/guide/region-selection: price multiplier = 1.25x
         region="eu-south-2" # "spaincentral": AZR Madrid / "eu-south-2": AWS Spain
 )
 def run_email_agent():
     import os
+    import time
     from datetime import datetime
     from transformers import AutoTokenizer
-    from helpers.decoder import count_tokens, truncate_to_tokens
-
-    from helpers.data import (
-        assign_thread_ids_by_subject_and_participant_overlap_for_production,
-        get_unquoted_text
+    from helpers.decoder import (
+        count_tokens,
+        truncate_to_tokens,
+        render_decoder_prompt,
+        get_response_cache_key,
+        read_response_cache,
+        write_response_cache,
+        evict_response_cache,
+        build_decoder_metrics,
+        write_decoder_metrics,
+        record_decoder_round_trip
+    )
+    from helpers.decoder_backends import get_decoder_backend
+    from helpers.imap_session import ImapSession
+    from helpers.data import assign_thread_ids_by_subject_and_participant_overlap_for_production
+    from config.decoder import (
+        MODEL_PROFILES,
+        EMAIL_WRITER_PROFILE,
+        DECODER_BACKEND,
+        USE_RESPONSE_CACHE,
+        RESPONSE_CACHE_PATH,
+        RESPONSE_CACHE_TTL_SECONDS,
+        RESPONSE_CACHE_MAX_SIZE_MB,
+        RESPONSE_CACHE_OPT_OUT_PROFILES,
+        RESPONSE_CACHE_SAMPLING_PARAMS,
+        USE_DECODER_METRICS,
+        DECODER_METRICS_PATH
     )
-    from config.decoder import MODEL_PROFILES, EMAIL_WRITER_PROFILE
     from config.email_agent import (
         MAX_EMAILS,
         CONTEXT_EMAILS_PER_FOLDER,
@@ -44,13 +67,17 @@ def run_email_agent():
         LAST_N_DAYS,
         SEND_TO_SELF,
         SAVE_AS_DRAFT,
-        DRAFTS_FOLDER
+        DRAFTS_FOLDER,
+        USE_MAILBOX_MIRROR,
+        MAILBOX_MIRROR_PATH
     )
     from helpers.email_agent import (
         transform_env_csv_into_list,
+        sync_mailbox_mirror,
         read_latest_emails,
         format_response_quoting_original_body,
         compact_email_body_for_decoder,
+        get_context_email_block,
         send_emails,
         save_drafts,
         mark_emails_as_read
@@ -94,56 +121,70 @@ def run_email_agent():
         print("run_email_agent: MY_EMAIL_ADDRESSES must include at least one email")
         return
     
-    # find decoder service
+    # find decoder service (or run a local/fake decoder, e.g., DECODER_BACKEND=fake on a laptop or CI box)
+    decoder_backend_name = os.getenv("DECODER_BACKEND", DECODER_BACKEND)
     try:
-        run_qwen3_lm_or_vlm = modal.Function.from_name("decoder", "run_qwen3_lm_or_vlm")
+        decoder_backend = get_decoder_backend(decoder_backend_name)
     except Exception as e:
-        print(f"run_email_agent: failed to find decoder service. Is it deployed? Error: {e}")
+        print(f"run_email_agent: failed to find decoder service ({decoder_backend_name}). Is it deployed? Error: {e}")
         return
 
+    # one IMAP session (connection and login) for every read, draft and flag of the run
+    imap_session = ImapSession(imap_server, int(imap_port_str), imap_email, password, worker_name="run_email_agent")
+
+    # sync inbox and sent mailbox mirrors (only new messages are fetched, the reads below are local)
+    mirror_path = MAILBOX_MIRROR_PATH if USE_MAILBOX_MIRROR else None
+    imap_session.set_phase("sync inbox")
+    inbox_mirror, inbox_mirror_written = sync_mailbox_mirror(imap_session, INBOX_FOLDER, LAST_N_DAYS, mirror_path)
+    imap_session.set_phase("sync sent")
+    sent_mirror, sent_mirror_written = sync_mailbox_mirror(imap_session, SENT_FOLDER, LAST_N_DAYS, mirror_path)
+    mirror_written = inbox_mirror_written or sent_mirror_written
+
     # read latest emails
+    imap_session.set_phase("read emails")
     emails = read_latest_emails(
+        imap_session=imap_session,
+        mailbox_mirror=inbox_mirror,
         max_emails=MAX_EMAILS,
         folder=INBOX_FOLDER,
         last_n_days=LAST_N_DAYS,
-        imap_email=imap_email,
-        password=password,
         unread_only=UNREAD_ONLY,
-        imap_server=imap_server,
-        imap_port=int(imap_port_str),
         blacklisted_emails=blacklisted_emails,
         blacklisted_domains=blacklisted_domains
     )
     if not emails:
         print("run_email_agent: no new emails to process")
+        imap_session.logout()
+        imap_session.print_round_trips()
+        if mirror_written:
+            rag_volume.commit()
+            print("run_email_agent: volume committed")
         return
     else:
         print(f"run_email_agent: {len(emails)} new emails to process")
 
     # load additional context emails from inbox and sent folders
+    imap_session.set_phase("read inbox context")
     context_inbox_emails = read_latest_emails(
+        imap_session=imap_session,
+        mailbox_mirror=inbox_mirror,
         max_emails=CONTEXT_EMAILS_PER_FOLDER,
         folder=INBOX_FOLDER,
         last_n_days=LAST_N_DAYS,
-        imap_email=imap_email,
-        password=password,
         unread_only=False,
-        imap_server=imap_server,
-        imap_port=int(imap_port_str),
         blacklisted_emails=blacklisted_emails,
         blacklisted_domains=blacklisted_domains
     )
     # reverse to match config/decoder's oldest to newest
     context_inbox_emails = list(reversed(context_inbox_emails))
+    imap_session.set_phase("read sent context")
     context_sent_emails = read_latest_emails(
+        imap_session=imap_session,
+        mailbox_mirror=sent_mirror,
         max_emails=CONTEXT_EMAILS_PER_FOLDER,
         folder=SENT_FOLDER,
         last_n_days=LAST_N_DAYS,
-        imap_email=imap_email,
-        password=password,
         unread_only=False,
-        imap_server=imap_server,
-        imap_port=int(imap_port_str),
         blacklisted_emails=blacklisted_emails,
         blacklisted_domains=blacklisted_domains
     )
@@ -166,7 +207,8 @@ def run_email_agent():
     unique_context_emails = []
     seen_context_ids = set()
     for email in combined_context_emails:
-        email_id = email.get("id")
+        # UIDs are per folder
+        email_id = (email.get("folder"), email.get("id"))
         if email_id in seen_context_ids:
             continue
         seen_context_ids.add(email_id)
@@ -181,19 +223,31 @@ def run_email_agent():
     # select decoder configuration for email writing
     email_writer_profile_config = MODEL_PROFILES[EMAIL_WRITER_PROFILE].copy()
 
-    # pop (and save) "prompt_template" and "max_context_tokens" (run_qwen3_lm_or_vlm would not expect them)
+    # pop (and save) "prompt_template" (run_qwen3_lm_or_vlm would not expect it)
     prompt_template = email_writer_profile_config.pop("prompt_template")
-    max_context_tokens = email_writer_profile_config.pop("max_context_tokens")
+    max_context_tokens = email_writer_profile_config["max_context_tokens"]
 
-    # calculate max new tokens budget based on thinking mode, max context tokens
+    # calculate input tokens budget based on thinking mode, max context tokens (the decoder caps
+    # max new tokens to the context actually left after each tokenized prompt)
     enable_thinking = email_writer_profile_config.get("enable_thinking", False)
     input_token_budget = max_context_tokens // 3 if enable_thinking else max_context_tokens // 2
-    email_writer_profile_config["max_new_tokens"] = max_context_tokens - input_token_budget
+    email_writer_profile_config["max_new_tokens"] = None
 
     # get decoder tokenizer 
     decoder_path = email_writer_profile_config["model_path"]
     decoder_tokenizer = AutoTokenizer.from_pretrained(decoder_path, trust_remote_code=True)
 
+    # response cache (unless the profile opts out, or the backend does not run the profile's model)
+    use_response_cache = (
+        USE_RESPONSE_CACHE and
+        decoder_backend.use_response_cache and
+        EMAIL_WRITER_PROFILE not in RESPONSE_CACHE_OPT_OUT_PROFILES
+    )
+    response_cache_updated = False
+
+    # per-request decoder metrics (appended to DECODER_METRICS_PATH)
+    decoder_metrics = []
+
     # map email id to thread id and thread id to emails
     email_id_to_thread_id = {}
     thread_id_to_emails = {}
@@ -201,13 +255,20 @@ def run_email_agent():
         thread_id = thread_email.get("threadID")
         if thread_id is None:
             continue
-        email_id = thread_email.get("id")
-        if email_id is not None:
+        email_id = (thread_email.get("folder"), thread_email.get("id"))
+        if email_id[1] is not None:
             email_id_to_thread_id[email_id] = thread_id
         if thread_id not in thread_id_to_emails:
             thread_id_to_emails[thread_id] = []
         thread_id_to_emails[thread_id].append(thread_email)
 
+    # thread context blocks by context email and truncation limits (an email is context to every reply
+    # in its thread), and the tokens of the newline joining them
+    context_email_blocks = {}
+    block_join_tokens = count_tokens(decoder_tokenizer, "\n")
+
+    # prompts built for every email first, then generated concurrently
+    reply_requests = []
     reply_bodies, original_subjects, recipient_emails, processed_email_ids = [], [], [], []
 
     # for each email:
@@ -230,16 +291,16 @@ def run_email_agent():
         print(f"run_email_agent: generating reply for '{original_subject}' from {original_sender}")
 
         # if current email already includes quoted history, skip thread context
-        _, original_quoted_body = get_unquoted_text(original_body, return_quoted=True)
+        original_quoted_body = email["quoted_body"]
         skip_thread_context = bool((original_quoted_body or "").strip())
 
         # get thread context emails for this email
-        email_id = email.get("id")
+        email_id = (email.get("folder"), email.get("id"))
         thread_id = email_id_to_thread_id.get(email_id)
         thread_context_emails = [
             context_email
             for context_email in thread_id_to_emails.get(thread_id, [])
-            if context_email.get("id") != email_id
+            if (context_email.get("folder"), context_email.get("id")) != email_id
         ]
         # sort from most recent/latest to original (high to low datetime)
         thread_context_emails = sorted(
@@ -264,7 +325,8 @@ def run_email_agent():
             "[text omitted: body missing]",
             unquoted_fail_placeholder=None,
             quoted_fail_placeholder="[quoted text omitted: tokenization failed]",
-            log_prefix="run_email_agent: current email"
+            log_prefix="run_email_agent: current email",
+            unquoted_and_quoted_body=(email["unquoted_body"], email["quoted_body"])
         )
         if original_body_compacted is None:
             continue
@@ -327,67 +389,37 @@ def run_email_agent():
         # the full thread or they complement each other, but this is a fair approximation for
         # a 1st prototype
         thread_context = ""
-        message_separator = "\n[END MESSAGE]\n"
         if first_email and not skip_thread_context:
-            first_email_body = compact_email_body_for_decoder(
+            # form thread context with first email (blocks are tokenized once per run, the context's tokens
+            # are their running total: an upper bound in practice, BPE may merge tokens across the joins)
+            first_email_block = get_context_email_block(
                 decoder_tokenizer,
-                first_email.get("message_body"),
+                first_email,
                 MAX_UNQUOTED_TOKENS_PER_CONTEXT_EMAIL,
                 MAX_QUOTED_TOKENS_PER_CONTEXT_EMAIL,
-                "[text omitted: body missing]",
-                unquoted_fail_placeholder="[text omitted: tokenization failed]",
-                quoted_fail_placeholder="[quoted text omitted: tokenization failed]",
-                log_prefix="run_email_agent: context email"
-            )
-            first_email_from = (first_email.get("from") or "").strip()
-            first_email_to = (first_email.get("to") or "").strip()
-            first_email_subject = (first_email.get("subject") or "").strip()
-            first_email_date = first_email.get("date")
-            first_email_date_text = str(first_email_date) if first_email_date else ""
-            block_header = (
-                "From: " + first_email_from + "\n"
-                "To: " + first_email_to + "\n"
-                "Date: " + first_email_date_text + "\n"
-                "Subject: " + first_email_subject + "\n"
-                "Body:\n"
+                context_email_blocks
             )
-            # form thread context with first email
-            thread_context = f"{block_header}{first_email_body}{message_separator}".strip()
+            context_blocks = [first_email_block["text"]]
+            thread_context_tokens = len(first_email_block["token_ids"])
             # if first email fits, add latest emails until budget is reached
-            thread_context_tokens = count_tokens(decoder_tokenizer, thread_context)
             if prompt_tokens + thread_context_tokens <= input_token_budget:
                 for other_email in other_emails_latest_first:
-                    other_email_body = other_email.get("message_body")
-                    if not other_email_body:
+                    if not other_email.get("message_body"):
                         print("run_email_agent: skipping context email because body is missing")
                         continue
-                    other_email_body = compact_email_body_for_decoder(
+                    other_email_block = get_context_email_block(
                         decoder_tokenizer,
-                        other_email_body,
+                        other_email,
                         MAX_UNQUOTED_TOKENS_PER_CONTEXT_EMAIL,
                         MAX_QUOTED_TOKENS_PER_CONTEXT_EMAIL,
-                        "[text omitted: body missing]",
-                        unquoted_fail_placeholder="[text omitted: tokenization failed]",
-                        quoted_fail_placeholder="[quoted text omitted: tokenization failed]",
-                        log_prefix="run_email_agent: context email"
+                        context_email_blocks
                     )
-                    other_email_from = (other_email.get("from") or "").strip()
-                    other_email_to = (other_email.get("to") or "").strip()
-                    other_email_subject = (other_email.get("subject") or "").strip()
-                    other_email_date = other_email.get("date")
-                    other_email_date_text = str(other_email_date) if other_email_date else ""
-                    other_block_header = (
-                        "From: " + other_email_from + "\n"
-                        "To: " + other_email_to + "\n"
-                        "Date: " + other_email_date_text + "\n"
-                        "Subject: " + other_email_subject + "\n"
-                        "Body:\n"
-                    )
-                    candidate_context = f"{thread_context}\n{other_block_header}{other_email_body}{message_separator}".strip()
-                    candidate_tokens = count_tokens(decoder_tokenizer, candidate_context)
+                    candidate_tokens = thread_context_tokens + block_join_tokens + len(other_email_block["token_ids"])
                     if prompt_tokens + candidate_tokens > input_token_budget:
                         break
-                    thread_context = candidate_context
+                    context_blocks.append(other_email_block["text"])
+                    thread_context_tokens = candidate_tokens
+                thread_context = "\n".join(context_blocks)
             else:
                 print("run_email_agent: skipping first email because base && first email prompt exceeds input token budget")
                 thread_context = ""
@@ -414,48 +446,147 @@ def run_email_agent():
             print(f"run_email_agent: error formatting email writer prompt template (with body and context): {e}")
             continue
 
-        # run decoder (without "template" in email_writer_profile_config)
+        # render the chat template and tokenize once: the decoder takes the ids as they are
+        request_start_time = time.perf_counter()
+        rendered_prompt_text, prompt_ids = render_decoder_prompt(
+            decoder_tokenizer,
+            [],
+            prompt,
+            email_writer_profile_config["system_prompt"],
+            enable_thinking
+        )
+
+        # reuse the reply to an identical request (e.g., re-run after a failed IMAP save)
+        cache_key, cached_response = None, None
+        if use_response_cache:
+            cache_key = get_response_cache_key(
+                decoder_path,
+                EMAIL_WRITER_PROFILE,
+                rendered_prompt_text,
+                {param: email_writer_profile_config.get(param) for param in RESPONSE_CACHE_SAMPLING_PARAMS}
+            )
+            cached_response = read_response_cache(RESPONSE_CACHE_PATH, cache_key, RESPONSE_CACHE_TTL_SECONDS)
+        # a cached reply's request ends here (its metrics time the rendering and the cache lookup)
+        cached_metrics = None
+        if cached_response is not None:
+            cached_metrics = build_decoder_metrics(
+                "run_email_agent",
+                EMAIL_WRITER_PROFILE,
+                decoder_path,
+                request_start_time,
+                len(prompt_ids),
+                cache_hits={"response": True}
+            )
+
+        # generated (or taken from the cache) below, all emails at once
+        reply_requests.append({
+            "email": email,
+            "original_subject": original_subject,
+            "original_body": original_body,
+            "original_sender": original_sender,
+            "prompt": prompt,
+            "prompt_ids": prompt_ids,
+            "cache_key": cache_key,
+            "cached_response": cached_response,
+            "cached_metrics": cached_metrics
+        })
+
+    ###########################################################################
+    # Generate the uncached replies in one batched decoder request (a single #
+    # GPU container, micro-batches of MAX_BATCH_SIZE), kept in email order   #
+    ###########################################################################
+    uncached_reply_requests = [reply_request for reply_request in reply_requests if reply_request["cached_response"] is None]
+    generated_replies = []
+    generation_start_time = time.perf_counter()
+    if uncached_reply_requests:
+        # a failed prompt does not fail the rest (its email gets no reply)
         try:
-            proposed_reply, prompt_text = run_qwen3_lm_or_vlm.remote(
-                context=[],
-                current_turn_input_text=prompt,
-                current_turn_image_in_bytes=None,
+            batch_results = decoder_backend.generate_batch(
+                [],
+                [reply_request["prompt"] for reply_request in uncached_reply_requests],
+                None,
+                EMAIL_WRITER_PROFILE,
+                prompt_ids=[reply_request["prompt_ids"] for reply_request in uncached_reply_requests],
                 **email_writer_profile_config
             )
+            generated_replies = [
+                (proposed_reply, prompt_text, record_decoder_round_trip(metrics, generation_start_time))
+                for proposed_reply, prompt_text, metrics in batch_results
+            ]
         except Exception as e:
             print(f"run_email_agent: decoder generation failed: {e}")
-            continue
+            generated_replies = [None] * len(uncached_reply_requests)
+    print(
+        f"run_email_agent: generated {len(uncached_reply_requests)} replies in "
+        f"{time.perf_counter() - generation_start_time:.1f} s ({len(reply_requests) - len(uncached_reply_requests)} cached)"
+    )
+    generated_replies = iter(generated_replies)
+
+    for reply_request in reply_requests:
+        email = reply_request["email"]
+        if reply_request["cached_response"] is not None:
+            print(f"run_email_agent: response cache hit for email {email['id']}")
+            proposed_reply = reply_request["cached_response"]["output"]
+            prompt_text = reply_request["cached_response"]["prompt_text"]
+            metrics = reply_request["cached_metrics"]
+        else:
+            generated_reply = next(generated_replies)
+            if generated_reply is None:
+                continue
+            proposed_reply, prompt_text, metrics = generated_reply
+            # failed generations (None) are not cached, so they are retried
+            if reply_request["cache_key"] is not None and proposed_reply is not None:
+                response_cache_updated |= write_response_cache(
+                    RESPONSE_CACHE_PATH,
+                    reply_request["cache_key"],
+                    proposed_reply,
+                    prompt_text
+                )
 
         if MODEL_PROFILES[EMAIL_WRITER_PROFILE]["return_prompt_text"]:
             print(f"{prompt_text}\n\n")
 
+        if metrics is not None:
+            decoder_metrics.append({**metrics, "email_id": str(email["id"])})
+            print(
+                f"run_email_agent: decoder metrics for email {email['id']}: {metrics['input_tokens']} input tokens, "
+                f"ttft {metrics['ttft_ms'] or 0:.0f} ms, queue {metrics['queue_ms'] or 0:.0f} ms, total {metrics['total_ms']:.0f} ms"
+            )
+
         # if LM thinks it does not have enough info to answer or fails to use <message>...</message>, skip email reply
         if proposed_reply is None:
             continue
 
         # format reply quoting original inquiry and append it to reply bodies list
-        reply_body = format_response_quoting_original_body(proposed_reply, original_body)
+        reply_body = format_response_quoting_original_body(proposed_reply, reply_request["original_body"])
         reply_bodies.append(reply_body)
         processed_email_ids.append(email["id"])
 
         # append subject to subjects list
-        original_subjects.append(original_subject)
+        original_subjects.append(reply_request["original_subject"])
         
         # set recipient email and append it to recipient emails list
-        recipient_email = smtp_email if (SEND_TO_SELF and not SAVE_AS_DRAFT) else original_sender
+        recipient_email = smtp_email if (SEND_TO_SELF and not SAVE_AS_DRAFT) else reply_request["original_sender"]
         recipient_emails.append(recipient_email)
 
+    # persist new responses and request metrics (before saving or sending, which may fail)
+    metrics_written = USE_DECODER_METRICS and write_decoder_metrics(DECODER_METRICS_PATH, "run_email_agent", decoder_metrics)
+    if response_cache_updated:
+        evicted = evict_response_cache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_SIZE_MB)
+        print(f"run_email_agent: response cache updated ({evicted} entries evicted)")
+    if response_cache_updated or metrics_written or mirror_written:
+        rag_volume.commit()
+        print("run_email_agent: volume committed")
+
     # save drafts
     if SAVE_AS_DRAFT:
+        imap_session.set_phase("save drafts")
         success, error = save_drafts(
+            imap_session=imap_session,
             reply_bodies=reply_bodies,
             original_subjects=original_subjects,
-            imap_email=imap_email,
             smtp_email=smtp_email,
             recipient_emails=recipient_emails,
-            password=password,
-            imap_server=imap_server,
-            imap_port=int(imap_port_str),
             drafts_folder=DRAFTS_FOLDER
         )
         action_performed = f"saved {len(original_subjects)} drafts"
@@ -475,12 +606,11 @@ def run_email_agent():
     if success:
         print(f"run_email_agent: {action_performed} successfully")
         if not LEAVE_UNREAD and processed_email_ids:
+            imap_session.set_phase("mark as read")
             mark_success, mark_error = mark_emails_as_read(
+                imap_session=imap_session,
                 email_ids=processed_email_ids,
-                imap_email=imap_email,
-                password=password,
-                imap_server=imap_server,
-                imap_port=int(imap_port_str)
+                inbox_folder=INBOX_FOLDER
             )
             if mark_success:
                 print(f"run_email_agent: marked {len(processed_email_ids)} emails as read")
@@ -488,3 +618,7 @@ def run_email_agent():
                 print(f"run_email_agent: emails were replied to, but marking as read failed: {mark_error}")
     else:
         print(f"run_email_agent: error: {error}")
+
+    imap_session.set_phase("logout")
+    imap_session.logout()
+    imap_session.print_round_trips()
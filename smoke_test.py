@@ -0,0 +1,81 @@
+# usage: DECODER_BACKEND=fake python smoke_test.py
+# (no GPU, model or Modal account: every decoder profile through the agents' decoder backend, generate and stream)
+# (the modal package must be installed: config/decoder.py imports it; see test_tags.py and test_imap.py for the
+# helpers' tests)
+import os
+import sys
+import asyncio
+from helpers.decoder_backends import get_decoder_backend
+from config.decoder import (
+    MODEL_PROFILES,
+    EMAIL_WRITER_PROFILE,
+    THREAD_GROUPER_PROFILE,
+    DATA_CLEANER_PROFILE
+)
+
+#######################################################
+# Check a profile's extracted output has its expected #
+# shape (what the agents read from it)                #
+#######################################################
+def check_profile_output(decoder_profile, output):
+    if decoder_profile == EMAIL_WRITER_PROFILE:
+        return isinstance(output, str) and bool(output)
+    elif decoder_profile == THREAD_GROUPER_PROFILE:
+        return (
+            isinstance(output, list) and bool(output) and
+            all(thread["messages"] and all(message["from"] for message in thread["messages"]) for thread in output)
+        )
+    elif decoder_profile == DATA_CLEANER_PROFILE:
+        if not (isinstance(output, list) and len(output) == 5):
+            return False
+        abstract, summary, cleanedtext, questions, answers = output
+        return bool(abstract and summary and cleanedtext and questions) and len(questions) == len(answers)
+    return output is not None
+
+async def stream_profile(decoder_backend, decoder_profile, model_config):
+    events = [
+        event
+        async for event in decoder_backend.stream_aio(
+            context=[],
+            current_turn_input_text="smoke test",
+            current_turn_image_in_bytes=None,
+            **model_config,
+            decoder_profile=decoder_profile
+        )
+    ]
+    return events[-1] if events and events[-1]["type"] == "result" else None
+
+def main():
+    decoder_backend_name = os.getenv("DECODER_BACKEND", "fake")
+    decoder_backend = get_decoder_backend(decoder_backend_name)
+
+    failures = []
+    for decoder_profile, profile_config in MODEL_PROFILES.items():
+        # as the agents call the decoder: without the agent-side keys
+        model_config = profile_config.copy()
+        for key in ["prompt_template", "max_chunk_size"]:
+            model_config.pop(key, None)
+
+        output, _, metrics = decoder_backend.generate(
+            context=[],
+            current_turn_input_text="smoke test",
+            current_turn_image_in_bytes=None,
+            **model_config,
+            decoder_profile=decoder_profile
+        )
+        if not check_profile_output(decoder_profile, output) or metrics is None:
+            failures.append(f"{decoder_profile} generate")
+
+        result = asyncio.run(stream_profile(decoder_backend, decoder_profile, model_config))
+        if result is None or not check_profile_output(decoder_profile, result["output"]):
+            failures.append(f"{decoder_profile} stream")
+
+        print(f"smoke_test: {decoder_backend_name} backend, '{decoder_profile}': {output}")
+
+    if failures:
+        print(f"smoke_test: FAILED ({', '.join(failures)})")
+        sys.exit(1)
+    print(f"smoke_test: {len(MODEL_PROFILES)} profiles OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# usage: python -m pytest -q test_imap.py
+# (IMAP helpers and the mailbox mirror sync against a fake session: no IMAP server needed; the mirror sync reads
+# config/email_agent.py, which imports modal, so its tests are skipped unless modal is installed)
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import pytest
+from helpers.imap_session import build_sequence_set, parse_imap_list, find_text_plain_part
+
+#############################################################
+# build_sequence_set, parse_imap_list, find_text_plain_part #
+#############################################################
+def test_build_sequence_set():
+    assert build_sequence_set([7, 1, 2, 3, 5]) == "1:3,5,7"
+    assert build_sequence_set(["4", 4, 5]) == "4:5"
+    assert build_sequence_set([]) == ""
+
+def test_parse_imap_list():
+    text = '12 (UID 3 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL "a \\"quoted\\" part" "7BIT" 5 1))'
+    start = text.index("BODYSTRUCTURE (") + len("BODYSTRUCTURE ")
+    parsed, end = parse_imap_list(text, start)
+    assert parsed == ["TEXT", "PLAIN", ["CHARSET", "utf-8"], None, 'a "quoted" part', "7BIT", "5", "1"]
+    assert text[end:] == ")"
+    with pytest.raises(ValueError):
+        parse_imap_list("NIL")
+
+def test_find_text_plain_part_single_part():
+    bodystructure = ["TEXT", "PLAIN", ["CHARSET", "iso-8859-1"], None, None, "QUOTED-PRINTABLE", "120", "4"]
+    assert find_text_plain_part(bodystructure) == (
+        False,
+        {"section": "1", "encoding": "QUOTED-PRINTABLE", "charset": "iso-8859-1"}
+    )
+
+def test_find_text_plain_part_multipart():
+    text_part = ["TEXT", "PLAIN", ["CHARSET", "utf-8"], None, None, "7BIT", "10", "1"]
+    html_part = ["TEXT", "HTML", ["CHARSET", "utf-8"], None, None, "7BIT", "20", "1"]
+    alternative = [text_part, html_part, "ALTERNATIVE"]
+    assert find_text_plain_part([alternative, "MIXED"]) == (
+        False,
+        {"section": "1.1", "encoding": "7BIT", "charset": "utf-8"}
+    )
+    # an attached part marks the message, and attached text/plain parts are not its body
+    attachment = ["TEXT", "PLAIN", None, None, None, "BASE64", "30", "1", None, ["ATTACHMENT", ["FILENAME", "a.txt"]]]
+    has_attachment, found_part = find_text_plain_part([html_part, attachment, "MIXED"])
+    assert has_attachment and found_part is None
+
+############################################################
+# sync_mailbox_mirror (prune by internal date, fetch above #
+# the last seen UID, capped syncs)                         #
+############################################################
+NOW = datetime.now(timezone.utc)
+
+class FakeImapSession:
+    # messages: {UID: (header date, internal date)}, SEARCH matches "UID a:b SINCE d-Mon-yyyy" by internal date
+    def __init__(self, messages, highestmodseq=None):
+        self.messages = messages
+        self.selected_uidvalidity = 1
+        self.selected_highestmodseq = highestmodseq
+        self.condstore_enabled = highestmodseq is not None
+        self.searches, self.fetched_uids = 0, []
+
+    def select(self, folder, readonly=False):
+        return "OK", None
+
+    def search_uids(self, *criteria):
+        self.searches += 1
+        uid_range, since_date = criteria[1], datetime.strptime(criteria[3], "%d-%b-%Y").date()
+        first_uid, last_uid = uid_range.split(":")
+        highest_uid = max(self.messages, default=0)
+        last_uid = highest_uid if last_uid == "*" else int(last_uid)
+        # "n:*" also matches the highest UID when it is below n
+        first_uid = min(int(first_uid), highest_uid) if uid_range.endswith("*") else int(first_uid)
+        return sorted(
+            uid for uid, (_, internal_date) in self.messages.items()
+            if first_uid <= uid <= last_uid and internal_date.date() >= since_date
+        )
+
+    def fetch_messages(self, uids, message_parts):
+        fetched_messages = {}
+        for uid in uids:
+            header_date, internal_date = self.messages[uid]
+            if "HEADER" in message_parts:
+                self.fetched_uids.append(uid)
+                fetched_messages[uid] = {
+                    "text": (
+                        f'1 (UID {uid} INTERNALDATE "{internal_date.strftime("%d-%b-%Y %H:%M:%S %z")}" '
+                        'BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {10}) '
+                        'BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 5 1))'
+                    ),
+                    "sections": {
+                        "HEADER.FIELDS (FROM TO SUBJECT DATE)": (
+                            f"From: sender@example.com\r\nSubject: email {uid}\r\nDate: {format_datetime(header_date)}\r\n\r\n"
+                        ).encode()
+                    }
+                }
+            else:
+                fetched_messages[uid] = {"text": "", "sections": {"1": f"body {uid}".encode()}}
+        return fetched_messages
+
+def sync(imap_session, mirror_path, last_n_days=30):
+    pytest.importorskip("modal")
+    from helpers.email_agent import sync_mailbox_mirror
+
+    imap_session.fetched_uids = []
+    return sync_mailbox_mirror(imap_session, "INBOX", last_n_days, mirror_path)
+
+def test_sync_fetches_only_new_messages(tmp_path):
+    imap_session = FakeImapSession({1: (NOW, NOW), 2: (NOW, NOW)})
+    mailbox_mirror, mirror_written = sync(imap_session, str(tmp_path))
+    assert sorted(imap_session.fetched_uids) == [1, 2] and mirror_written
+    assert mailbox_mirror["messages"]["1"]["message_body"] == "body 1"
+
+    # unchanged folder: nothing fetched or written
+    mailbox_mirror, mirror_written = sync(imap_session, str(tmp_path))
+    assert imap_session.fetched_uids == [] and not mirror_written
+
+    # new message above the last seen UID, expunged message leaves the mirror
+    imap_session.messages[3] = (NOW, NOW)
+    del imap_session.messages[1]
+    mailbox_mirror, _ = sync(imap_session, str(tmp_path))
+    assert imap_session.fetched_uids == [3]
+    assert sorted(mailbox_mirror["messages"], key=int) == ["2", "3"]
+
+def test_sync_prunes_by_internal_date(tmp_path):
+    # 1: old header date but recent internal date (kept, SEARCH SINCE matches it), 2: old internal date (never fetched)
+    imap_session = FakeImapSession({1: (NOW - timedelta(days=60), NOW - timedelta(days=2)), 2: (NOW, NOW - timedelta(days=60))})
+    mailbox_mirror, _ = sync(imap_session, str(tmp_path))
+    assert imap_session.fetched_uids == [1]
+    mailbox_mirror, _ = sync(imap_session, str(tmp_path))
+    assert imap_session.fetched_uids == [] and list(mailbox_mirror["messages"]) == ["1"]
+
+    # a shorter window prunes it locally, and it is not fetched again
+    mailbox_mirror, _ = sync(imap_session, str(tmp_path), last_n_days=1)
+    assert imap_session.fetched_uids == [] and mailbox_mirror["messages"] == {}
+
+def test_sync_capped_fetch_leaves_the_rest_for_the_next_sync(tmp_path, monkeypatch):
+    pytest.importorskip("modal")
+    import config.email_agent
+
+    monkeypatch.setattr(config.email_agent, "MAILBOX_MIRROR_MAX_FETCH_PER_SYNC", 2)
+    imap_session = FakeImapSession({uid: (NOW, NOW) for uid in range(1, 6)})
+    mailbox_mirror, _ = sync(imap_session, str(tmp_path))
+    # latest first
+    assert imap_session.fetched_uids == [5, 4] and mailbox_mirror["pending"]
+    mailbox_mirror, _ = sync(imap_session, str(tmp_path))
+    assert imap_session.fetched_uids == [3, 2] and mailbox_mirror["pending"]
+    mailbox_mirror, _ = sync(imap_session, str(tmp_path))
+    assert imap_session.fetched_uids == [1] and not mailbox_mirror["pending"]
+    assert len(mailbox_mirror["messages"]) == 5
+
+def test_sync_skips_unchanged_highestmodseq(tmp_path):
+    imap_session = FakeImapSession({1: (NOW, NOW)}, highestmodseq=7)
+    sync(imap_session, str(tmp_path))
+    searches = imap_session.searches
+    mailbox_mirror, mirror_written = sync(imap_session, str(tmp_path))
+    assert imap_session.searches == searches and not mirror_written
+    assert list(mailbox_mirror["messages"]) == ["1"]
+
+def test_sync_in_memory_fetches_only_what_the_run_reads(monkeypatch):
+    pytest.importorskip("modal")
+    import config.email_agent
+
+    monkeypatch.setattr(config.email_agent, "CONTEXT_EMAILS_PER_FOLDER", 2)
+    imap_session = FakeImapSession({uid: (NOW, NOW) for uid in range(1, 6)})
+    mailbox_mirror, mirror_written = sync(imap_session, None)
+    assert imap_session.fetched_uids == [5, 4] and not mirror_written
+    assert not mailbox_mirror["pending"]
@@ -0,0 +1,107 @@
+# usage: python -m pytest -q test_tags.py
+# (tag scanning, streaming tag parser and tag grammars of helpers/decoder.py: no GPU, model or Modal needed)
+from helpers.decoder import (
+    scan_tags,
+    find_tag_nodes,
+    create_tag_stream_state,
+    feed_tag_stream,
+    compile_tag_grammar,
+    advance_tag_grammar
+)
+
+MESSAGE_TAGS = ("<message>", "</message>")
+THREAD_TAGS = ("<thread>", "</thread>")
+FIELD_TAGS = [("<abstract>", "</abstract>"), ("<summary>", "</summary>")]
+STOP_TAGS = ["</summary>"]
+DATA_CLEANER_GRAMMAR = ("sequence", [
+    ("field", "<abstract>", "</abstract>"),
+    ("block", "<questions>", "</questions>", ("repeat", ("sequence", [
+        ("field", "<question>", "</question>"),
+        ("field", "<answer>", "</answer>")
+    ])))
+])
+EMAIL_WRITER_GRAMMAR = ("choice", [("field", "<message>", "</message>"), ("field", "<nomessage>", "</nomessage>")])
+
+def is_complete(compiled_grammar, states):
+    return any(compiled_grammar["nodes"][node_index][0] == "end" for node_index, _ in states)
+
+################################
+# scan_tags and find_tag_nodes #
+################################
+def test_scan_tags_nested_and_sibling_tags():
+    response = "<message>a <message>b</message> c</message> <message>d</message>"
+    tag_nodes = find_tag_nodes(scan_tags(response, [MESSAGE_TAGS]), "<message>")
+    assert [tag_node["content"] for tag_node in tag_nodes] == ["a <message>b</message> c", "b", "d"]
+
+def test_scan_tags_ignores_unmatched_tags():
+    response = "text </message> <message>ok</message> <message>unclosed"
+    tag_nodes = find_tag_nodes(scan_tags(response, [MESSAGE_TAGS]), "<message>")
+    assert [tag_node["content"] for tag_node in tag_nodes] == ["ok"]
+
+def test_scan_tags_unclosed_tag_keeps_closed_children():
+    response = "<thread><message>a</message>"
+    tag_nodes = scan_tags(response, [THREAD_TAGS, MESSAGE_TAGS])
+    assert find_tag_nodes(tag_nodes, "<thread>") == []
+    assert [tag_node["content"] for tag_node in find_tag_nodes(tag_nodes, "<message>")] == ["a"]
+
+def test_find_tag_nodes_direct_children_only():
+    response = "<thread><message>a <message>quoted</message></message><message>b</message></thread>"
+    thread = find_tag_nodes(scan_tags(response, [THREAD_TAGS, MESSAGE_TAGS]), "<thread>")[0]
+    direct_messages = find_tag_nodes(thread["children"], "<message>", direct_children_only=True)
+    assert [message["content"] for message in direct_messages] == ["a <message>quoted</message>", "b"]
+    assert len(find_tag_nodes(thread["children"], "<message>")) == 3
+
+##############################################
+# feed_tag_stream (tags split across deltas) #
+##############################################
+def feed_in_chunks(state, text, chunk_size):
+    completed_fields = []
+    for chunk_start in range(0, len(text), chunk_size):
+        completed_fields += feed_tag_stream(state, text[chunk_start:chunk_start + chunk_size])
+    return completed_fields
+
+def test_feed_tag_stream_tags_split_across_chunks():
+    text = "<think>I could write <abstract>x</abstract> here</think>\n<abstract> A </abstract><summary>S</summary>trailing <abstract>"
+    for chunk_size in [1, 2, 3, 5, len(text)]:
+        state = create_tag_stream_state(FIELD_TAGS, STOP_TAGS, True)
+        assert feed_in_chunks(state, text, chunk_size) == [("abstract", "A"), ("summary", "S")], chunk_size
+        assert state["done"]
+
+def test_feed_tag_stream_stops_at_stop_tag():
+    state = create_tag_stream_state([MESSAGE_TAGS], ["</message>"], False)
+    assert feed_in_chunks(state, "<message>Hello</message><message>again</message>", 4) == [("message", "Hello")]
+    assert state["done"]
+    assert feed_tag_stream(state, "<message>more</message>") == []
+
+###############################################
+# compile_tag_grammar and advance_tag_grammar #
+###############################################
+def test_tag_grammar_accepts_complete_output():
+    compiled_grammar = compile_tag_grammar(DATA_CLEANER_GRAMMAR)
+    text = "\n<abstract> a <b> </abs </abstract>\n<questions>\n<question>q?</question><answer>a</answer>\n</questions>\n"
+    states = advance_tag_grammar(compiled_grammar["nodes"], compiled_grammar["start"], text)
+    assert states and is_complete(compiled_grammar, states)
+
+def test_tag_grammar_prefixes_and_violations():
+    compiled_grammar = compile_tag_grammar(DATA_CLEANER_GRAMMAR)
+    nodes, start = compiled_grammar["nodes"], compiled_grammar["start"]
+    # a valid prefix is not complete yet
+    states = advance_tag_grammar(nodes, start, "<abstract>x</abstract><questions><question>q")
+    assert states and not is_complete(compiled_grammar, states)
+    # a tag out of order breaks the grammar
+    assert not advance_tag_grammar(nodes, start, "<abstract>x</abstract><summary>")
+    # a question without its answer breaks it as well
+    assert not advance_tag_grammar(nodes, start, "<abstract>x</abstract><questions><question>x</question></questions>")
+
+def test_tag_grammar_choice_and_incremental_advance():
+    compiled_grammar = compile_tag_grammar(EMAIL_WRITER_GRAMMAR)
+    nodes, start = compiled_grammar["nodes"], compiled_grammar["start"]
+    assert advance_tag_grammar(nodes, start, "<nom")
+    assert not advance_tag_grammar(nodes, start, "hello")
+    # advancing chunk by chunk reaches the same states as advancing over the whole text
+    text = "<message>Hi </mess age></message>"
+    states = start
+    for c in text:
+        states = advance_tag_grammar(nodes, states, c)
+    assert states == advance_tag_grammar(nodes, start, text)
+    assert is_complete(compiled_grammar, states)